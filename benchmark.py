@@ -0,0 +1,366 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import tempfile
+import time
+import tracemalloc
+
+import chart_pack
+import ddr2vibes
+import generate_headers
+
+
+BENCHMARK_VERSION = 1
+
+# Raw chart types of the single charts, the same values CHART_TYPE_LOOKUP maps to CHART_TYPES
+SSQ_CHART_TYPES = [0x0414, 0x0114, 0x0214, 0x0314, 0x0614]
+
+# CMS difficulties of the same charts, CmsReader maps them to 0x14 | ((diff + 1) << 8)
+CMS_CHART_DIFFS = [3, 0, 1, 2, 5]
+
+# One measure is 4096 offset units, 1024 per beat
+NOTE_SPACINGS = [128, 256, 256, 512, 512, 1024]
+
+STAGES = ["parse", "convert", "convert_reference", "write", "write_pack", "headers_raw", "headers_delta", "headers_pack"]
+
+
+def generate_notes(rng, note_count, freeze_density):
+    # Returns a list of (offset, note, is_freeze_end) for player 1 panels only so every chart converts
+    notes = []
+    active_freezes = {}
+    offset = 4096
+
+    while len(notes) < note_count:
+        offset += rng.choice(NOTE_SPACINGS)
+
+        if active_freezes and rng.random() < 0.5:
+            panel = rng.choice(sorted(active_freezes.keys()))
+            del active_freezes[panel]
+            notes.append((offset, 1 << panel, True))
+            continue
+
+        panels = [x for x in range(4) if x not in active_freezes]
+        if not panels:
+            continue
+
+        note = 0
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            note |= 1 << rng.choice(panels)
+
+        notes.append((offset, note, False))
+
+        if bin(note).count("1") == 1 and rng.random() < freeze_density:
+            active_freezes[note.bit_length() - 1] = offset
+
+    return notes
+
+
+def generate_tempo(rng, end_offset, bpm_changes):
+    # Returns (offsets, data) at a tick rate of 150, with segment boundaries on beats and the occasional stop
+    tick_rate = 150
+    beats = end_offset // 1024 + 1
+    boundaries = sorted(rng.sample(range(1, beats), min(bpm_changes, beats - 1))) + [beats]
+
+    offsets = [0]
+    data = [rng.randint(0, 300)]
+    for beat in boundaries:
+        if rng.random() < 0.1 and beat != boundaries[-1]:
+            offsets.append(offsets[-1])
+            data.append(data[-1] + rng.randint(10, 200))
+
+        segment_beats = beat - offsets[-1] // 1024
+        offsets.append(beat * 1024)
+        data.append(data[-1] + max(1, int(segment_beats / rng.uniform(60, 400) * 60 * tick_rate)))
+
+    return tick_rate, offsets, data
+
+
+def make_ssq_chunk(chunk_type, raw):
+    raw = bytes(raw) + bytes(len(raw) % 2)
+    raw = struct.pack("<H", chunk_type) + raw
+    raw += bytes((4 - (len(raw) + 4) % 4) % 4)
+    return struct.pack("<I", len(raw) + 4) + raw
+
+
+def generate_ssq(rng, note_count, bpm_changes, freeze_density, chart_count=len(SSQ_CHART_TYPES)):
+    charts = [generate_notes(rng, note_count, freeze_density) for _ in range(chart_count)]
+    end_offset = max([x[-1][0] for x in charts]) + 4096
+
+    tick_rate, tempo_offsets, tempo_data = generate_tempo(rng, end_offset, bpm_changes)
+    data = make_ssq_chunk(0x01, struct.pack("<HHH", tick_rate, len(tempo_offsets), 0) + struct.pack("<%di" % len(tempo_offsets), *tempo_offsets) + struct.pack("<%di" % len(tempo_data), *tempo_data))
+
+    event_offsets = [-4096, 0, 1024, end_offset - 4096, end_offset]
+    event_data = [0x0401, 0x0102, 0x0202, 0x0302, 0x0402]
+    data += make_ssq_chunk(0x02, struct.pack("<HHH", 1, len(event_offsets), 0) + struct.pack("<5i", *event_offsets) + struct.pack("<5H", *event_data))
+
+    for chart_type, notes in zip(SSQ_CHART_TYPES, charts):
+        # Freeze ends are a 0 note byte followed by a (note, 1) extra pair
+        note_data = bytes([0 if is_freeze_end else note for offset, note, is_freeze_end in notes])
+        note_data += bytes((6 + len(notes) * 5) % 2)
+        extra_data = b"".join([bytes([note, 1]) for offset, note, is_freeze_end in notes if is_freeze_end])
+        data += make_ssq_chunk(0x03, struct.pack("<HHH", chart_type, len(notes), 0) + struct.pack("<%di" % len(notes), *[x[0] for x in notes]) + note_data + extra_data)
+
+    return data + bytes(4)
+
+
+def generate_cms(rng, note_count, bpm_changes, chart_count=len(CMS_CHART_DIFFS)):
+    # CMS charts have no freezes
+    charts = [generate_notes(rng, note_count, 0) for _ in range(chart_count)]
+    end_offset = max([x[-1][0] for x in charts]) + 4096
+
+    tick_rate, tempo_offsets, tempo_data = generate_tempo(rng, end_offset, bpm_changes)
+    tempo = b"".join([struct.pack("<ii", offset, int(sample * 0x4b / tick_rate)) for offset, sample in zip(tempo_offsets, tempo_data)])
+    data = struct.pack("<I", len(tempo) + 4) + tempo
+
+    for diff, notes in zip(CMS_CHART_DIFFS, charts):
+        chart = bytes([0, diff, 0, 0]) + bytes(4) + b"\xff" * 4
+
+        for offset, note, is_freeze_end in notes:
+            # p1_l/p1_d are the low/high nibble of the first byte, p1_u/p1_r of the second
+            chart += struct.pack("<iBBBB", offset, (note & 1) | ((note & 2) << 3), ((note & 4) >> 2) | ((note & 8) << 1), 0, 0)
+
+        chart += struct.pack("<i", end_offset) + b"\xff" * 4
+        data += struct.pack("<I", len(chart) + 4) + chart
+
+    return data + bytes(4)
+
+
+def generate_corpus(folder, song_count, note_count, bpm_changes, freeze_density, input_formats, seed):
+    # Every song gets its own folder with a package.json, formats are cycled through so the corpus mixes all readers
+    rng = random.Random(seed)
+    paths = []
+
+    for idx in range(song_count):
+        input_format = input_formats[idx % len(input_formats)]
+        song_folder = os.path.join(folder, "%05d" % idx)
+        os.makedirs(song_folder, exist_ok=True)
+
+        if input_format == "cms":
+            data = generate_cms(rng, note_count, bpm_changes)
+
+        else:
+            data = generate_ssq(rng, note_count, bpm_changes, freeze_density)
+
+        path = os.path.join(song_folder, "all.%s" % input_format)
+        open(path, "wb").write(data)
+
+        json.dump({
+            'music_id': "bench%05d" % idx,
+            'title': "Benchmark Song %d" % idx,
+        }, open(os.path.join(song_folder, "package.json"), "w"))
+
+        paths.append(path)
+
+    return paths
+
+
+def run_parse(paths, chart_folder):
+    for path in paths:
+        reader = ddr2vibes.open_reader(path)
+        reader.load_tempo()
+        reader.get_chunks(["notes"], ddr2vibes.CHART_TYPES)
+
+
+def run_convert(paths, chart_folder, reference=False):
+    for path in paths:
+        ddr2vibes.convert(path, ddr2vibes.CHART_TYPES, reference=reference)
+
+
+def run_write(paths, chart_folder):
+    shutil.rmtree(chart_folder, ignore_errors=True)
+    os.makedirs(chart_folder)
+
+    for path in paths:
+        result = ddr2vibes.convert_file(path, ddr2vibes.CHART_TYPES, chart_folder)
+
+        if result['error']:
+            raise ddr2vibes.ConversionError("%s: %s" % (path, result['error']))
+
+
+def get_pack_path(chart_folder):
+    return chart_folder + ".vpk"
+
+
+def run_write_pack(paths, chart_folder):
+    pack_path = get_pack_path(chart_folder)
+    if os.path.exists(pack_path):
+        os.remove(pack_path)
+
+    packed = []
+    for path in paths:
+        result = ddr2vibes.convert_file(path, ddr2vibes.CHART_TYPES, chart_folder, pack=pack_path)
+
+        if result['error']:
+            raise ddr2vibes.ConversionError("%s: %s" % (path, result['error']))
+
+        packed += result['packed']
+
+    chart_pack.append_charts(pack_path, packed)
+
+
+def run_headers(paths, chart_folder, event_format):
+    charts, changed, removed = generate_headers.load_charts(chart_folder, {})
+    charts = generate_headers.sort_charts(charts, "path")
+    event_count, regions, dedupe_saved = generate_headers.layout_charts(charts, event_format)
+    generate_headers.render_chart_list(charts, regions, event_count, event_format)
+    generate_headers.render_chart_meta(charts, event_format)
+
+
+STAGE_FUNCTIONS = {
+    'parse': run_parse,
+    'convert': run_convert,
+    'convert_reference': lambda paths, chart_folder: run_convert(paths, chart_folder, True),
+    'write': run_write,
+    'write_pack': run_write_pack,
+    'headers_raw': lambda paths, chart_folder: run_headers(paths, chart_folder, "raw"),
+    'headers_delta': lambda paths, chart_folder: run_headers(paths, chart_folder, "delta"),
+    'headers_pack': lambda paths, chart_folder: run_headers(paths, get_pack_path(chart_folder), "delta"),
+}
+
+
+def run_stage(stage, paths, chart_folder, repeat, measure_memory=True):
+    # The best of repeat runs is reported, peak memory is measured in a separate run since tracemalloc slows everything down
+    func = STAGE_FUNCTIONS[stage]
+
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(paths, chart_folder)
+        times.append(time.perf_counter() - start_time)
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        func(paths, chart_folder)
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'time': min(times),
+        'times': times,
+        'peak_memory': peak_memory,
+    }
+
+
+def compare_results(results, baseline, threshold):
+    # Returns a list of (stage, metric, baseline value, value) for every metric that got worse by more than threshold
+    regressions = []
+
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+
+        for metric in ['time', 'peak_memory']:
+            baseline_value = baseline['stages'][stage][metric]
+
+            if result[metric] is None or baseline_value is None:
+                continue
+
+            if result[metric] > baseline_value * (1 + threshold):
+                regressions.append((stage, metric, baseline_value, result[metric]))
+
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print("%-18s %10s %12s %10s %14s" % ("Stage", "Time (s)", "Charts/s", "Peak (MB)", "vs baseline"))
+
+    for stage, result in results['stages'].items():
+        change = ""
+        if baseline and stage in baseline['stages'] and baseline['stages'][stage]['time'] > 0:
+            change = "%+.1f%%" % ((result['time'] / baseline['stages'][stage]['time'] - 1) * 100)
+
+        rate = results['chart_count'] / result['time'] if result['time'] > 0 else 0
+        peak_memory = "-" if result['peak_memory'] is None else "%.2f" % (result['peak_memory'] / (1024 * 1024))
+        print("%-18s %10.3f %12.1f %10s %14s" % (stage, result['time'], rate, peak_memory, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', '--songs', help='Number of songs in the synthetic library', default=100, type=int)
+    parser.add_argument('--notes', help='Notes per chart', default=400, type=int)
+    parser.add_argument('--bpm-changes', help='BPM changes per song', default=8, type=int)
+    parser.add_argument('--freeze-density', help='Chance of a single panel note starting a freeze (SSQ/CSQ only)', default=0.1, type=float)
+    parser.add_argument('--formats', help='Input formats to cycle through', default=ddr2vibes.INPUT_FORMATS, nargs='+', choices=ddr2vibes.INPUT_FORMATS)
+    parser.add_argument('--seed', help='Seed of the synthetic library', default=0, type=int)
+    parser.add_argument('--stages', help='Stages to run', default=STAGES, nargs='+', choices=STAGES)
+    parser.add_argument('-r', '--repeat', help='Timed runs per stage, the fastest is reported', default=3, type=int)
+    parser.add_argument('--no-memory', help="Don't measure peak memory, which needs an extra (much slower) run of every stage", default=False, action='store_true')
+    parser.add_argument('-w', '--work', help='Folder for the synthetic library and converted charts (a temporary folder by default)', default=None)
+    parser.add_argument('-o', '--output', help='Write the results to a JSON file', default=None)
+    parser.add_argument('--baseline', help='Compare against a results JSON file from an earlier run', default=None)
+    parser.add_argument('--save-baseline', help='Write the results to this file to compare against later', default=None)
+    parser.add_argument('--threshold', help='Fractional slowdown or memory increase over the baseline that counts as a regression', default=0.1, type=float)
+
+    args = parser.parse_args()
+
+    work_folder = args.work or tempfile.mkdtemp(prefix="viber_benchmark_")
+    song_folder = os.path.join(work_folder, "songs")
+    chart_folder = os.path.join(work_folder, "charts")
+
+    config = {
+        'songs': args.songs,
+        'notes': args.notes,
+        'bpm_changes': args.bpm_changes,
+        'freeze_density': args.freeze_density,
+        'formats': args.formats,
+        'seed': args.seed,
+    }
+
+    try:
+        print("Generating %d songs in %s" % (args.songs, song_folder))
+        shutil.rmtree(song_folder, ignore_errors=True)
+        paths = generate_corpus(song_folder, args.songs, args.notes, args.bpm_changes, args.freeze_density, args.formats, args.seed)
+
+        # The header stages read the charts the write stages converted
+        stages = args.stages
+        if [x for x in stages if x in ["headers_raw", "headers_delta"]] and "write" not in stages:
+            run_write(paths, chart_folder)
+
+        if "headers_pack" in stages and "write_pack" not in stages:
+            run_write_pack(paths, chart_folder)
+
+        results = {
+            'version': BENCHMARK_VERSION,
+            'config': config,
+            'python': platform.python_version(),
+            'chart_count': len(paths) * len(ddr2vibes.CHART_TYPES),
+            'stages': {},
+        }
+
+        for stage in [x for x in STAGES if x in stages]:
+            results['stages'][stage] = run_stage(stage, paths, chart_folder, args.repeat, not args.no_memory)
+
+    finally:
+        if args.work is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        baseline = json.load(open(args.baseline, "r"))
+
+        if baseline.get('version') != BENCHMARK_VERSION or baseline.get('config') != config:
+            print("Baseline was run with a different configuration, times aren't comparable")
+            baseline = None
+
+    print_results(results, baseline)
+
+    if args.output:
+        json.dump(results, open(args.output, "w"), indent=4)
+
+    if args.save_baseline:
+        json.dump(results, open(args.save_baseline, "w"), indent=4)
+
+    if baseline:
+        regressions = compare_results(results, baseline, args.threshold)
+
+        for stage, metric, baseline_value, value in regressions:
+            print("Regression in %s %s: %.4g -> %.4g (%+.1f%%)" % (stage, metric, baseline_value, value, (value / baseline_value - 1) * 100))
+
+        if regressions:
+            exit(1)
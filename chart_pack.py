@@ -0,0 +1,329 @@
+import argparse
+import array
+import fnmatch
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from profiling import profiler
+
+
+PACK_MAGIC = b"VIBP"
+PACK_VERSION = 2
+
+# magic, version, chart count, index offset
+PACK_HEADER = struct.Struct("<4sHxxIQ")
+
+# name length, title length, flags, event count, beat segment count, data offset, SHA-256 of the title and data block.
+# The UTF-8 name and title follow each entry.
+PACK_ENTRY = struct.Struct("<HHIIIQ32s")
+
+# start_us, period_num, period_den, count of a beats entry
+PACK_BEAT = struct.Struct("<qQQI")
+
+# Set when the chart has a beat schedule, an empty one is kept apart from none at all for the JSON export
+PACK_HAS_BEATS = 1
+
+# Appends leave replaced charts and old indexes behind, the pack is compacted once they're more than this fraction of it
+PACK_MAX_WASTE = 0.5
+
+
+class ChartPackError(ValueError):
+    pass
+
+
+def read_index(data, path):
+    if len(data) < PACK_HEADER.size:
+        raise ChartPackError("Not a chart pack: %s" % path)
+
+    magic, version, count, index_offset = PACK_HEADER.unpack_from(data)
+
+    if magic != PACK_MAGIC:
+        raise ChartPackError("Not a chart pack: %s" % path)
+
+    if version != PACK_VERSION:
+        raise ChartPackError("Unsupported chart pack version %d: %s" % (version, path))
+
+    entries = {}
+
+    try:
+        cursor = index_offset
+        for _ in range(count):
+            name_length, title_length, flags, event_count, beat_count, offset, chart_hash = PACK_ENTRY.unpack_from(data, cursor)
+            cursor += PACK_ENTRY.size
+
+            name = bytes(data[cursor:cursor+name_length]).decode('utf-8')
+            title = bytes(data[cursor+name_length:cursor+name_length+title_length]).decode('utf-8')
+            cursor += name_length + title_length
+
+            entries[name] = {
+                'title': title,
+                'flags': flags,
+                'event_count': event_count,
+                'beat_count': beat_count,
+                'offset': offset,
+                'hash': chart_hash.hex(),
+            }
+
+    except struct.error as e:
+        raise ChartPackError("Truncated chart pack index: %s" % path) from e
+
+    return entries
+
+
+def get_data_size(entry):
+    return entry['event_count'] * 5 + entry['beat_count'] * PACK_BEAT.size
+
+
+def get_chart_hash(title, data):
+    # Kept in the index so a chart can be told apart from its old version without reading its data block
+    return hashlib.sha256(title.encode('utf-8') + data).hexdigest()
+
+
+def encode_chart(vibes):
+    # Returns (index entry without its offset, data block). The block is the uint32 timestamps, the note_bits bytes and the beats.
+    timestamps = array.array('I', [x['timestamp'] for x in vibes['events']])
+    if sys.byteorder != "little":
+        timestamps.byteswap()
+
+    beats = vibes.get('beats')
+
+    entry = {
+        'title': vibes['title'],
+        'flags': 0 if beats is None else PACK_HAS_BEATS,
+        'event_count': len(timestamps),
+        'beat_count': len(beats or []),
+    }
+
+    data = timestamps.tobytes() + bytes([x['note_bits'] for x in vibes['events']])
+    data += b"".join([PACK_BEAT.pack(x['start_us'], x['period_num'], x['period_den'], x['count']) for x in beats or []])
+    entry['hash'] = get_chart_hash(entry['title'], data)
+
+    return entry, data
+
+
+def write_index(outfile, entries):
+    index_offset = outfile.tell()
+
+    for name, entry in entries.items():
+        name_bytes = name.encode('utf-8')
+        title_bytes = entry['title'].encode('utf-8')
+        outfile.write(PACK_ENTRY.pack(len(name_bytes), len(title_bytes), entry['flags'], entry['event_count'], entry['beat_count'], entry['offset'], bytes.fromhex(entry['hash'])))
+        outfile.write(name_bytes)
+        outfile.write(title_bytes)
+
+    return index_offset
+
+
+def write_header(outfile, entries, index_offset):
+    outfile.seek(0)
+    outfile.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(entries), index_offset))
+
+
+def get_pack_size(entries):
+    return PACK_HEADER.size + sum([PACK_ENTRY.size + len(name.encode('utf-8')) + len(x['title'].encode('utf-8')) + get_data_size(x) for name, x in entries.items()])
+
+
+class ChartPack:
+    # Read only view of a chart pack. The file is memory mapped and only the index is decoded up front,
+    # every chart's events are decoded from the map when that chart is requested.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self.file.fileno()).st_size else b""
+        self.entries = read_index(self.data, path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+        self.file.close()
+
+
+    def names(self):
+        return list(self.entries.keys())
+
+
+    def get_raw(self, name):
+        # Slicing the map only reads this chart's pages of the file
+        entry = self.entries[name]
+        return self.data[entry['offset']:entry['offset'] + get_data_size(entry)]
+
+
+    def read_chart(self, name):
+        # Returns {title, timestamps, notes, beats}, beats is None when the chart was packed without a beat schedule
+        entry = self.entries[name]
+        raw = self.get_raw(name)
+        count = entry['event_count']
+
+        if len(raw) != get_data_size(entry):
+            raise ChartPackError("Truncated chart data for %s: %s" % (name, self.path))
+
+        timestamps = array.array('I')
+        timestamps.frombytes(raw[:count * 4])
+        if sys.byteorder != "little":
+            timestamps.byteswap()
+
+        beats = None
+        if entry['flags'] & PACK_HAS_BEATS:
+            beats = [{
+                'start_us': start_us,
+                'period_num': period_num,
+                'period_den': period_den,
+                'count': beat_count,
+            } for start_us, period_num, period_den, beat_count in PACK_BEAT.iter_unpack(raw[count * 5:])]
+
+        profiler.count("bytes_read", len(raw))
+
+        return {
+            'title': entry['title'],
+            'timestamps': timestamps.tolist(),
+            'notes': list(raw[count * 4:count * 5]),
+            'beats': beats,
+        }
+
+
+    def read_vibes(self, name):
+        # The chart in the same form as the JSON files ddr2vibes.py writes
+        chart = self.read_chart(name)
+
+        vibes = {
+            'title': chart['title'],
+            'events': [{'timestamp': timestamp, 'note_bits': note_bits} for timestamp, note_bits in zip(chart['timestamps'], chart['notes'])],
+        }
+
+        if chart['beats'] is not None:
+            vibes['beats'] = chart['beats']
+
+        return vibes
+
+
+def append_charts(pack_path, charts):
+    # Adds (name, vibes) charts to the pack, creating it if needed. The new data is written after everything already
+    # in the file, followed by a new index, and the header is rewritten last to point at it, so a failed append
+    # leaves the previous contents readable. A chart with a name that's already in the pack replaces it.
+    entries = {}
+    if os.path.exists(pack_path):
+        with ChartPack(pack_path) as pack:
+            entries = pack.entries
+
+    with open(pack_path, "r+b" if entries else "w+b") as outfile:
+        outfile.seek(0, os.SEEK_END)
+        if outfile.tell() < PACK_HEADER.size:
+            outfile.write(bytes(PACK_HEADER.size - outfile.tell()))
+
+        data_size = 0
+        for name, vibes in charts:
+            entry, data = encode_chart(vibes)
+            entry['offset'] = outfile.tell()
+            entries[name] = entry
+            outfile.write(data)
+            data_size += len(data)
+
+        index_offset = write_index(outfile, entries)
+        file_size = outfile.tell()
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+        write_header(outfile, entries, index_offset)
+
+    profiler.count("bytes_written", data_size + file_size - index_offset + PACK_HEADER.size)
+
+    if file_size - get_pack_size(entries) > file_size * PACK_MAX_WASTE:
+        compact_pack(pack_path)
+
+
+def compact_pack(pack_path):
+    # Rewrites the pack with only the current data of every chart
+    temp_path = pack_path + ".tmp"
+
+    with ChartPack(pack_path) as pack, open(temp_path, "wb") as outfile:
+        outfile.write(bytes(PACK_HEADER.size))
+
+        entries = {}
+        for name, entry in pack.entries.items():
+            entries[name] = dict(entry, offset=outfile.tell())
+            outfile.write(pack.get_raw(name))
+
+        write_header(outfile, entries, write_index(outfile, entries))
+
+    os.replace(temp_path, pack_path)
+
+
+def import_json(pack_path, paths):
+    # Charts are named after their JSON file without the extension
+    charts = []
+    for path in paths:
+        charts.append((os.path.splitext(os.path.basename(path))[0], json.load(open(path, "r"))))
+
+    append_charts(pack_path, charts)
+    return len(charts)
+
+
+def export_json(pack_path, output_folder, patterns=None):
+    os.makedirs(output_folder, exist_ok=True)
+    count = 0
+
+    with ChartPack(pack_path) as pack:
+        for name in pack.names():
+            if patterns and not any([fnmatch.fnmatch(name, x) for x in patterns]):
+                continue
+
+            json.dump(pack.read_vibes(name), open(os.path.join(output_folder, name + ".json"), "w"), indent=4)
+            count += 1
+
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-p', '--pack', help='Chart pack written by ddr2vibes.py --pack', default="charts.vpk")
+    parser.add_argument('--import', help='Add chart JSON files, or every chart JSON file in these folders, to the pack', dest='import_paths', default=None, nargs='+')
+    parser.add_argument('--export', help='Write the charts in the pack to this folder as JSON', default=None)
+    parser.add_argument('-c', '--charts', help='Only export charts whose name matches one of these patterns', default=None, nargs='+')
+    parser.add_argument('--compact', help='Rewrite the pack without the space left by replaced charts', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+
+    try:
+        if args.import_paths:
+            paths = [x for path in args.import_paths for x in (sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path])]
+            print("Imported %d charts" % import_json(args.pack, paths))
+
+        if args.compact:
+            size = os.path.getsize(args.pack)
+            compact_pack(args.pack)
+            print("Compacted %d -> %d bytes" % (size, os.path.getsize(args.pack)))
+
+        if args.export:
+            print("Exported %d charts to %s" % (export_json(args.pack, args.export, args.charts), args.export))
+
+        if not args.import_paths and not args.compact and not args.export:
+            with ChartPack(args.pack) as pack:
+                print("%-40s %-20s %7s %6s" % ("Chart", "Title", "Events", "Beats"))
+
+                for name, entry in pack.entries.items():
+                    print("%-40s %-20s %7d %6s" % (name, entry['title'], entry['event_count'], sum([x['count'] for x in pack.read_chart(name)['beats']]) if entry['flags'] & PACK_HAS_BEATS else "-"))
+
+                print("%d charts, %d bytes (%.1fms)" % (len(pack.entries), os.path.getsize(args.pack), (time.perf_counter() - start_time) * 1000))
+
+    except (OSError, ChartPackError) as e:
+        print(e)
+        exit(1)
@@ -1,20 +1,539 @@
 import argparse
-import copy
+import array
+import bisect
+import concurrent.futures
+import glob
+import hashlib
 import json
+import logging
+import math
+import mmap
 import os
+import posixpath
+import struct
+import tarfile
+import time
+import zipfile
+
+from chart_pack import ChartPackError, append_charts
+from library_index import compute_chart_stats, update_index
+from profiling import profiler, merge_snapshots, trim_functions, save_report, print_snapshot
+
+
+CHART_TYPES = ["single-beginner", "single-basic", "single-standard", "single-heavy", "single-challenge"]
+INPUT_FORMATS = ["ssq", "csq", "cms"]
+
+ARCHIVE_FORMATS = [".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"]
+
+# Separates an archive's path from the member inside it, e.g. "mix.zip::song/all.ssq"
+ARCHIVE_SEPARATOR = "::"
+
+# How coalesce_events handles a panel that's pressed and released within the same group
+COALESCE_CONFLICTS = ["split", "last"]
+
+# Chart offsets per beat, a measure is 4096
+BEAT_OFFSET = 1024
+
+# Bytes a single event takes in the raw event_timestamps/event_notes arrays. The event format is only picked when the
+# headers are generated, so coalescing savings are given for the raw format, with -f delta an event is usually 1-2 bytes.
+RAW_EVENT_SIZE = 5
+
+# Bump whenever a change to the converter changes its output so old cache entries are ignored
+CONVERTER_VERSION = 3
+
+logger = logging.getLogger("ddr2vibes")
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ChartFormatError(ConversionError):
+    # The input is malformed or uses chunks/notes the readers don't know about
+    pass
+
+
+class UnsupportedNoteError(ConversionError, KeyError):
+    # The chart uses panels that can't be replayed as vibes (player 2 panels, shocks).
+    # Also a KeyError since that's what the converter has always raised for these.
+    pass
+
+
+class VerificationError(ConversionError):
+    pass
+
+CHUNK_TYPE_LOOKUP = {
+    0x01: 'tempo',
+    0x02: 'events',
+    0x03: 'notes',
+    0x04: 'lamps',
+    0x05: 'anim',
+}
+
+CHART_TYPE_LOOKUP = {
+    0x0114: "single-basic",
+    0x0214: "single-standard",
+    0x0314: "single-heavy",
+    0x0414: "single-beginner",
+    0x0614: "single-challenge",
+
+    0x0116: "solo-basic",
+    0x0216: "solo-standard",
+    0x0316: "solo-heavy",
+    0x0416: "solo-beginner",
+    0x0616: "solo-challenge",
+
+    0x0118: "double-basic",
+    0x0218: "double-standard",
+    0x0318: "double-heavy",
+    0x0418: "double-beginner",
+    0x0618: "double-challenge",
+
+    0x1024: "double-battle",
+
+    # fxxx range is just a hack and not an official chart range
+    0xf116: "solo3-basic",
+    0xf216: "solo3-standard",
+    0xf316: "solo3-heavy",
+    0xf416: "solo3-beginner",
+    0xf616: "solo3-challenge",
+}
+
+
+def build_note_lookup(panels):
+    # Precompute the list of panel names for every possible note byte
+    lookup = {}
+
+    for note_raw in range(0x100):
+        bits = [i for i in range(8) if (note_raw & (1 << i)) != 0]
+
+        if all(i in panels for i in bits):
+            lookup[note_raw] = [panels[i] for i in bits]
+
+    lookup[0xff] = ['shock']
+
+    return lookup
+
+
+NOTE_LOOKUP = build_note_lookup({
+    0x00: 'p1_l',
+    0x01: 'p1_d',
+    0x02: 'p1_u',
+    0x03: 'p1_r',
+    0x04: 'p2_l',
+    0x05: 'p2_d',
+    0x06: 'p2_u',
+    0x07: 'p2_r',
+})
+
+# CMS stores each player's arrows across two bytes, left/down in the first and up/right in the second
+CMS_FIRST_NOTE_LOOKUP = [((x & 0x10) != 0) << 1 | ((x & 0x01) != 0) for x in range(0x100)]
+CMS_SECOND_NOTE_LOOKUP = [((x & 0x10) != 0) << 3 | ((x & 0x01) != 0) << 2 for x in range(0x100)]
+
+# Set bit indexes of every note byte
+NOTE_PANEL_BITS = [[i for i in range(8) if (x & (1 << i)) != 0] for x in range(0x100)]
+
+SOLO_NOTE_LOOKUP = build_note_lookup({
+    0x00: 'solo_l',
+    0x01: 'solo_d',
+    0x02: 'solo_u',
+    0x03: 'solo_r',
+    0x04: 'solo_ul',
+    0x06: 'solo_ur',
+})
+
+
+def round_div(numerator, denominator):
+    # Integer division rounded to the nearest integer with ties to even, same as round() on the exact quotient
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+
+    quotient, remainder = divmod(numerator, denominator)
+
+    if remainder * 2 > denominator or (remainder * 2 == denominator and quotient & 1):
+        quotient += 1
+
+    return quotient
+
+
+class TempoMap:
+    def __init__(self, bpm_list, tick_rate=None):
+        self.segments = bpm_list
+        self.tick_rate = tick_rate
+
+        self.start_offsets = [x['start_offset'] for x in bpm_list]
+        self.end_offsets = [x['end_offset'] for x in bpm_list]
+        self.start_data = [x['start_data'] for x in bpm_list]
+        self.end_data = [x['end_data'] for x in bpm_list]
+
+        # Bisect only finds the same segment as a linear scan when the segments are back to back
+        self.offsets_contiguous = self.is_contiguous(self.start_offsets, self.end_offsets)
+        self.data_contiguous = self.is_contiguous(self.start_data, self.end_data)
+
+        self.exact_segments = None if tick_rate is None else [self.exact_segment(x, tick_rate) for x in bpm_list]
+
+
+    @staticmethod
+    def exact_segment(bpm_info, tick_rate):
+        # A segment maps offset to µs as (base + offset * scale) / divisor using only the raw tempo chunk integers:
+        # start_data / tick_rate seconds plus (offset - start_offset) / (end_offset - start_offset) of the segment's
+        # (end_data - start_data) / tick_rate seconds. Time stands still in zero length segments.
+        offset_delta = bpm_info['end_offset'] - bpm_info['start_offset']
+        data_delta = bpm_info['end_data'] - bpm_info['start_data']
+
+        if offset_delta == 0:
+            return (1000000 * bpm_info['start_data'], 0, tick_rate)
+
+        scale = 1000000 * data_delta
+        base = 1000000 * bpm_info['start_data'] * offset_delta - bpm_info['start_offset'] * scale
+        return (base, scale, tick_rate * offset_delta)
+
+
+    @staticmethod
+    def is_contiguous(starts, ends):
+        for i in range(1, len(starts)):
+            if starts[i] != ends[i-1] or starts[i] < starts[i-1]:
+                return False
+
+        return True
+
+
+    @staticmethod
+    def calculate_measure(value):
+        m = int(value / 4096)
+        n = (value - (m * 4096)) / 4096
+        return (m, n)
+
+
+    def find_segment(self, value, starts, ends, contiguous):
+        # Values that fall outside of every segment use the last segment, same as the original linear scan
+        if contiguous:
+            idx = bisect.bisect_right(starts, value) - 1
+
+            if idx >= 0 and value < ends[idx]:
+                return idx
+
+            return len(starts) - 1
+
+        for idx in range(len(starts)):
+            if value >= starts[idx] and value < ends[idx]:
+                return idx
+
+        return len(starts) - 1
+
+
+    def segment_timestamp(self, idx, value):
+        bpm_info = self.segments[idx]
+        timestamp = bpm_info['start_timestamp'] + (((value - bpm_info['start_offset']) / 1024) / bpm_info['bpm']) * 60
+        return timestamp * 1000
+
+
+    def segment_timestamp_us(self, idx, value):
+        base, scale, divisor = self.exact_segments[idx]
+        return round_div(base + value * scale, divisor)
+
+
+    def timestamp(self, value):
+        idx = self.find_segment(value, self.start_offsets, self.end_offsets, self.offsets_contiguous)
+        return self.segment_timestamp(idx, value)
+
+
+    def timestamp_us(self, value):
+        idx = self.find_segment(value, self.start_offsets, self.end_offsets, self.offsets_contiguous)
+        return self.segment_timestamp_us(idx, value)
+
+
+    def bpm(self, value):
+        idx = self.find_segment(value, self.start_offsets, self.end_offsets, self.offsets_contiguous)
+        return self.segments[idx]['bpm']
+
+
+    def offset(self, value):
+        idx = self.find_segment(value, self.start_data, self.end_data, self.data_contiguous)
+        bpm_info = self.segments[idx]
+        return bpm_info['start_offset'] + (bpm_info['end_offset'] - bpm_info['start_offset']) * ((value - bpm_info['start_data']) / (bpm_info['end_data'] - bpm_info['start_data']))
+
+
+    def lookup(self, value):
+        idx = self.find_segment(value, self.start_offsets, self.end_offsets, self.offsets_contiguous)
+        return (self.segment_timestamp(idx, value), self.segments[idx]['bpm'], self.calculate_measure(value))
+
+
+    def segment_indices(self, values):
+        # Walks the segments in a single merge pass when the offsets are sorted
+        if not self.offsets_contiguous or any(values[i] < values[i-1] for i in range(1, len(values))):
+            return [self.find_segment(value, self.start_offsets, self.end_offsets, self.offsets_contiguous) for value in values]
+
+        starts = self.start_offsets
+        ends = self.end_offsets
+        last_idx = len(starts) - 1
+
+        indices = []
+        idx = 0
+        for value in values:
+            while idx < last_idx and starts[idx + 1] <= value:
+                idx += 1
+
+            indices.append(idx if starts[idx] <= value < ends[idx] else last_idx)
+
+        return indices
+
+
+    def lookup_many(self, values):
+        # Resolve a whole offset table at once
+        return [(self.segment_timestamp(idx, value), self.segments[idx]['bpm'], self.calculate_measure(value)) for idx, value in zip(self.segment_indices(values), values)]
+
+
+    def lookup_columns(self, values):
+        # Same as lookup_many but returns (timestamps, bpms) arrays and leaves measures to be calculated on demand
+        indices = self.segment_indices(values)
+        timestamps = array.array('d', [self.segment_timestamp(idx, value) for idx, value in zip(indices, values)])
+        bpms = array.array('d', [self.segments[idx]['bpm'] for idx in indices])
+        return timestamps, bpms
+
+
+    def beat_schedule(self, start_us, end_us):
+        # Beats fall on every BEAT_OFFSET offsets, so within a segment they're evenly spaced. Each segment with beats between
+        # start_us and end_us becomes {start_us, period_num, period_den, count}: count beats period_num / period_den µs apart,
+        # the first at start_us (relative to the start_us argument and rounded). A segment that carries on from the previous
+        # one at the same period is merged into it. The last segment runs on until end_us like timestamps past the end do.
+        if self.exact_segments is None:
+            return None
+
+        schedule = []
+        last_idx = len(self.exact_segments) - 1
+
+        for idx, (base, scale, divisor) in enumerate(self.exact_segments):
+            start_offset = self.start_offsets[idx]
+            end_offset = self.end_offsets[idx]
+
+            # Stops and segments where time doesn't advance have no beats of their own
+            if scale <= 0 or end_offset <= start_offset:
+                continue
+
+            # Beat n is at (base + n * BEAT_OFFSET * scale) / divisor µs, it's kept when that rounds to a time within
+            # start_us and end_us the same way the note timestamps are rounded
+            step = BEAT_OFFSET * scale
+            first_beat = max(-(-start_offset // BEAT_OFFSET), -((2 * base - (2 * start_us - 1) * divisor) // (2 * step)))
+            last_beat = ((2 * end_us + 1) * divisor - 2 * base - 1) // (2 * step)
+
+            if idx != last_idx:
+                last_beat = min(last_beat, (end_offset - 1) // BEAT_OFFSET)
+
+            if last_beat < first_beat:
+                continue
+
+            # Beat times are kept as numerator / divisor µs so merging needs no division
+            first = base + first_beat * step - start_us * divisor
+            count = last_beat - first_beat + 1
+
+            if schedule:
+                last_first, last_step, last_divisor, last_count = schedule[-1]
+
+                if last_step * divisor == step * last_divisor and (last_first + last_count * last_step) * divisor == first * last_divisor:
+                    schedule[-1][3] += count
+                    continue
+
+            schedule.append([first, step, divisor, count])
+
+        output = []
+        for first, step, divisor, count in schedule:
+            common = math.gcd(step, divisor)
+
+            output.append({
+                'start_us': round_div(first, divisor),
+                'period_num': step // common,
+                'period_den': divisor // common,
+                'count': count,
+            })
+
+        return output
+
+
+    def lookup_timestamps_us(self, values):
+        # Exact µs for a whole offset table
+        exact_segments = [self.exact_segments[idx] for idx in self.segment_indices(values)]
+
+        try:
+            return array.array('q', [round_div(base + value * scale, divisor) for (base, scale, divisor), value in zip(exact_segments, values)])
+
+        except OverflowError as e:
+            raise ChartFormatError("Timestamp out of range: %s" % e) from e
+
+
+class EventColumns:
+    # Columnar storage for a decoded events or lamps chunk.
+    # timestamps and bpms are None when the chart has no tempo information.
+    __slots__ = ('offsets', 'timestamps', 'bpms', 'values')
+
+    def __init__(self, offsets, timestamps, bpms, values):
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.bpms = bpms
+        self.values = values
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def get_timestamp(self, idx):
+        return None if self.timestamps is None else self.timestamps[idx]
+
+
+    def get_bpm(self, idx):
+        return None if self.bpms is None else self.bpms[idx]
+
+
+    def to_dicts(self):
+        return [{
+            'offset': self.offsets[i],
+            'measure': TempoMap.calculate_measure(self.offsets[i]),
+            'timestamp': self.get_timestamp(i),
+            '_bpm': self.get_bpm(i),
+            'event': self.values[i],
+        } for i in range(len(self))]
+
+
+class NoteColumns:
+    # Columnar storage for a decoded notes chunk, sorted by offset.
+    # notes holds the raw note byte (0xff = shock) and flags holds FREEZE_END/FREEZE_START bits.
+    # Timestamps are resolved through tempo_map the first time they're used. timestamps_us are exact µs from the
+    # integer tempo math and are all the vibes conversion needs, the float ms timestamps and bpms are only for the JSON export.
+    # All of them are None when the chart has no tempo information.
+    __slots__ = ('chart_type', 'offsets', 'notes', 'flags', 'note_lookup', 'tempo_map', '_timestamps', '_bpms', '_timestamps_us')
+
+    FREEZE_END = 1
+    FREEZE_START = 2
+
+    def __init__(self, chart_type, offsets, notes, flags, note_lookup, tempo_map=None):
+        self.chart_type = chart_type
+        self.offsets = offsets
+        self.notes = notes
+        self.flags = flags
+        self.note_lookup = note_lookup
+        self.tempo_map = tempo_map
+        self._timestamps = None
+        self._bpms = None
+        self._timestamps_us = None
+
+
+    @property
+    def timestamps(self):
+        if self._timestamps is None and self.tempo_map is not None:
+            with profiler.stage("timestamps"):
+                self._timestamps, self._bpms = self.tempo_map.lookup_columns(self.offsets)
+
+        return self._timestamps
+
+
+    @property
+    def bpms(self):
+        return None if self.timestamps is None else self._bpms
+
+
+    @property
+    def timestamps_us(self):
+        if self._timestamps_us is None and self.tempo_map is not None:
+            with profiler.stage("exact_timestamps"):
+                self._timestamps_us = self.tempo_map.lookup_timestamps_us(self.offsets)
+
+        return self._timestamps_us
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def get_timestamp(self, idx):
+        return None if self.timestamps is None else self.timestamps[idx]
+
+
+    def get_bpm(self, idx):
+        return None if self.bpms is None else self.bpms[idx]
+
+
+    def get_timestamp_us(self, idx):
+        return None if self.timestamps_us is None else self.timestamps_us[idx]
+
+
+    def get_notes(self, idx):
+        return list(self.note_lookup[self.notes[idx]])
+
+
+    def get_extra(self, idx):
+        extra = []
+
+        if self.flags[idx] & self.FREEZE_END:
+            extra.append('freeze_end')
+
+        if self.flags[idx] & self.FREEZE_START:
+            extra.append('freeze_start')
+
+        return extra
+
+
+    def to_dicts(self):
+        events = []
+
+        for i in range(len(self)):
+            events.append({
+                'offset': self.offsets[i],
+                'measure': TempoMap.calculate_measure(self.offsets[i]),
+                'timestamp': self.get_timestamp(i),
+                '_bpm': self.get_bpm(i),
+                'notes': self.get_notes(i),
+            })
+
+            if self.flags[i]:
+                events[-1]['extra'] = self.get_extra(i)
+
+        return events
 
 
 class CsqReader:
+    # Only the chunk boundaries are indexed up front. Chunks are decoded the first time they're requested,
+    # so converting a single chart only touches the tempo chunk and that chart's notes chunk.
     def __init__(self, data):
         self.data = data
         self.bpm_list = None
-        self.chunks = self.parse()
+        self.tempo_map = None
 
+        with profiler.stage("split_chunks"):
+            self.chunk_index = self.index_chunks()
 
-    def export_json(self, filename=None):
+        profiler.count("chunks", len(self.chunk_index))
+        self.decoded_chunks = {}
+
+
+    @property
+    def chunks(self):
+        return self.get_chunks()
+
+
+    def get_chart_types(self):
+        return [x['chart_type'] for x in self.chunk_index if x['type'] == "notes"]
+
+
+    def get_chunks(self, chunk_types=None, chart_types=None):
+        chunks = []
+
+        for idx, chunk in enumerate(self.chunk_index):
+            if chunk_types is not None and chunk['type'] not in chunk_types:
+                continue
+
+            if chart_types is not None and chunk['type'] == "notes" and chunk['chart_type'] not in chart_types:
+                continue
+
+            chunks.append(self.decode_chunk(idx))
+
+        return chunks
+
+
+    def export_json(self, filename=None, chunk_types=None, chart_types=None):
         chunks = []
 
-        for chunk in self.chunks[::]:
+        for chunk in self.get_chunks(chunk_types, chart_types):
             sanitized_events = []
 
             if chunk['type'] == "tempo":
@@ -37,11 +556,13 @@ class CsqReader:
                 })
 
             elif chunk['type'] in ["events", "lamps"]:
-                for event in chunk['events']:
+                events = chunk['events']
+
+                for i in range(len(events)):
                     sanitized_events.append({
-                        '_meta_timestamp': event['timestamp'],
-                        'measure': event['measure'],
-                        'event': event['event'],
+                        '_meta_timestamp': events.get_timestamp(i),
+                        'measure': self.calculate_measure(events.offsets[i]),
+                        'event': events.values[i],
                     })
 
             elif chunk['type'] == "notes":
@@ -50,15 +571,18 @@ class CsqReader:
                     'events': [],
                 }
 
-                for event in chunk['events']['events']:
+                events = chunk['events']['events']
+
+                for i in range(len(events)):
                     sanitized_events['events'].append({
-                        '_meta_timestamp': event['timestamp'],
-                        'measure': event['measure'],
-                        'notes': event['notes'],
+                        '_meta_timestamp': events.get_timestamp(i),
+                        '_meta_timestamp_us': events.get_timestamp_us(i),
+                        'measure': self.calculate_measure(events.offsets[i]),
+                        'notes': events.get_notes(i),
                     })
 
-                    if 'extra' in event:
-                        sanitized_events['events'][-1]['extra'] = event['extra']
+                    if events.flags[i]:
+                        sanitized_events['events'][-1]['extra'] = events.get_extra(i)
 
             elif chunk['type'] == "anim":
                 for event in chunk['events']:
@@ -70,65 +594,138 @@ class CsqReader:
                         'clip_filename': event['clip_filename'],
                     })
 
-            chunk['events'] = sanitized_events
-
-            chunks.append(chunk)
+            # The decoded chunks are cached so build new dicts instead of sanitizing them in place
+            chunks.append({
+                'type': chunk['type'],
+                'events': sanitized_events,
+            })
 
         if filename:
-            import json
             json.dump(chunks, open(filename, "w"), indent=4, ensure_ascii=False)
 
         return chunks
 
 
     def calculate_measure(self, value):
-        m = int(value / 4096)
-        n = (value - (m * 4096)) / 4096
-        return (m, n)
+        return TempoMap.calculate_measure(value)
 
 
     def calculate_timestamp(self, value):
         if not self.bpm_list:
             return None
 
-        for bpm_info in self.bpm_list:
-            if value >= bpm_info['start_offset'] and value < bpm_info['end_offset']:
-                break
+        return self.tempo_map.timestamp(value)
 
-        timestamp = bpm_info['start_timestamp'] + (((value - bpm_info['start_offset']) / 1024) / bpm_info['bpm']) * 60
 
-        return timestamp * 1000
+    def calculate_offset(self, value):
+        if not self.bpm_list:
+            return None
 
+        return self.tempo_map.offset(value)
 
-    def calculate_offset(self, value):
+
+    def get_bpm(self, value):
         if not self.bpm_list:
             return None
 
-        for bpm_info in self.bpm_list:
-            if value >= bpm_info['start_data'] and value < bpm_info['end_data']:
-                break
+        return self.tempo_map.bpm(value)
+
 
-        offset = bpm_info['start_offset'] + (bpm_info['end_offset'] - bpm_info['start_offset']) * ((value - bpm_info['start_data']) / (bpm_info['end_data'] - bpm_info['start_data']))
+    def resolve_offsets(self, values):
+        if not self.bpm_list:
+            return [(None, None, self.calculate_measure(value)) for value in values]
 
-        return offset
+        return self.tempo_map.lookup_many(values)
 
 
-    def get_bpm(self, value):
+    def resolve_offset_columns(self, values):
         if not self.bpm_list:
-            return None
+            return None, None
+
+        return self.tempo_map.lookup_columns(values)
 
-        for bpm_info in self.bpm_list:
-            if value >= bpm_info['start_offset'] and value < bpm_info['end_offset']:
+    def index_chunks(self):
+        data = memoryview(self.data)
+
+        chunk_index = []
+
+        # Chunks are sliced out of a memoryview so splitting the file never copies the remaining data
+        cursor = 0
+        while cursor < len(data):
+            chunk_len, = struct.unpack_from("<I", data, cursor)
+
+            if len(data) - cursor - 4 <= 0 or chunk_len == 0:
                 break
 
-        return bpm_info['bpm']
+            chunk_type, = struct.unpack_from("<H", data, cursor + 4)
+            chunk_raw = data[cursor+6:cursor+chunk_len]
+            cursor += chunk_len
 
+            if chunk_type not in CHUNK_TYPE_LOOKUP:
+                raise ChartFormatError("Unknown chunk type: %04x" % chunk_type)
 
-    def parse(self):
-        data = self.data
+            chunk = {
+                'type': CHUNK_TYPE_LOOKUP[chunk_type],
+                '_raw': chunk_raw,
+            }
+
+            if chunk['type'] == "notes":
+                # The chart type is the first field of a notes chunk so charts can be filtered without decoding them
+                chart_type, = struct.unpack_from("<H", chunk_raw)
+                chunk['chart_type'] = CHART_TYPE_LOOKUP.get(chart_type, chart_type)
+
+            chunk_index.append(chunk)
+
+        if not [x for x in chunk_index if x['type'] == "tempo"]:
+            raise ChartFormatError("Couldn't find BPM chunk")
+
+        return chunk_index
+
+
+    def load_tempo(self):
+        if self.tempo_map is not None:
+            return
+
+        for idx, chunk in enumerate(self.chunk_index):
+            if chunk['type'] == "tempo":
+                bpm_chunk = self.decode_chunk(idx)
+                break
+
+        self.bpm_list = bpm_chunk['events']['events']
+
+        with profiler.stage("tempo_map"):
+            self.tempo_map = TempoMap(self.bpm_list, bpm_chunk['events']['tick_rate'])
+
+        profiler.count("bpm_segments", len(self.bpm_list))
 
-        chunks = []
 
+    def decode_chunk(self, idx):
+        if idx in self.decoded_chunks:
+            return self.decoded_chunks[idx]
+
+        chunk_type = self.chunk_index[idx]['type']
+
+        # Everything except the tempo chunk needs the tempo map to calculate timestamps
+        if chunk_type != "tempo":
+            self.load_tempo()
+
+        with profiler.stage("decode_" + chunk_type):
+            chunk = {
+                'type': chunk_type,
+                'events': self.parse_chunk(self.chunk_index[idx]),
+            }
+
+        profiler.count("decoded_chunks")
+
+        # if 'anim' in chunk['type']:
+        #     render_animation(chunk['events'], "output_anim", mp3_filename, bpm_chunk['events'])
+
+        self.decoded_chunks[idx] = chunk
+
+        return chunk
+
+
+    def parse_chunk(self, chunk):
         chunk_parsers = {
             'tempo': self.parse_tempo_chunk,
             'events': self.parse_events_chunk,
@@ -137,59 +734,38 @@ class CsqReader:
             # 'anim': self.parse_anim_chunk_raw,
         }
 
-        while data:
-            chunk_len = int.from_bytes(data[:4], 'little')
-
-            if len(data) - 4 <= 0:
-                break
-
-            chunk_type = int.from_bytes(data[4:6], 'little')
-            chunk_raw = data[6:chunk_len]
-            data = data[chunk_len:]
+        return chunk_parsers.get(chunk['type'], lambda x: [])(chunk['_raw'])
 
-            chunks.append({
-                'type': {
-                    0x01: 'tempo',
-                    0x02: 'events',
-                    0x03: 'notes',
-                    0x04: 'lamps',
-                    0x05: 'anim',
-                }[chunk_type],
-                '_raw': chunk_raw,
-            })
 
-        bpm_chunk = None
-        for chunk in chunks:
-            if chunk['type'] == "tempo":
-                chunk['events'] = chunk_parsers.get(chunk['type'], lambda x: [])(chunk['_raw'])
-                bpm_chunk = copy.deepcopy(chunk)
-                break
+    def parse(self):
+        return self.get_chunks()
 
-        if bpm_chunk is None:
-            print("Couldn't find BPM chunk")
-            exit(1)
 
-        self.bpm_list = bpm_chunk['events']['events']
+    def unpack_table(self, data, count, fmt, start=6):
+        # Decode a whole table of little endian values in one call instead of slicing each element
+        return list(struct.unpack_from("<%d%s" % (count, fmt), data, start))
 
-        for chunk in chunks:
-            chunk['events'] = chunk_parsers.get(chunk['type'], lambda x: [])(chunk['_raw'])
 
-            # if 'anim' in chunk['type']:
-            #     render_animation(chunk['events'], "output_anim", mp3_filename, bpm_chunk['events'])
+    def parse_tempo_chunk(self, data):
+        tick_rate, count, padding = struct.unpack_from("<HHH", data)
+        if padding != 0:
+            raise ChartFormatError("Unexpected tempo chunk padding: %04x" % padding)
 
-            del chunk['_raw']
+        time_offsets = self.unpack_table(data, count, "i")
+        time_data = self.unpack_table(data, count, "i", 6 + count * 4)
 
-        return chunks
+        return self.build_tempo(tick_rate, time_offsets, time_data)
 
 
-    def parse_tempo_chunk(self, data):
-        tick_rate = int.from_bytes(data[:2], 'little')
-        count = int.from_bytes(data[2:4], 'little')
-        assert(int.from_bytes(data[4:6], 'little') == 0)
+    def build_tempo(self, tick_rate, time_offsets, time_data):
+        count = len(time_offsets)
 
-        time_offsets = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count)]
-        time_data = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count, count * 2)]
+        if tick_rate == 0:
+            raise ChartFormatError("Tempo chunk has a tick rate of 0")
 
+        # Every segment is between two entries, with fewer there's nothing to time the notes with
+        if count < 2:
+            raise ChartFormatError("Tempo chunk has %d entries, at least 2 are needed" % count)
         sample_rate = 294 * tick_rate
 
         bpm_changes = []
@@ -198,6 +774,10 @@ class CsqReader:
             end_timestamp = time_data[i] / tick_rate
             time_delta = (end_timestamp - start_timestamp) * 1000
             offset_delta = (time_offsets[i] - time_offsets[i-1])
+
+            if time_delta == 0 and offset_delta != 0:
+                raise ChartFormatError("Tempo segment at offset %d has no length" % time_offsets[i-1])
+
             bpm = 60000 / (time_delta / (offset_delta / 1024)) if offset_delta != 0 else 0
 
             bpm_changes.append({
@@ -219,12 +799,18 @@ class CsqReader:
 
 
     def parse_events_chunk(self, data):
-        assert(int.from_bytes(data[:2], 'little') == 1)
-        count = int.from_bytes(data[2:4], 'little')
-        assert(int.from_bytes(data[4:6], 'little') == 0)
+        chunk_id, count, padding = struct.unpack_from("<HHH", data)
+        if chunk_id != 1 or padding != 0:
+            raise ChartFormatError("Unexpected events chunk header: %04x %04x" % (chunk_id, padding))
+
+        event_offsets = self.unpack_table(data, count, "i")
+        event_data = self.unpack_table(data, count, "H", 6 + count * 4)
+
+        return self.build_events(event_offsets, event_data)
 
-        event_offsets = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count)]
-        event_data = [int.from_bytes(data[6+(count*4)+x*2:6+(count*4)+(x+1)*2], 'little') for x in range(count)]
+
+    def build_events(self, event_offsets, event_data):
+        count = len(event_offsets)
 
         event_lookup = {
             0x0202: "start", # Display "Ready?"
@@ -232,17 +818,9 @@ class CsqReader:
             0x0402: "clear", # End of stage/move to result screen
         }
 
-        events = []
-        for i in range(count):
-            events.append({
-                'offset': event_offsets[i],
-                'measure': self.calculate_measure(event_offsets[i]),
-                'timestamp': self.calculate_timestamp(event_offsets[i]),
-                '_bpm': self.get_bpm(event_offsets[i]),
-                'event': event_lookup.get(event_data[i], event_data[i])
-            })
+        timestamps, bpms = self.resolve_offset_columns(event_offsets)
 
-        return events
+        return EventColumns(array.array('i', event_offsets), timestamps, bpms, [event_lookup.get(x, x) for x in event_data])
 
 
     def parse_note_events_chunk(self, data):
@@ -252,148 +830,102 @@ class CsqReader:
 
             return val + (boundary - (val % boundary))
 
-        chart_type = int.from_bytes(data[:2], 'little')
-        count = int.from_bytes(data[2:4], 'little')
-        assert(int.from_bytes(data[4:6], 'little') == 0)
-
-        chart_type = {
-            0x0114: "single-basic",
-            0x0214: "single-standard",
-            0x0314: "single-heavy",
-            0x0414: "single-beginner",
-            0x0614: "single-challenge",
-
-            0x0116: "solo-basic",
-            0x0216: "solo-standard",
-            0x0316: "solo-heavy",
-            0x0416: "solo-beginner",
-            0x0616: "solo-challenge",
-
-            0x0118: "double-basic",
-            0x0218: "double-standard",
-            0x0318: "double-heavy",
-            0x0418: "double-beginner",
-            0x0618: "double-challenge",
-
-            0x1024: "double-battle",
-
-            # fxxx range is just a hack and not an official chart range
-            0xf116: "solo3-basic",
-            0xf216: "solo3-standard",
-            0xf316: "solo3-heavy",
-            0xf416: "solo3-beginner",
-            0xf616: "solo3-challenge",
-        }.get(chart_type, chart_type)
-
-        event_offsets = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count)]
+        chart_type, count, padding = struct.unpack_from("<HHH", data)
+        if padding != 0:
+            raise ChartFormatError("Unexpected notes chunk padding: %04x" % padding)
+
+        event_offsets = self.unpack_table(data, count, "i")
         event_data = data[6+(count*4):clamp(6+(count*4)+count, 2)]
         event_extra_data = data[clamp(6+(count*4)+count, 2):]
 
-        events = []
-        for offset in event_offsets:
-            event = {
-                'offset': offset,
-                'measure': self.calculate_measure(offset),
-                'timestamp': self.calculate_timestamp(offset),
-                '_bpm': self.get_bpm(offset),
-            }
+        return self.build_note_events(chart_type, event_offsets, event_data, event_extra_data)
 
-            note_raw = event_data[0]
-            event_data = event_data[1:]
+
+    def build_note_events(self, chart_type, event_offsets, event_data, event_extra_data):
+        # event_data has one note byte per offset, a 0 note byte takes the note and extra flags from the next pair in event_extra_data
+        count = len(event_offsets)
+        chart_type = CHART_TYPE_LOOKUP.get(chart_type, chart_type)
+
+        is_solo = isinstance(chart_type, str) and "solo" in chart_type
+        note_lookup = SOLO_NOTE_LOOKUP if is_solo else NOTE_LOOKUP
+
+        if len(event_data) < count:
+            raise ChartFormatError("Notes chunk has %d note bytes for %d events" % (len(event_data), count))
+
+        notes = bytearray(count)
+        flags = bytearray(count)
+        extra_cursor = 0
+        for idx in range(count):
+            note_raw = event_data[idx]
 
             if note_raw == 0:
-                note_raw = event_extra_data[0]
-                extra_type = event_extra_data[1]
-                event_extra_data = event_extra_data[2:]
+                if extra_cursor + 2 > len(event_extra_data):
+                    raise ChartFormatError("Notes chunk extra data ends before event %d" % idx)
+
+                note_raw = event_extra_data[extra_cursor]
+                extra_type = event_extra_data[extra_cursor+1]
+                extra_cursor += 2
 
                 if (extra_type & 1) != 0:
-                    event['extra'] = ['freeze_end']
+                    flags[idx] = NoteColumns.FREEZE_END
 
                 if (extra_type & ~1) != 0:
-                    print("Unknown extra event: %02x" % extra_type)
-                    exit(1)
+                    raise ChartFormatError("Unknown extra event: %02x" % extra_type)
 
-            notes = []
-            if note_raw == 0xff:
-                notes.append('shock')
+            if note_raw not in note_lookup:
+                raise ChartFormatError("Unknown note for %s: %02x" % (chart_type, note_raw))
 
-            else:
-                for i in range(8):
-                    if (note_raw & (1 << i)) != 0:
-                        if "solo" in chart_type:
-                            n = {
-                                0x00: 'solo_l',
-                                0x01: 'solo_d',
-                                0x02: 'solo_u',
-                                0x03: 'solo_r',
-                                0x04: 'solo_ul',
-                                0x06: 'solo_ur',
-                            }[i]
-
-                        else:
-                            n = {
-                                0x00: 'p1_l',
-                                0x01: 'p1_d',
-                                0x02: 'p1_u',
-                                0x03: 'p1_r',
-                                0x04: 'p2_l',
-                                0x05: 'p2_d',
-                                0x06: 'p2_u',
-                                0x07: 'p2_r',
-                            }[i]
-
-                        notes.append(n)
-
-            event['notes'] = notes
+            notes[idx] = note_raw
 
-            events.append(event)
+        offsets = array.array('i', event_offsets)
+
+        if any(offsets[i] < offsets[i-1] for i in range(1, count)):
+            order = sorted(range(count), key=lambda x:offsets[x])
+            offsets = array.array('i', [offsets[i] for i in order])
+            notes = bytearray([notes[i] for i in order])
+            flags = bytearray([flags[i] for i in order])
 
         # Add freeze start commands
-        events = sorted(events, key=lambda x:x['offset'])
-        for i in range(len(events)):
-            if "freeze_end" in events[i].get('extra', []):
-                for x in range(i-1, -1, -1):
-                    if events[i]['notes'] == events[x]['notes']:
-                        events[x]['extra'] = events[x].get('extra', []) + ['freeze_start']
-                        break
+        # Each freeze end pairs with the closest earlier event that has the same notes
+        with profiler.stage("freeze_pairing"):
+            last_seen = {}
+            for i in range(count):
+                if (flags[i] & NoteColumns.FREEZE_END) and notes[i] in last_seen:
+                    flags[last_seen[notes[i]]] |= NoteColumns.FREEZE_START
+
+                last_seen[notes[i]] = i
+
+        profiler.count("note_events", count)
 
         return {
             'chart_type': chart_type,
-            'events': events,
+            'events': NoteColumns(chart_type, offsets, notes, flags, note_lookup, self.tempo_map if self.bpm_list else None),
         }
 
 
     def parse_lamp_events_chunk(self, data):
-        assert(int.from_bytes(data[:2], 'little') == 1)
-        count = int.from_bytes(data[2:4], 'little')
-        assert(int.from_bytes(data[4:6], 'little') == 0)
+        chunk_id, count, padding = struct.unpack_from("<HHH", data)
+        if chunk_id != 1 or padding != 0:
+            raise ChartFormatError("Unexpected lamp chunk header: %04x %04x" % (chunk_id, padding))
 
-        event_offsets = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count)]
-        event_data = [data[6+(count*4)+x] for x in range(count)]
+        event_offsets = self.unpack_table(data, count, "i")
+        event_data = self.unpack_table(data, count, "B", 6 + count * 4)
 
-        events = []
-        for i in range(count):
-            events.append({
-                'offset': event_offsets[i],
-                'measure': self.calculate_measure(event_offsets[i]),
-                'timestamp': self.calculate_timestamp(event_offsets[i]),
-                '_bpm': self.get_bpm(event_offsets[i]),
-                'event': event_data[i],
-            })
+        timestamps, bpms = self.resolve_offset_columns(event_offsets)
 
-        return events
+        return EventColumns(array.array('i', event_offsets), timestamps, bpms, event_data)
 
 
     def parse_anim_chunk_raw(self, data):
-        assert(int.from_bytes(data[:2], 'little') == 0) # What is this used for?
-        count = int.from_bytes(data[2:4], 'little')
-        assert(int.from_bytes(data[4:6], 'little') == 0)
+        chunk_id, count, padding = struct.unpack_from("<HHH", data)
+        if chunk_id != 0 or padding != 0: # What is chunk_id used for?
+            raise ChartFormatError("Unexpected anim chunk header: %04x %04x" % (chunk_id, padding))
 
-        event_offsets = [int.from_bytes(data[6+x*4:6+(x+1)*4], 'little', signed=True) for x in range(count)]
+        event_offsets = self.unpack_table(data, count, "i")
         event_data = [data[6+(count*4)+x*4:6+(count*4)+(x+1)*4] for x in range(count)]
 
-        filename_chunk_count = int.from_bytes(data[6+(count*8):6+(count*8)+4], 'little')
-        filename_chunks = [int.from_bytes(data[6+(count*8)+4+x*4:6+(count*8)+4+(x+1)*4], 'little') for x in range(filename_chunk_count)]
+        filename_chunk_count, = struct.unpack_from("<I", data, 6 + count * 8)
+        filename_chunks = self.unpack_table(data, filename_chunk_count, "I", 6 + count * 8 + 4)
 
         clip_filenames = []
 
@@ -410,6 +942,8 @@ class CsqReader:
 
             clip_filenames.append(output_string)
 
+        resolved = self.resolve_offsets(event_offsets)
+
         events = []
         last_direction = 1
         for i in range(count):
@@ -417,7 +951,7 @@ class CsqReader:
             cmd_upper = (cmd >> 4) & 0x0f
 
             clip_idx = event_data[i][1]
-            param = int.from_bytes(event_data[i][2:4], 'little')
+            param, = struct.unpack_from("<H", event_data[i], 2)
 
             common_lookup = {
                 0x14: "end",
@@ -434,11 +968,13 @@ class CsqReader:
 
             clip_filename = common_lookup[clip_idx] if clip_idx in common_lookup else clip_filenames[clip_idx]
 
+            timestamp, bpm, measure = resolved[i]
+
             event = {
                 'offset': event_offsets[i],
-                'measure': self.calculate_measure(event_offsets[i]),
-                'timestamp': self.calculate_timestamp(event_offsets[i]),
-                '_bpm': self.get_bpm(event_offsets[i]),
+                'measure': measure,
+                'timestamp': timestamp,
+                '_bpm': bpm,
                 'cmd_raw': cmd,
                 'param_raw': param,
                 'clip_filename': clip_filename
@@ -453,19 +989,149 @@ class CsqReader:
         return []
 
 
-class CmsReader:
-    def __init__(self, data):
-        self.data = self.convert(data)
+class CmsReader(CsqReader):
+    # CMS charts are decoded straight into the same chunk model CsqReader uses.
+    # The result is identical to converting the CMS to a SSQ with convert() and reading that with CsqReader,
+    # but the SSQ is only built when it's explicitly exported with export_ssq().
+    def index_chunks(self):
+        data = memoryview(self.data)
+
+        chunks = []
+        cursor = 0
+        while cursor < len(data):
+            chunk_size, = struct.unpack_from("<I", data, cursor)
+
+            if chunk_size == 0:
+                chunks.append(None)
+                cursor += 4
+
+            else:
+                chunks.append(data[cursor+4:cursor+chunk_size])
+                cursor += chunk_size
+
+        is_solo_cms = False
+        for idx, chunk in enumerate(chunks):
+            if not chunk:
+                continue
+
+            if idx > 0:
+                if struct.unpack_from("<I", chunk, 0x08)[0] != 0xffffffff:
+                    raise ChartFormatError("Didn't find expected header for chart")
+
+                chart_type = chunk[0] # 0 = single, 1 = solo??, 2 = double
+                is_solo = chart_type == 1 # ??
+
+                if is_solo:
+                    is_solo_cms = True
+                    break
+
+        tempo_chunk = None
+        note_chunks = []
+        end_timestamp = None
+        for idx, chunk in enumerate(chunks):
+            if not chunk:
+                continue
+
+            if idx == 0:
+                # Tempo change chunk, (offset, sample) pairs
+                count = len(chunk) // 8
+                points = list(struct.unpack_from("<%di" % (count * 2), chunk))
+
+                tempo_chunk = {
+                    'type': "tempo",
+                    'tick_rate': 0x4b,
+                    'time_offsets': points[0::2],
+                    'time_data': points[1::2],
+                }
+
+                continue
+
+            if struct.unpack_from("<I", chunk, 0x08)[0] != 0xffffffff:
+                raise ChartFormatError("Didn't find expected header for chart")
+
+            chart_type = chunk[0] # 0 = single, 1 = solo??, 2 = double
+            diff = chunk[1]
 
+            event_offsets = []
+            event_data = bytearray()
+            for offset, b0, b1, b2, b3 in struct.iter_unpack("<iBBBB", chunk[0x0c:0x0c + ((len(chunk) - 0x0c) // 8) * 8]):
+                if b0 == b1 == b2 == b3 == 0xff:
+                    end_timestamp = offset
+                    break
+
+                event_offsets.append(offset)
+                event_data.append(CMS_FIRST_NOTE_LOOKUP[b0] | CMS_SECOND_NOTE_LOOKUP[b1] | ((CMS_FIRST_NOTE_LOOKUP[b2] | CMS_SECOND_NOTE_LOOKUP[b3]) << 4))
+
+            if is_solo_cms:
+                if chart_type == 0:
+                    chart_idx = 0x16 # 6 panel
+
+                elif chart_type == 1:
+                    chart_idx = 0x14 # 4 panel
 
-    def export_json(self, filename=None):
-        # This is code from another tool I had sitting around.
-        # I took the lazy way out and just convert it to a SSQ and then using CsqReader
-        # instead of writing another chart reader.
-        return CsqReader(self.data).export_json(filename)
+                elif chart_type == 2:
+                    chart_idx = 0x16 # 3 panel
+                    diff += 0xf0 # This is a hack for 3 panel modes to be handled as edit charts
+
+            else:
+                chart_idx = 0x14 + (chart_type * 2)
+
+            # A converted SSQ notes chunk is padded to 4 bytes and CsqReader reads that padding as extra data
+            count = len(event_offsets)
+            chunk_len = 8 + count * 5
+            chunk_len += (4 - chunk_len % 4) % 4
+            data_end = 6 + count * 5 + (6 + count * 5) % 2
+
+            note_chunks.append({
+                'type': "notes",
+                'chart_type': CHART_TYPE_LOOKUP.get(chart_idx | ((diff + 1) << 8), chart_idx | ((diff + 1) << 8)),
+                'chart_type_raw': chart_idx | ((diff + 1) << 8),
+                'event_offsets': event_offsets,
+                'event_data': bytes(event_data),
+                'event_extra_data': bytes(chunk_len - 2 - data_end),
+            })
+
+        if tempo_chunk is None:
+            raise ChartFormatError("Couldn't find BPM chunk")
+
+        if end_timestamp is None:
+            raise ChartFormatError("Couldn't find end of chart marker")
+
+        # Chart event timing chunk
+        events_chunk = {
+            'type': "events",
+            'event_offsets': [-4096, -4096, 0, end_timestamp - 4096, end_timestamp],
+            'event_data': [0x0401, 0x0102, 0x0202, 0x0302, 0x0402],
+        }
+
+        return [tempo_chunk, events_chunk] + note_chunks
+
+
+    def parse_chunk(self, chunk):
+        if chunk['type'] == "tempo":
+            return self.build_tempo(chunk['tick_rate'], chunk['time_offsets'], chunk['time_data'])
+
+        elif chunk['type'] == "events":
+            return self.build_events(chunk['event_offsets'], chunk['event_data'])
+
+        elif chunk['type'] == "notes":
+            return self.build_note_events(chunk['chart_type_raw'], chunk['event_offsets'], chunk['event_data'], chunk['event_extra_data'])
+
+        return []
+
+
+    def export_ssq(self, filename=None):
+        data = self.convert(self.data)
+
+        if filename:
+            open(filename, "wb").write(data)
+
+        return data
 
 
     def convert(self, chart):
+        # This is code from another tool I had sitting around that converts a CMS to a SSQ
+        chart = bytearray(chart)
         chunks = []
         while len(chart) > 0:
             chunk_size = int.from_bytes(chart[:4], 'little')
@@ -485,8 +1151,7 @@ class CmsReader:
 
             if idx > 0:
                 if int.from_bytes(chunk[0x08:0x0c], 'little') != 0xffffffff:
-                    print("Didn't find expected header for chart")
-                    exit(1)
+                    raise ChartFormatError("Didn't find expected header for chart")
 
                 chart_type = chunk[0] # 0 = single, 1 = solo??, 2 = double
                 is_solo = chart_type == 1 # ??
@@ -496,6 +1161,7 @@ class CmsReader:
                     break
 
         new_chunks = []
+        end_timestamp = None
         for idx, chunk in enumerate(chunks):
             if not chunk:
                 continue
@@ -529,15 +1195,13 @@ class CmsReader:
 
             else:
                 if int.from_bytes(chunk[0x08:0x0c], 'little') != 0xffffffff:
-                    print("Didn't find expected header for chart")
-                    exit(1)
+                    raise ChartFormatError("Didn't find expected header for chart")
 
                 chart_type = chunk[0] # 0 = single, 1 = solo??, 2 = double
                 diff = chunk[1]
 
                 events = [(int.from_bytes(chunk[0x0c+i:0x0c+i+4], 'little'), chunk[0x0c+i+4:0x0c+i+8]) for i in range(0, len(chunk) - 0x0c, 8)]
                 event_chunks = []
-                end_timestamp = None
 
                 for event in events:
                     if int.from_bytes(event[1], 'little') == 0xffffffff:
@@ -594,6 +1258,9 @@ class CmsReader:
 
             new_chunks.append(chunk)
 
+        if end_timestamp is None:
+            raise ChartFormatError("Couldn't find end of chart marker")
+
         # Generate chart event timing chunk
         chunk = bytearray()
         chunk += int.to_bytes(2, 2, 'little')
@@ -649,8 +1316,146 @@ class CmsReader:
         return output
 
 
+class ConversionCache:
+    # Converted events only depend on the chart data, so entries are keyed by the input's content hash
+    # and the same SSQ copied into several mix folders shares one entry. The title is the only part of
+    # the output that comes from package.json and it's rebuilt from the current package.json on every hit.
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+
+    @staticmethod
+    def hash_file(input_path):
+        if split_archive_path(input_path)[1] is not None:
+            return hashlib.sha256(read_input(input_path)).hexdigest()
+
+        h = hashlib.sha256()
+
+        with open(input_path, "rb") as infile:
+            for block in iter(lambda: infile.read(1024 * 1024), b""):
+                h.update(block)
+
+        return h.hexdigest()
+
+
+    def get_entry_path(self, content_hash, target_chart):
+        key = hashlib.sha256(("%s:%s:%d" % (content_hash, target_chart, CONVERTER_VERSION)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key[:2], key + ".json")
+
+
+    def get(self, content_hash, target_chart):
+        # Returns (found, vibes) where vibes has the events and beats but no title.
+        # vibes is None when the input is known to not contain the chart.
+        entry_path = self.get_entry_path(content_hash, target_chart)
+
+        try:
+            raw = open(entry_path, "rb").read()
+            entry = json.loads(raw)
+
+        except (OSError, ValueError):
+            self.misses += 1
+            profiler.count("cache_misses")
+            return False, None
+
+        profiler.count("cache_hits")
+        profiler.count("bytes_read", len(raw))
+
+        # Used as the LRU timestamp for eviction
+        os.utime(entry_path)
+
+        self.hits += 1
+
+        if entry['events'] is None:
+            return True, None
+
+        vibes = {'events': entry['events']}
+        if entry.get('beats') is not None:
+            vibes['beats'] = entry['beats']
+
+        return True, vibes
+
+
+    def put(self, content_hash, target_chart, vibes):
+        entry_path = self.get_entry_path(content_hash, target_chart)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        temp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(temp_path, "w") as outfile:
+            json.dump({
+                'content_hash': content_hash,
+                'chart': target_chart,
+                'version': CONVERTER_VERSION,
+                'events': None if vibes is None else vibes['events'],
+                'beats': None if vibes is None else vibes.get('beats'),
+            }, outfile)
+            profiler.count("bytes_written", outfile.tell())
+
+        os.replace(temp_path, entry_path)
+
+
+    def get_entries(self):
+        entries = []
+
+        for path in glob.glob(os.path.join(self.path, "*", "*.json")):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+
+    def evict(self):
+        entries = sorted(self.get_entries())
+        total_size = sum([x[1] for x in entries])
+
+        evicted_count = 0
+        evicted_size = 0
+
+        if self.max_size is not None:
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+
+                os.remove(path)
+                total_size -= size
+                evicted_count += 1
+                evicted_size += size
+
+        return evicted_count, evicted_size
+
+
+    def print_stats(self, hits=None, misses=None, evicted_count=0, evicted_size=0):
+        hits = self.hits if hits is None else hits
+        misses = self.misses if misses is None else misses
+        entries = self.get_entries()
+
+        logger.info("Cache: %d hits, %d misses (%.1f%% hit rate)", hits, misses, hits / (hits + misses) * 100 if hits + misses > 0 else 0)
+        logger.info("Cache size: %d entries, %.2f MB (%d entries/%.2f MB evicted)", len(entries), sum([x[1] for x in entries]) / (1024 * 1024), evicted_count, evicted_size / (1024 * 1024))
+
+
+def get_chart_title(package_info, target_chart):
+    title = package_info.get('title', "Untitled")
+    diff = {
+        "single-beginner": "BEG",
+        "single-basic": "BSC",
+        "single-standard": "STD",
+        "single-heavy": "HVY",
+        "single-challenge": "CHA",
+    }[target_chart]
+
+    title = title[:20 - 4]
+    title += " " + diff
+
+    return title
+
+
 def convert_json_to_vibes(data, target_chart, package_info):
     output_events = {}
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     for x in data:
         if x['type'] != "notes":
@@ -675,8 +1480,15 @@ def convert_json_to_vibes(data, target_chart, package_info):
 
         last_k = 0
         for event in sorted(x['events']['events'], key=lambda x:x['_meta_timestamp']):
-            print(event)
-            k = round(event['_meta_timestamp'] * 1000)
+            if debug:
+                logger.debug("%s", event)
+
+            unsupported_notes = [x for x in event['notes'] if x not in key_states]
+            if unsupported_notes:
+                raise UnsupportedNoteError(unsupported_notes[0])
+
+            # JSON exported before the exact tempo engine only has the float ms timestamps
+            k = event['_meta_timestamp_us'] if event.get('_meta_timestamp_us') is not None else round(event['_meta_timestamp'] * 1000)
             if k not in output_events:
                 output_events[k] = []
             val = 0 if "freeze_end" in event.get('extra', []) else 1
@@ -693,7 +1505,9 @@ def convert_json_to_vibes(data, target_chart, package_info):
                             output_events[k2] = []
 
                         output_events[k2] += [{'name': x, 'value': 0}]
-                        print(k2)
+
+                        if debug:
+                            logger.debug("%d", k2)
 
             for x in event['notes']:
                 if "freeze_start" in event.get('extra', []):
@@ -707,17 +1521,7 @@ def convert_json_to_vibes(data, target_chart, package_info):
 
             last_k = k
 
-    title = package_info.get('title', "Untitled")
-    diff = {
-        "single-beginner": "BEG",
-        "single-basic": "BSC",
-        "single-standard": "STD",
-        "single-heavy": "HVY",
-        "single-challenge": "CHA",
-    }[target_chart]
-
-    title = title[:20 - 4]
-    title += " " + diff
+    title = get_chart_title(package_info, target_chart)
 
     event_count = 0
     keys = sorted(output_events.keys())
@@ -746,38 +1550,899 @@ def convert_json_to_vibes(data, target_chart, package_info):
 
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def convert_columns_to_vibes(note_columns, target_chart, package_info):
+    # Fast path equivalent of convert_json_to_vibes that works directly on the NoteColumns of parsed charts.
+    # Note bytes already use the same bit order as note_bits (p1_l, p1_d, p1_u, p1_r), so each event just adds
+    # its note byte to the pressed panel mask and, unless it's a freeze end, to the panel value bits for its timestamp.
+    value_bits = {}
+    mask_bits = {}
 
-    parser.add_argument('-i', '--input', help='Input folder', default=None, required=True)
-    parser.add_argument('-c', '--chart', help='Chart to export', default=None, required=True, choices=["single-beginner", "single-basic", "single-standard", "single-heavy", "single-challenge"])
+    for columns in note_columns:
+        if columns.chart_type != target_chart:
+            continue
 
-    args = parser.parse_args()
+        count = len(columns)
+        timestamps = columns.timestamps_us
+        notes = columns.notes
+        flags = columns.flags
+
+        order = range(count)
+        if any(timestamps[i] < timestamps[i-1] for i in range(1, count)):
+            order = sorted(range(count), key=lambda x:timestamps[x])
+
+        key_states = [0, 0, 0, 0]
+        key_state_timestamps = [0, 0, 0, 0]
+
+        for i in order:
+            note = notes[i]
+
+            if note & 0xf0:
+                # Only player 1's panels can be converted, fail the same way convert_json_to_vibes does
+                raise UnsupportedNoteError([x for x in columns.get_notes(i) if x not in ["p1_l", "p1_d", "p1_u", "p1_r"]][0])
+
+            k = timestamps[i]
+            freeze_end = (flags[i] & NoteColumns.FREEZE_END) != 0
+            freeze_start = (flags[i] & NoteColumns.FREEZE_START) != 0
+
+            mask_bits[k] = mask_bits.get(k, 0) + note
+            value_bits[k] = value_bits.get(k, 0) + (0 if freeze_end else note)
+
+            panels = NOTE_PANEL_BITS[note]
+
+            if not freeze_end:
+                for bit in panels:
+                    if key_states[bit] != 0:
+                        # Release the previous press of this panel before pressing it again
+                        k2 = key_state_timestamps[bit] + (k - key_state_timestamps[bit]) // 2
+                        k2_2 = key_state_timestamps[bit] + 75000
+                        k2 = k2_2 if k2_2 < k2 else k2
+
+                        mask_bits[k2] = mask_bits.get(k2, 0) + (1 << bit)
+                        value_bits[k2] = value_bits.get(k2, 0)
+
+            for bit in panels:
+                if freeze_start:
+                    key_states[bit] = 2
+                elif freeze_end:
+                    key_states[bit] = 0
+                elif key_states[bit] == 0:
+                    key_states[bit] = 1
+
+                key_state_timestamps[bit] = k
+
+    keys = sorted(mask_bits.keys())
+    timestamps = [k - keys[0] for k in keys]
+    note_bits = [value_bits[k] | (mask_bits[k] << 4) for k in keys]
+
+    output = {
+        'title': get_chart_title(package_info, target_chart),
+        'events': [{'timestamp': timestamp, 'note_bits': bits} for timestamp, bits in zip(timestamps, note_bits)],
+    }
+
+    return output, len(keys)
+
+
+def build_chart_beats(reader, target_chart, vibes):
+    # Beat schedule from the chart's first to its last event, with times relative to the first event like the vibes events
+    note_columns = [x['events']['events'] for x in reader.get_chunks(["notes"], [target_chart])]
+    timestamps_us = [x.timestamps_us for x in note_columns if x.timestamps_us]
+
+    if not timestamps_us or not vibes['events']:
+        return None
+
+    start_us = min([min(x) for x in timestamps_us])
+    return reader.tempo_map.beat_schedule(start_us, start_us + vibes['events'][-1]['timestamp'])
+
+
+def add_chart_beats(reader, outputs):
+    with profiler.stage("beats"):
+        for target_chart, vibes in outputs.items():
+            if vibes is None:
+                continue
+
+            beats = build_chart_beats(reader, target_chart, vibes)
+
+            if beats is not None:
+                vibes['beats'] = beats
+                profiler.count("beat_segments", len(beats))
+
+    return outputs
+
+
+def coalesce_events(events, tolerance, conflicts="split"):
+    # Merges every event at most tolerance µs after the first event of a group into that first event.
+    # Panels are applied in order so a later event's state wins for the panels it touches. When a later event
+    # would flip a panel the group already sets, "split" starts a new group there instead so no press or release
+    # is ever lost, and "last" merges it anyway and keeps the later state.
+    output = []
+    group = None
+
+    for event in events:
+        note_bits = event['note_bits']
+        mask = note_bits >> 4
+
+        if group is not None and event['timestamp'] - group['timestamp'] <= tolerance:
+            group_mask = group['note_bits'] >> 4
+            conflict = (note_bits ^ group['note_bits']) & mask & group_mask & 0x0f
+
+            if not conflict or conflicts == "last":
+                values = (group['note_bits'] & ~mask & 0x0f) | (note_bits & mask)
+                group['note_bits'] = values | ((group_mask | mask) << 4)
+                continue
+
+        group = {
+            'timestamp': event['timestamp'],
+            'note_bits': note_bits,
+        }
+        output.append(group)
+
+    return output
+
+
+def coalesce_vibes(vibes, tolerance, conflicts="split"):
+    if vibes is None or tolerance <= 0:
+        return vibes
+
+    return dict(vibes, events=coalesce_events(vibes['events'], tolerance, conflicts))
+
+
+class ArchiveReader:
+    # Reads members of a zip or tar archive without extracting it.
+    # Members stored without compression (zip) or in an uncompressed tar are returned as memoryviews of a mmap
+    # of the archive, compressed members are decompressed into memory.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) > 0 else b""
+        self.zip = None
+        self.tar = None
+
+        if zipfile.is_zipfile(self.file):
+            self.zip = zipfile.ZipFile(self.file)
+            self.members = {x.filename: x for x in self.zip.infolist() if not x.is_dir()}
+
+        else:
+            try:
+                self.file.seek(0)
+                self.tar = tarfile.open(fileobj=self.file, mode="r:")
+                self.compressed = False
+
+            except tarfile.ReadError:
+                self.file.seek(0)
+
+                try:
+                    self.tar = tarfile.open(fileobj=self.file, mode="r:*")
+
+                except tarfile.ReadError:
+                    raise ConversionError("Not a zip or tar archive: %s" % path)
+
+                self.compressed = True
+
+            # Archives made with "tar -C folder ." prefix every name with "./"
+            self.members = {posixpath.normpath(x.name): x for x in self.tar.getmembers() if x.isfile()}
+
+
+    def names(self):
+        # Members in archive order, which is also the cheapest order to read a compressed tar in
+        return list(self.members.keys())
+
+
+    def read(self, name):
+        if name not in self.members:
+            raise ConversionError("%s not found in %s" % (name, self.path))
+
+        member = self.members[name]
+
+        if self.zip is not None:
+            if member.compress_type != zipfile.ZIP_STORED or member.flag_bits & 1:
+                return self.zip.read(member)
+
+            # The data follows the member's local header, whose name and extra field lengths can differ from the central directory
+            name_length, extra_length = struct.unpack_from("<HH", self.data, member.header_offset + 26)
+            start = member.header_offset + 30 + name_length + extra_length
+            return memoryview(self.data)[start:start+member.file_size]
+
+        if self.compressed:
+            return self.tar.extractfile(member).read()
 
+        return memoryview(self.data)[member.offset_data:member.offset_data+member.size]
+
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+
+        if self.tar is not None:
+            self.tar.close()
+
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+
+            except BufferError:
+                # Members read as memoryviews are still in use, the mmap is unmapped once they're released
+                pass
+
+        self.file.close()
+
+
+# Recently used archives stay open so batch workers don't re-read an archive's index for every member.
+# They're keyed by process id as well, a forked worker must never share the parent's file object and offset.
+# Members are converted in path order so a worker rarely goes back to an archive, only the last few are kept open.
+open_archives = {}
+MAX_OPEN_ARCHIVES = 4
+
+
+def open_archive(path):
+    key = (os.getpid(), os.path.abspath(path))
+
+    if key in open_archives:
+        # Move it to the end so the least recently used archive is always first
+        open_archives[key] = open_archives.pop(key)
+        return open_archives[key]
+
+    owned = [x for x in open_archives if x[0] == key[0]]
+    for old_key in owned[:max(0, len(owned) - MAX_OPEN_ARCHIVES + 1)]:
+        open_archives.pop(old_key).close()
+
+    open_archives[key] = ArchiveReader(key[1])
+
+    return open_archives[key]
+
+
+def close_archives():
+    for key in [x for x in open_archives if x[0] == os.getpid()]:
+        open_archives.pop(key).close()
+
+
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(tuple(ARCHIVE_FORMATS))
+
+
+def split_archive_path(input_path):
+    # Returns (archive path, member name) for archive member paths and (input_path, None) for everything else
+    if ARCHIVE_SEPARATOR in input_path:
+        archive_path, member = input_path.split(ARCHIVE_SEPARATOR, 1)
+        return archive_path, member
+
+    return input_path, None
+
+
+def read_input(input_path):
+    archive_path, member = split_archive_path(input_path)
+
+    if member is not None:
+        with profiler.stage("read"):
+            data = open_archive(archive_path).read(member)
+
+    else:
+        with profiler.stage("read"):
+            data = open(input_path, "rb").read()
+
+    profiler.count("bytes_read", len(data))
+
+    return data
+
+
+def load_package_info(input_path):
     package_info = {
-        'music_id': os.path.splitext(os.path.basename(args.input))[0],
-        'title': os.path.splitext(os.path.basename(args.input))[0],
+        'music_id': os.path.splitext(os.path.basename(input_path))[0],
+        'title': os.path.splitext(os.path.basename(input_path))[0],
     }
-    package_path = os.path.join(os.path.dirname(args.input), "package.json")
+
+    archive_path, member = split_archive_path(input_path)
+
+    if member is not None:
+        # Archive members use the package.json in the same folder of the archive
+        package_member = posixpath.join(posixpath.dirname(member), "package.json")
+        archive = open_archive(archive_path)
+
+        if package_member in archive.members:
+            package_info = json.loads(bytes(archive.read(package_member)))
+
+        return package_info
+
+    package_path = os.path.join(os.path.dirname(input_path), "package.json")
     if os.path.exists(package_path):
         package_info = json.load(open(package_path, "r"))
 
-    input_format = os.path.splitext(args.input)[-1].lower().strip('.')
+    return package_info
 
+
+def get_input_format(input_path):
+    return os.path.splitext(input_path)[-1].lower().strip('.')
+
+
+def create_reader(data, input_format):
+    # Returns None for inputs that are already exported JSON
     if input_format in ["ssq", "csq"]:
-        reader = CsqReader(bytearray(open(args.input, "rb").read()))
-        data = reader.export_json()
+        return CsqReader(data)
 
     elif input_format in ["cms"]:
-        reader = CmsReader(bytearray(open(args.input, "rb").read()))
-        data = reader.export_json()
+        return CmsReader(data)
 
     elif input_format == "json":
-        import json
-        data = json.load(open(args.input))
+        return None
+
+    raise ConversionError("Unknown input format: %s" % input_format)
+
+
+def open_reader(input_path):
+    input_format = get_input_format(input_path)
+
+    if split_archive_path(input_path)[1] is not None:
+        if input_format in ["ssq", "csq"]:
+            return create_reader(read_input(input_path), input_format)
+
+        elif input_format in ["cms"]:
+            return create_reader(bytearray(read_input(input_path)), input_format)
+
+        return create_reader(None, input_format)
+
+    if input_format in ["ssq", "csq"]:
+        with profiler.stage("read"), open(input_path, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                raise ChartFormatError("Empty chart file: %s" % input_path)
+
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    elif input_format in ["cms"]:
+        with profiler.stage("read"):
+            data = bytearray(open(input_path, "rb").read())
+
+    else:
+        return create_reader(None, input_format)
+
+    profiler.count("bytes_read", len(data))
+
+    return create_reader(data, input_format)
+
+
+def parse_json_chart(data):
+    # JSON input is a chart exported with --export-json, a list of chunks that each have a type and events
+    try:
+        chunks = json.loads(bytes(data))
+
+    except ValueError as e:
+        raise ChartFormatError("Malformed JSON chart: %s" % e) from e
+
+    if not isinstance(chunks, list):
+        raise ChartFormatError("JSON chart isn't a list of chunks")
+
+    for idx, chunk in enumerate(chunks):
+        if not isinstance(chunk, dict) or 'type' not in chunk or 'events' not in chunk:
+            raise ChartFormatError("JSON chunk %d has no type or events" % idx)
+
+        if chunk['type'] != "notes":
+            continue
+
+        if not isinstance(chunk['events'], dict) or 'chart_type' not in chunk['events'] or not isinstance(chunk['events'].get('events'), list):
+            raise ChartFormatError("JSON notes chunk %d has no chart_type or events" % idx)
+
+        for event_idx, event in enumerate(chunk['events']['events']):
+            if not isinstance(event, dict) or not isinstance(event.get('notes'), list):
+                raise ChartFormatError("JSON notes chunk %d event %d has no notes" % (idx, event_idx))
+
+            if event.get('_meta_timestamp') is None and event.get('_meta_timestamp_us') is None:
+                raise ChartFormatError("JSON notes chunk %d event %d has no timestamp" % (idx, event_idx))
+
+    return chunks
+
+
+def load_chart_data(input_path, target_charts=None, reader=None):
+    # When target_charts is given only those charts' notes chunks are decoded, which is all convert_json_to_vibes needs
+    chunk_types = None if target_charts is None else ["notes"]
+
+    if reader is None:
+        reader = open_reader(input_path)
+
+    if reader is None:
+        return parse_json_chart(read_input(input_path))
+
+    return reader.export_json(chunk_types=chunk_types, chart_types=target_charts)
+
+
+def convert(source, charts=None, input_format=None, package_info=None, reference=False, verify=False, coalesce=0, coalesce_conflicts="split"):
+    # Converts a chart file (path) or the contents of one (bytes) and returns {chart: vibes},
+    # with None for requested charts the input doesn't contain. Nothing is printed or written to disk.
+    # Readers use the columnar fast path unless reference is set, JSON input always uses convert_json_to_vibes.
+    # With verify both paths are run and must produce the same output.
+    # With coalesce events closer than that many µs are merged, see coalesce_events.
+    if coalesce > 0:
+        outputs = convert(source, charts, input_format, package_info, reference, verify)
+        return {k: coalesce_vibes(v, coalesce, coalesce_conflicts) for k, v in outputs.items()}
+
+    target_charts = CHART_TYPES if charts is None else charts
+    is_bytes = isinstance(source, (bytes, bytearray, memoryview))
+
+    if is_bytes and input_format is None:
+        raise ConversionError("input_format is required when converting bytes")
+
+    if not is_bytes and input_format is not None and input_format != get_input_format(source):
+        raise ConversionError("Input format %s doesn't match %s" % (input_format, source))
+
+    if package_info is None:
+        package_info = {} if is_bytes else load_package_info(source)
+
+    logger.debug("Converting %s from %s", ", ".join(target_charts), "%d bytes of %s" % (len(source), input_format) if is_bytes else source)
+
+    try:
+        if is_bytes:
+            reader = create_reader(source, input_format)
+            data = parse_json_chart(source) if reader is None else None
+
+        else:
+            reader = open_reader(source)
+            data = parse_json_chart(read_input(source)) if reader is None else None
+
+        outputs = {}
+
+        if reader is not None and not reference:
+            note_columns = [x['events']['events'] for x in reader.get_chunks(["notes"], target_charts)]
+            available_charts = set([x.chart_type for x in note_columns])
+
+            with profiler.stage("vibes"):
+                for target_chart in target_charts:
+                    outputs[target_chart] = convert_columns_to_vibes(note_columns, target_chart, package_info)[0] if target_chart in available_charts else None
+
+            if not verify:
+                return add_chart_beats(reader, outputs)
+
+        if data is None:
+            with profiler.stage("export_json"):
+                data = reader.export_json(chunk_types=["notes"], chart_types=target_charts)
+
+        available_charts = set([x['events']['chart_type'] for x in data if x['type'] == "notes"])
+
+        for target_chart in target_charts:
+            with profiler.stage("vibes_reference"):
+                vibes = convert_json_to_vibes(data, target_chart, package_info)[0] if target_chart in available_charts else None
+
+            if target_chart in outputs and outputs[target_chart] != vibes:
+                raise VerificationError("Fast path output for %s doesn't match convert_json_to_vibes" % (target_chart))
+
+            outputs[target_chart] = vibes
+
+        # Both paths get the same beats so they're added after the comparison
+        return outputs if reader is None else add_chart_beats(reader, outputs)
+
+    except struct.error as e:
+        # Truncated chunks or tables
+        raise ChartFormatError("Malformed chart data: %s" % e) from e
+
+
+def measure_tempo_drift(source, charts=None, input_format=None):
+    # Compares the µs timestamp the old float tempo math gave every note, round(ms * 1000), with the exact one.
+    # Returns {chart: stats} for the requested charts the input has, JSON input has no raw tempo data and returns {}.
+    target_charts = CHART_TYPES if charts is None else charts
+    is_bytes = isinstance(source, (bytes, bytearray, memoryview))
+
+    try:
+        reader = create_reader(source, input_format) if is_bytes else open_reader(source)
+
+        if reader is None:
+            return {}
+
+        drift = {}
+        for chunk in reader.get_chunks(["notes"], target_charts):
+            columns = chunk['events']['events']
+
+            if columns.timestamps_us is None:
+                continue
+
+            deltas = [round(timestamp * 1000) - timestamp_us for timestamp, timestamp_us in zip(columns.timestamps, columns.timestamps_us)]
+            abs_deltas = [abs(x) for x in deltas]
+
+            drift[columns.chart_type] = {
+                'events': len(deltas),
+                'drifted_events': len([x for x in deltas if x != 0]),
+                'max_drift_us': max(abs_deltas, default=0),
+                'mean_drift_us': sum(abs_deltas) / len(deltas) if deltas else 0,
+                'end_drift_us': deltas[-1] if deltas else 0,
+            }
+
+        return drift
+
+    except struct.error as e:
+        raise ChartFormatError("Malformed chart data: %s" % e) from e
+
+
+def get_chart_name(package_info, target_chart):
+    return f"chart_{package_info['music_id']}_{target_chart}"
+
+
+def get_chart_output_path(output_folder, package_info, target_chart):
+    return os.path.join(output_folder, get_chart_name(package_info, target_chart) + ".json")
+
+
+def find_archive_members(archive_path):
+    archive = open_archive(archive_path)
+    return [archive_path + ARCHIVE_SEPARATOR + name for name in archive.names() if os.path.splitext(name)[-1].lower().strip('.') in INPUT_FORMATS]
+
 
-    print("Dumping vibes")
-    vibes, event_count = convert_json_to_vibes(data, args.chart, package_info)
+def find_input_files(input_path):
+    # Archives are expanded into their chart members, which are kept in archive order
+    if split_archive_path(input_path)[1] is not None:
+        return [input_path]
+
+    if os.path.isdir(input_path):
+        paths = []
+
+        for root, dirs, files in os.walk(input_path):
+            for filename in files:
+                if os.path.splitext(filename)[-1].lower().strip('.') in INPUT_FORMATS or is_archive(os.path.join(root, filename)):
+                    paths.append(os.path.join(root, filename))
+
+    else:
+        paths = [path for path in glob.glob(input_path, recursive=True) if os.path.isfile(path)]
+
+    output = []
+    for path in sorted(paths):
+        output += find_archive_members(path) if is_archive(path) else [path]
+
+    return output
+
+
+def convert_file(input_path, target_charts, output_folder, cache_folder=None, reference=False, verify=False, profile=False, capture_cprofile=False, coalesce=0, coalesce_conflicts="split", drift=False, index=False, pack=None):
+    # Parses the input once and writes every requested chart it contains.
+    # With pack the charts aren't written, they're returned as (name, vibes) in result['packed'] for the caller to
+    # append to that chart pack, and their paths are <pack>/<name>.
+    # Errors are returned instead of raised so one bad file can't take down a whole batch.
+    # With profile the file's stage timers and counters are returned in result['profile'].
+    # With index every written chart's library index row is returned in result['index'].
+    if profile:
+        profiler.enable(capture_cprofile)
+        profiler.snapshot()
+
+    start_time = time.perf_counter()
+
+    result = {
+        'path': input_path,
+        'charts': {},
+        'missing': [],
+        'event_count': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'coalesced': {},
+        'drift': {},
+        'index': [],
+        'packed': [],
+        'error': None,
+    }
+
+    cache = None
+
+    try:
+        with profiler.stage("read"):
+            package_info = load_package_info(input_path)
+
+        content_hash = None
+        cached_vibes = {}
+        if cache_folder is not None:
+            with profiler.stage("cache"):
+                cache = ConversionCache(cache_folder)
+                content_hash = cache.hash_file(input_path)
+
+                for target_chart in target_charts:
+                    found, vibes = cache.get(content_hash, target_chart)
+
+                    if found:
+                        cached_vibes[target_chart] = vibes
+
+        # Only parse the input when at least one requested chart wasn't in the cache
+        outputs = {}
+        if len(cached_vibes) != len(target_charts):
+            outputs = convert(input_path, [x for x in target_charts if x not in cached_vibes], package_info=package_info, reference=reference, verify=verify)
+
+        for target_chart in target_charts:
+            if target_chart in cached_vibes:
+                vibes = cached_vibes[target_chart]
+                if vibes is not None:
+                    vibes = dict({'title': get_chart_title(package_info, target_chart)}, **vibes)
+
+            else:
+                vibes = outputs[target_chart]
+
+            if cache is not None and target_chart not in cached_vibes:
+                with profiler.stage("cache"):
+                    cache.put(content_hash, target_chart, vibes)
+
+            if vibes is None:
+                result['missing'].append(target_chart)
+                continue
+
+            if pack is not None:
+                output_path = os.path.join(pack, get_chart_name(package_info, target_chart))
+
+            else:
+                output_path = get_chart_output_path(output_folder, package_info, target_chart)
+
+            # The cache keeps the uncoalesced events so any tolerance can be applied to them
+            if coalesce > 0:
+                event_count = len(vibes['events'])
+
+                with profiler.stage("coalesce"):
+                    vibes = coalesce_vibes(vibes, coalesce, coalesce_conflicts)
+
+                result['coalesced'][target_chart] = [event_count, len(vibes['events'])]
+
+            if pack is not None:
+                result['packed'].append((get_chart_name(package_info, target_chart), vibes))
+
+            else:
+                with profiler.stage("write_json"), open(output_path, "w") as outfile:
+                    json.dump(vibes, outfile, indent=4)
+                    profiler.count("bytes_written", outfile.tell())
+
+            profiler.count("charts_written")
+            profiler.count("vibes_events", len(vibes['events']))
+
+            result['charts'][target_chart] = output_path
+            result['event_count'] += len(vibes['events'])
+
+            if index:
+                with profiler.stage("index"):
+                    if content_hash is None:
+                        content_hash = ConversionCache.hash_file(input_path)
+
+                    result['index'].append(dict({
+                        'path': output_path,
+                        'source_path': input_path,
+                        'source_hash': content_hash,
+                        'music_id': package_info['music_id'],
+                        'title': vibes['title'],
+                        'chart_type': target_chart,
+                        'converter_version': CONVERTER_VERSION,
+                    }, **compute_chart_stats(vibes['events'])))
+
+        if drift:
+            with profiler.stage("drift"):
+                result['drift'] = measure_tempo_drift(input_path, target_charts)
+
+    except Exception as e:
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+
+    if cache is not None:
+        result['cache_hits'] = cache.hits
+        result['cache_misses'] = cache.misses
+
+    if profile:
+        result['profile'] = profiler.snapshot()
+        result['profile']['timers']['total'] = time.perf_counter() - start_time
+
+    return result
+
+
+def convert_batch(input_paths, target_charts, output_folder, jobs=None, cache_folder=None, reference=False, verify=False, profile=False, capture_cprofile=False, coalesce=0, coalesce_conflicts="split", drift=False, index=False, pack=None):
+    # With pack every converted chart is appended to that chart pack in one go once the whole batch is converted
+    if pack is None:
+        os.makedirs(output_folder, exist_ok=True)
+
+    start_time = time.perf_counter()
+    results = []
+
+    # Archives opened while listing the input are closed so workers open their own
+    close_archives()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(convert_file, path, target_charts, output_folder, cache_folder, reference, verify, profile, capture_cprofile, coalesce, coalesce_conflicts, drift, index, pack) for path in input_paths]
+
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            if result['error']:
+                logger.error("Failed %s: %s", result['path'], result['error'])
+
+            else:
+                logger.info("Converted %s (%d charts)", result['path'], len(result['charts']))
+
+    results = sorted(results, key=lambda x:x['path'])
+
+    if pack is not None:
+        append_charts(pack, [x for result in results for x in result.pop('packed')])
+
+    elapsed = time.perf_counter() - start_time
+
+    return results, elapsed
+
+
+def build_profile_report(results, elapsed):
+    # Per file stats plus their total, stage timers are summed over all workers so the total can exceed elapsed
+    return {
+        'elapsed': elapsed,
+        'files': [dict(trim_functions(x['profile']), path=x['path'], error=x['error']) for x in results if 'profile' in x],
+        'total': trim_functions(merge_snapshots([x['profile'] for x in results if 'profile' in x])),
+    }
+
+
+def build_coalesce_report(results):
+    return [{
+        'path': result['path'],
+        'chart': chart,
+        'events': before,
+        'coalesced_events': after,
+        'saved_raw_bytes': (before - after) * RAW_EVENT_SIZE,
+    } for result in results for chart, (before, after) in result['coalesced'].items()]
+
+
+def build_drift_report(results):
+    return [dict({
+        'path': result['path'],
+        'chart': chart,
+    }, **stats) for result in results for chart, stats in result['drift'].items()]
+
+
+def print_drift_summary(drift):
+    drifted = sum([x['drifted_events'] for x in drift])
+    logger.info("Tempo drift: %d of %d note events were off by up to %d µs with float timestamps", drifted, sum([x['events'] for x in drift]), max([x['max_drift_us'] for x in drift], default=0))
+
+
+def print_batch_summary(results, elapsed):
+    failures = [x for x in results if x['error']]
+    chart_count = sum([len(x['charts']) for x in results])
+    event_count = sum([x['event_count'] for x in results])
+    missing_count = sum([len(x['missing']) for x in results if not x['error']])
+    rate = lambda x: x / elapsed if elapsed > 0 else 0
+
+    logger.info("")
+    logger.info("Files: %d (%d failed)", len(results), len(failures))
+    logger.info("Charts written: %d (%d requested charts not present)", chart_count, missing_count)
+    logger.info("Events: %d", event_count)
+
+    coalesced = [x for result in results for x in result['coalesced'].values()]
+    if coalesced:
+        before = sum([x[0] for x in coalesced])
+        after = sum([x[1] for x in coalesced])
+        logger.info("Coalesced: %d events into %d (%d bytes saved with -f raw, less with -f delta)", before, after, (before - after) * RAW_EVENT_SIZE)
+
+    drift = build_drift_report(results)
+    if drift:
+        print_drift_summary(drift)
+
+    logger.info("Elapsed: %.2fs (%.1f files/s, %.1f charts/s, %.0f events/s)", elapsed, rate(len(results)), rate(chart_count), rate(event_count))
+
+    if failures:
+        logger.info("")
+        logger.info("Failures:")
+        for result in failures:
+            logger.info("  %s: %s", result['path'], result['error'])
+
+    if [x for x in results if 'profile' in x]:
+        logger.info("")
+        logger.info("Stages (summed over all workers):")
+        print_snapshot(merge_snapshots([x['profile'] for x in results if 'profile' in x]), logger.info)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--input', help='Input file, folder or glob pattern', default=None, required=True)
+    parser.add_argument('-c', '--chart', help='Chart(s) to export', default=None, required=True, nargs='+', choices=CHART_TYPES + ["all"])
+    parser.add_argument('-o', '--output', help='Output folder', default="charts")
+    parser.add_argument('-j', '--jobs', help='Number of worker processes for batch conversion', default=None, type=int)
+    parser.add_argument('--export-ssq', help='Also write a CMS input converted to SSQ to this path', default=None)
+    parser.add_argument('--cache', help='Conversion cache folder', default=None)
+    parser.add_argument('--cache-size', help='Maximum conversion cache size in MB', default=256, type=float)
+    parser.add_argument('--reference', help='Convert through export_json and convert_json_to_vibes instead of the fast path', default=False, action='store_true')
+    parser.add_argument('--verify', help='Run both the fast path and the reference conversion and fail if they differ', default=False, action='store_true')
+    parser.add_argument('--coalesce', help='Merge events within this many µs of each other into one event', default=0, type=int)
+    parser.add_argument('--coalesce-conflicts', help='How --coalesce handles a panel pressed and released within the tolerance, split keeps both events and last keeps the later state', default="split", choices=COALESCE_CONFLICTS)
+    parser.add_argument('--coalesce-report', help='Write the per chart event counts before and after --coalesce and the bytes saved with -f raw to a JSON file', default=None)
+    parser.add_argument('--drift-report', help='Write how far the old float tempo math drifted from the exact timestamps per chart to a JSON file', default=None)
+    parser.add_argument('--index', help='Record every converted chart and its statistics in this SQLite library index', default=None)
+    parser.add_argument('--pack', help='Append the converted charts to this chart pack instead of writing a JSON file per chart', default=None)
+    parser.add_argument('--profile', help='Write per file and total stage timings and counters to this JSON file', default=None)
+    parser.add_argument('--cprofile', help='Also capture cProfile function stats in the --profile report', default=False, action='store_true')
+    parser.add_argument('-v', '--verbose', help='Log every converted event', default=False, action='store_true')
+    parser.add_argument('-q', '--quiet', help='Only log errors', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.verbose else logging.ERROR if args.quiet else logging.INFO)
+
+    target_charts = CHART_TYPES if "all" in args.chart else list(dict.fromkeys(args.chart))
+
+    single_file = split_archive_path(args.input)[1] is not None or (os.path.isfile(args.input) and not is_archive(args.input))
+
+    if not single_file or len(target_charts) > 1 or args.cache or args.index:
+        try:
+            input_paths = find_input_files(args.input)
+
+        except ConversionError as e:
+            logger.error("%s: %s", type(e).__name__, e)
+            exit(1)
+
+        if not input_paths:
+            logger.error("No input files found")
+            exit(1)
+
+        try:
+            results, elapsed = convert_batch(input_paths, target_charts, args.output, args.jobs, args.cache, args.reference, args.verify, args.profile is not None, args.cprofile, args.coalesce, args.coalesce_conflicts, args.drift_report is not None, args.index is not None, args.pack)
+
+        except (OSError, ChartPackError) as e:
+            logger.error("Couldn't write the chart pack: %s", e)
+            exit(1)
+
+        print_batch_summary(results, elapsed)
+
+        if args.coalesce_report:
+            json.dump(build_coalesce_report(results), open(args.coalesce_report, "w"), indent=4)
+
+        if args.drift_report:
+            json.dump(build_drift_report(results), open(args.drift_report, "w"), indent=4)
+
+        if args.index:
+            update_index(args.index, [x for result in results for x in result['index']])
+
+        if args.profile:
+            save_report(args.profile, build_profile_report(results, elapsed))
+
+        if args.cache:
+            cache = ConversionCache(args.cache, int(args.cache_size * 1024 * 1024))
+            evicted_count, evicted_size = cache.evict()
+            cache.print_stats(sum([x['cache_hits'] for x in results]), sum([x['cache_misses'] for x in results]), evicted_count, evicted_size)
+
+        if any([x['error'] for x in results]):
+            exit(1)
+
+    else:
+        package_info = load_package_info(args.input)
+
+        if args.export_ssq:
+            if os.path.splitext(args.input)[-1].lower() != ".cms":
+                logger.error("--export-ssq only works with CMS input")
+                exit(1)
+
+            CmsReader(bytearray(read_input(args.input))).export_ssq(args.export_ssq)
+
+        if args.profile:
+            profiler.enable(args.cprofile)
+
+        start_time = time.perf_counter()
+
+        logger.info("Dumping vibes")
+        try:
+            vibes = convert(args.input, target_charts, package_info=package_info, reference=args.reference, verify=args.verify)[target_charts[0]]
+
+            if args.drift_report:
+                drift = build_drift_report([{'path': args.input, 'drift': measure_tempo_drift(args.input, target_charts)}])
+                print_drift_summary(drift)
+                json.dump(drift, open(args.drift_report, "w"), indent=4)
+
+        except ConversionError as e:
+            logger.error("%s: %s", type(e).__name__, e)
+            exit(1)
 
-    os.makedirs("charts", exist_ok=True)
-    json.dump(vibes, open(os.path.join("charts", f"chart_{package_info['music_id']}_{args.chart}.json"), "w"), indent=4)
+        if vibes is None:
+            # A chart that isn't in the input has always been written out with no events
+            vibes = {'title': get_chart_title(package_info, target_charts[0]), 'events': []}
+
+        if args.coalesce > 0:
+            event_count = len(vibes['events'])
+            vibes = coalesce_vibes(vibes, args.coalesce, args.coalesce_conflicts)
+            logger.info("Coalesced %d events into %d (%d bytes saved with -f raw, less with -f delta)", event_count, len(vibes['events']), (event_count - len(vibes['events'])) * RAW_EVENT_SIZE)
+
+            if args.coalesce_report:
+                json.dump(build_coalesce_report([{'path': args.input, 'coalesced': {target_charts[0]: [event_count, len(vibes['events'])]}}]), open(args.coalesce_report, "w"), indent=4)
+
+        if args.pack:
+            try:
+                with profiler.stage("write_pack"):
+                    append_charts(args.pack, [(get_chart_name(package_info, target_charts[0]), vibes)])
+
+            except (OSError, ChartPackError) as e:
+                logger.error("Couldn't write the chart pack: %s", e)
+                exit(1)
+
+        else:
+            os.makedirs(args.output, exist_ok=True)
+            with profiler.stage("write_json"), open(get_chart_output_path(args.output, package_info, target_charts[0]), "w") as outfile:
+                json.dump(vibes, outfile, indent=4)
+                profiler.count("bytes_written", outfile.tell())
+
+        if args.profile:
+            elapsed = time.perf_counter() - start_time
+            result = {'path': args.input, 'error': None, 'profile': profiler.snapshot()}
+            result['profile']['timers']['total'] = elapsed
+            save_report(args.profile, build_profile_report([result], elapsed))
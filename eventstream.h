@@ -0,0 +1,53 @@
+#ifndef __EVENTSTREAM_H__
+#define __EVENTSTREAM_H__
+
+#include <stdint.h>
+
+// Delta encoded event stream, see encode_event_stream in generate_headers.py.
+//
+// Each event starts with a header byte:
+//   bit 7    - more timestamp delta bytes follow
+//   bits 3-6 - note selector, 0-7 is a single panel press/release (panel = sel >> 1, state = sel & 1), 8 means a raw note byte follows
+//   bits 0-2 - lowest 3 bits of the timestamp delta
+// followed by the rest of the delta 7 bits at a time (bit 7 set when more bytes follow) and then the raw note byte if needed.
+
+#ifndef EVENTSTREAM_READ_BYTE
+#define EVENTSTREAM_READ_BYTE(addr) pgm_read_byte(addr)
+#endif
+
+#define EVENTSTREAM_RAW_NOTE 8
+
+// Decodes the next count events into the cache arrays and advances the stream position and running timestamp
+static inline void decodeEventStream(const uint8_t *stream, uint32_t *pos, uint32_t *timestamp, uint32_t *timestamps, uint8_t *notes, unsigned int count)
+{
+  uint32_t p = *pos;
+  uint32_t t = *timestamp;
+
+  for (unsigned int i = 0; i < count; i++) {
+    uint8_t b = EVENTSTREAM_READ_BYTE(stream + p++);
+    uint8_t sel = (b >> 3) & 0x0f;
+    uint32_t delta = b & 0x07;
+    uint8_t shift = 3;
+
+    while (b & 0x80) {
+      b = EVENTSTREAM_READ_BYTE(stream + p++);
+      delta |= (uint32_t)(b & 0x7f) << shift;
+      shift += 7;
+    }
+
+    t += delta;
+    timestamps[i] = t;
+
+    if (sel < EVENTSTREAM_RAW_NOTE) {
+      uint8_t panel = sel >> 1;
+      notes[i] = (0x10 << panel) | ((sel & 1) << panel);
+    } else {
+      notes[i] = EVENTSTREAM_READ_BYTE(stream + p++);
+    }
+  }
+
+  *pos = p;
+  *timestamp = t;
+}
+
+#endif
@@ -1,41 +1,1174 @@
+import argparse
+import bisect
+import filecmp
+import fnmatch
+import fractions
 import glob
+import hashlib
 import json
 import os
+import sqlite3
+import subprocess
+import tempfile
+import time
 
-chart_count = 0
-event_start_idx = 0
-with open("viberchart_list.h", "w") as outfile:
-    all_events = []
-    all_events_timestamps = []
-    all_events_notes = []
+from chart_pack import ChartPack, ChartPackError, get_data_size
+from library_index import query_index
+from profiling import profiler, trim_functions, save_report
 
-    outfile.write("const ViberChart charts[VIBERCHART_CHARTCOUNT] PROGMEM = {\n")
-    paths = list(glob.glob(os.path.join("charts", "*.json")))
-    for path_idx, path in enumerate(paths):
-        chart = json.load(open(path, "r"))
 
-        for event in chart['events']:
-            all_events.append(f"{{{event['timestamp']},{event['note_bits']}}}")
-            all_events_timestamps.append(str(event['timestamp']))
-            all_events_notes.append(str(event['note_bits']))
+MANIFEST_VERSION = 4
+MANIFEST_CHART_FIELDS = ['path', 'size', 'mtime_ns', 'hash']
 
-            if event['timestamp'] == 0:
-                all_events[-1] = f"/* {len(all_events) - 1} {chart['title']} */ " + all_events[-1]
+EVENT_FORMATS = ["raw", "delta"]
 
-        outfile.write(f"{{\"{chart['title']}\",{len(chart['events'])},{event_start_idx}}},")
-        event_start_idx += len(chart['events'])
-        chart_count += 1
+# sizeof(ViberChart) on AVR: char title[20] + 2x 16-bit unsigned int
+VIBERCHART_ENTRY_SIZE = 24
 
-    outfile.write("};\n")
+# Must match CACHE_SIZE in replayer.ino, the round trip check decodes in refill sized batches like the firmware
+CACHE_SIZE = 100
 
-    outfile.write("const uint32_t event_timestamps[%d] PROGMEM = {\n" % (len(all_events_timestamps)))
-    outfile.write(",\n".join(all_events_timestamps))
-    outfile.write("};\n")
+# sizeof(ViberSeekPoint) on AVR, a 2 byte event index plus the stream position and running timestamp for delta charts
+# and a byte of held panels
+SEEK_POINT_SIZES = {
+    'raw': 3,
+    'delta': 11,
+}
 
-    outfile.write("const uint8_t event_notes[%d] PROGMEM = {\n" % (len(all_events_notes)))
-    outfile.write(",\n".join(all_events_notes))
-    outfile.write("};\n")
+# Each chart has an unsigned int entry in chart_seek_start, plus one terminating entry for the whole table
+SEEK_START_SIZE = 2
 
+# sizeof(ViberBeatSegment) on AVR: first beat, whole µs of the period, period fraction in 1/65536 µs, beat count and BPM * 100
+BEAT_SEGMENT_SIZE = 14
 
-with open("viberchart_meta.h", "w") as outfile:
-    outfile.write("#define VIBERCHART_CHARTCOUNT %d\n" % (chart_count))
\ No newline at end of file
+# Each chart has an unsigned int entry in chart_beat_start, plus one terminating entry for the whole table
+BEAT_START_SIZE = 2
+
+# Furthest a beat replayed from the tables may be from the converter's exact beat time
+BEAT_TOLERANCE_US = 1
+
+# Event data shards are .cpp files next to the headers so the Arduino build compiles and caches each one separately
+SHARD_FILE_PATTERN = "viberchart_shard_*.cpp"
+
+# A shard is always cut once it reaches this many times --shard-size
+MAX_SHARD_SCALE = 4
+
+# Each shard has a pointer per event array in the shard tables (2 bytes on AVR) and a uint32_t entry in shard_starts,
+# which also has one terminating entry
+SHARD_POINTER_SIZE = 2
+SHARD_START_SIZE = 4
+
+# Polynomial hash of the event array values used to find charts that can share event data
+SEQUENCE_HASH_MODULUS = (1 << 61) - 1
+SEQUENCE_HASH_BASE = 1000003
+
+
+def load_manifest(manifest_path):
+    if not manifest_path or not os.path.exists(manifest_path):
+        return {}
+
+    try:
+        manifest = json.load(open(manifest_path, "r"))
+
+    except ValueError:
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    if not manifest_path:
+        return
+
+    temp_path = manifest_path + ".tmp"
+    json.dump(manifest, open(temp_path, "w"))
+    os.replace(temp_path, manifest_path)
+
+
+def get_manifest_entry(chart):
+    # Only what's needed to tell whether the chart changed, never its events
+    return {k: chart.get(k) for k in MANIFEST_CHART_FIELDS}
+
+
+def load_chart(path):
+    raw = open(path, "rb").read()
+    chart = json.loads(raw)
+
+    profiler.count("bytes_read", len(raw))
+    profiler.count("charts_read")
+
+    return {
+        'path': path,
+        'hash': hashlib.sha256(raw).hexdigest(),
+        'title': chart['title'],
+        'timestamps': [event['timestamp'] for event in chart['events']],
+        'notes': [event['note_bits'] for event in chart['events']],
+        'beats': chart.get('beats') or [],
+    }
+
+
+def scan_pack_charts(pack_path, selected_paths=None):
+    # Charts in a chart pack have <pack>/<name> paths and are told apart by the hash of their packed data in the pack's index,
+    # so only the index is read
+    entries = []
+
+    with ChartPack(pack_path) as pack:
+        for name, entry in pack.entries.items():
+            path = os.path.join(pack_path, name)
+
+            if selected_paths is not None and os.path.abspath(path) not in selected_paths:
+                continue
+
+            entries.append({
+                'path': path,
+                'size': get_data_size(entry),
+                'mtime_ns': None,
+                'hash': entry['hash'],
+            })
+
+    return entries
+
+
+def scan_chart_folder(chart_folder, previous_charts, selected_paths=None):
+    # Charts whose size and mtime match the manifest keep their hash, only the others are read and hashed
+    entries = []
+
+    for path in glob.glob(os.path.join(chart_folder, "*.json")):
+        if selected_paths is not None and os.path.abspath(path) not in selected_paths:
+            continue
+
+        stat = os.stat(path)
+        previous = previous_charts.get(path)
+
+        if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+            chart_hash = previous['hash']
+
+        else:
+            raw = open(path, "rb").read()
+            chart_hash = hashlib.sha256(raw).hexdigest()
+            profiler.count("bytes_read", len(raw))
+
+        entries.append({
+            'path': path,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': chart_hash,
+        })
+
+    return entries
+
+
+def scan_charts(chart_input, manifest, selected_paths=None):
+    # Finds which charts changed or were removed since the manifest was written without decoding any events.
+    # With selected_paths only charts whose absolute path is in it are included.
+    previous_charts = {x['path']: x for x in manifest.get('charts', [])}
+
+    if os.path.isfile(chart_input):
+        entries = scan_pack_charts(chart_input, selected_paths)
+
+    else:
+        entries = scan_chart_folder(chart_input, previous_charts, selected_paths)
+
+    changed = [x['path'] for x in entries if x['path'] not in previous_charts or previous_charts[x['path']]['hash'] != x['hash']]
+    removed = sorted(set(previous_charts.keys()) - set([x['path'] for x in entries]))
+
+    return entries, changed, removed
+
+
+def read_charts(chart_input, entries):
+    # Decodes the events of every scanned chart, changed or not, packed charts are decoded straight from the pack's memory map
+    charts = []
+
+    if os.path.isfile(chart_input):
+        with ChartPack(chart_input) as pack:
+            for entry in entries:
+                packed = pack.read_chart(os.path.relpath(entry['path'], chart_input))
+                profiler.count("charts_read")
+
+                charts.append(dict(entry, title=packed['title'], timestamps=packed['timestamps'], notes=packed['notes'], beats=packed['beats'] or []))
+
+        return charts
+
+    for entry in entries:
+        chart = load_chart(entry['path'])
+        chart.update(entry)
+        charts.append(chart)
+
+    return charts
+
+
+def load_charts(chart_input, manifest, selected_paths=None):
+    entries, changed, removed = scan_charts(chart_input, manifest, selected_paths)
+    return read_charts(chart_input, entries), changed, removed
+
+
+def sort_charts(charts, sort_key):
+    # The path is always the last part of the key so the order never depends on glob order
+    sort_keys = {
+        'path': lambda x: (x['path'],),
+        'title': lambda x: (x['title'], x['path']),
+        'events': lambda x: (len(x['timestamps']), x['path']),
+    }
+
+    return sorted(charts, key=sort_keys[sort_key])
+
+
+def encode_event_stream(timestamps, notes, offsets=None):
+    # See eventstream.h for the layout. The byte offset every event starts at is appended to offsets when given.
+    output = bytearray()
+    last_timestamp = 0
+
+    for timestamp, note in zip(timestamps, notes):
+        if offsets is not None:
+            offsets.append(len(output))
+
+        delta = timestamp - last_timestamp
+        assert(delta >= 0)
+        last_timestamp = timestamp
+
+        mask = note >> 4
+        sel = 8
+
+        if mask in [1, 2, 4, 8] and (note & 0x0f & ~mask) == 0:
+            # A single panel press or release fits in the header byte
+            panel = mask.bit_length() - 1
+            sel = (panel << 1) | ((note >> panel) & 1)
+
+        header = (sel << 3) | (delta & 0x07)
+        delta >>= 3
+
+        output.append(header | (0x80 if delta else 0))
+
+        while delta:
+            b = delta & 0x7f
+            delta >>= 7
+            output.append(b | (0x80 if delta else 0))
+
+        if sel == 8:
+            output.append(note)
+
+    return bytes(output)
+
+
+def get_raw_size(chart):
+    # uint32_t timestamp + uint8_t note per event
+    return len(chart['timestamps']) * 5
+
+
+def get_chart_stream(chart):
+    if 'stream' not in chart:
+        chart['stream'] = encode_event_stream(chart['timestamps'], chart['notes'])
+
+    return chart['stream']
+
+
+def get_chart_stream_offsets(chart):
+    if 'stream_offsets' not in chart:
+        offsets = []
+        encode_event_stream(chart['timestamps'], chart['notes'], offsets)
+        chart['stream_offsets'] = offsets
+
+    return chart['stream_offsets']
+
+
+def build_seek_table(chart, event_format, seek_interval):
+    # Seek point k is the first event at or after k * seek_interval ms, found in a single pass over the events.
+    # Points are (event index, held panels) for raw charts and (event index, stream offset, running timestamp before the event,
+    # held panels) for delta charts, the stream offset is relative to the start of the chart's stream. Held panels has bit i set
+    # when arrow i is held down after the events before the point, the replayer presses them when it starts from the point.
+    key = (event_format, seek_interval)
+    if chart.get('seek_table_key') == key:
+        return chart['seek_table']
+
+    timestamps = chart['timestamps']
+    notes = chart['notes']
+    offsets = get_chart_stream_offsets(chart) if event_format == "delta" else None
+    interval = seek_interval * 1000
+
+    points = []
+    idx = 0
+    held = 0
+    for k in range(timestamps[-1] // interval + 1 if timestamps else 0):
+        while timestamps[idx] < k * interval:
+            mask = notes[idx] >> 4
+            held = (held & ~mask) | (notes[idx] & mask)
+            idx += 1
+
+        if event_format == "delta":
+            points.append((idx, offsets[idx], timestamps[idx-1] if idx > 0 else 0, held))
+
+        else:
+            points.append((idx, held))
+
+    chart['seek_table_key'] = key
+    chart['seek_table'] = points
+
+    return points
+
+
+def get_seek_table_size(chart, event_format, seek_interval):
+    if not seek_interval:
+        return 0
+
+    return SEEK_START_SIZE + len(build_seek_table(chart, event_format, seek_interval)) * SEEK_POINT_SIZES[event_format]
+
+
+def build_beat_table(chart):
+    # The chart's beat schedule as (first beat µs, period µs, period fraction, beat count, BPM * 100) segments.
+    # The metronome adds the period fraction up in 1/65536 µs so it needs no division or floating point math,
+    # segments with more beats than fit in beat_count are split.
+    if 'beat_table' in chart:
+        return chart['beat_table']
+
+    table = []
+    for segment in chart['beats']:
+        period = fractions.Fraction(segment['period_num'], segment['period_den'])
+        period_us, period_frac = divmod(round(period * 65536), 65536)
+        bpm_x100 = min(round(6000000000 / period), 0xffff)
+
+        for idx in range(0, segment['count'], 0xffff):
+            table.append((round(segment['start_us'] + idx * period), period_us, period_frac, min(segment['count'] - idx, 0xffff), bpm_x100))
+
+    chart['beat_table'] = table
+
+    return table
+
+
+def get_beat_table_size(chart, beat_tables):
+    if not beat_tables:
+        return 0
+
+    return BEAT_START_SIZE + len(build_beat_table(chart)) * BEAT_SEGMENT_SIZE
+
+
+def get_shard_table_size(event_format, shard_size):
+    # Where shards end isn't known until the charts are laid out, but every shard ends after some chart's event data,
+    # so a chart adds at most one shard's entries to the shard tables
+    if not shard_size:
+        return 0
+
+    return len(get_event_arrays(event_format)) * SHARD_POINTER_SIZE + SHARD_START_SIZE
+
+
+def get_chart_footprint(chart, event_format, seek_interval=0, beat_tables=False, shard_size=0):
+    # Number of PROGMEM bytes the chart adds to the build, exact except for the shard tables which are the most it can add
+    table_size = get_seek_table_size(chart, event_format, seek_interval) + get_beat_table_size(chart, beat_tables) + get_shard_table_size(event_format, shard_size)
+
+    if event_format == "delta":
+        return VIBERCHART_ENTRY_SIZE + len(get_chart_stream(chart)) + table_size
+
+    return VIBERCHART_ENTRY_SIZE + get_raw_size(chart) + table_size
+
+
+def load_priorities(priorities_path):
+    # JSON object of {pattern: priority}, patterns are matched against the chart filename and title
+    if not priorities_path:
+        return {}
+
+    return json.load(open(priorities_path, "r"))
+
+
+def get_chart_priority(chart, priorities, default_priority):
+    for pattern, priority in priorities.items():
+        if fnmatch.fnmatch(os.path.basename(chart['path']), pattern) or fnmatch.fnmatch(chart['title'], pattern):
+            return priority
+
+    return default_priority
+
+
+def plan_charts(charts, event_format, budget, priorities, default_priority=1, max_capacity=4096, seek_interval=0, beat_tables=False, shard_size=0):
+    # 0/1 knapsack over chart footprints to pick the highest total priority that fits the budget.
+    # Sizes are rounded up to a granularity so the table stays small for big budgets,
+    # which can only overestimate sizes so the selection is still guaranteed to fit.
+    total_budget = budget
+
+    # The terminating chart_seek_start entry doesn't belong to any chart
+    if seek_interval:
+        budget -= SEEK_START_SIZE
+
+    if beat_tables:
+        budget -= BEAT_START_SIZE
+
+    # The terminating shard_starts entry, and the first shard which is there even when no chart is selected
+    shard_fixed_size = SHARD_START_SIZE + get_shard_table_size(event_format, shard_size) if shard_size else 0
+    budget -= shard_fixed_size
+
+    items = []
+    for idx, chart in enumerate(charts):
+        items.append({
+            'idx': idx,
+            'chart': chart,
+            'size': get_chart_footprint(chart, event_format, seek_interval, beat_tables, shard_size),
+            'seek_size': get_seek_table_size(chart, event_format, seek_interval),
+            'beat_size': get_beat_table_size(chart, beat_tables),
+            'priority': get_chart_priority(chart, priorities, default_priority),
+        })
+
+    granularity = max(1, -(-budget // max_capacity))
+    capacity = budget // granularity
+
+    candidates = [x for x in items if x['priority'] > 0 and x['size'] <= budget]
+
+    best = [0] * (capacity + 1)
+    choices = []
+    for item in candidates:
+        weight = -(-item['size'] // granularity)
+        value = item['priority']
+        taken = bytearray(capacity + 1)
+
+        for c in range(capacity, weight - 1, -1):
+            if best[c - weight] + value > best[c]:
+                best[c] = best[c - weight] + value
+                taken[c] = 1
+
+        choices.append(taken)
+
+    selected = set()
+    c = capacity
+    for item, taken in zip(candidates[::-1], choices[::-1]):
+        if taken[c]:
+            selected.add(item['idx'])
+            c -= -(-item['size'] // granularity)
+
+    # Rounding can leave a few bytes unused, fill them with whatever still fits exactly
+    used = sum([x['size'] for x in items if x['idx'] in selected])
+    for item in sorted(candidates, key=lambda x: (-x['priority'], x['size'], x['idx'])):
+        if item['idx'] not in selected and used + item['size'] <= budget:
+            selected.add(item['idx'])
+            used += item['size']
+
+    if seek_interval:
+        used += SEEK_START_SIZE
+
+    if beat_tables:
+        used += BEAT_START_SIZE
+
+    used += shard_fixed_size
+
+    report = {
+        'budget': total_budget,
+        'used': used,
+        'seek_size': sum([x['seek_size'] for x in items if x['idx'] in selected]) + (SEEK_START_SIZE if seek_interval else 0),
+        'beat_size': sum([x['beat_size'] for x in items if x['idx'] in selected]) + (BEAT_START_SIZE if beat_tables else 0),
+        'shard_table_size': len(selected) * get_shard_table_size(event_format, shard_size) + shard_fixed_size,
+        'granularity': granularity,
+        'selected': [],
+        'dropped': [],
+    }
+
+    for item in items:
+        entry = {
+            'path': item['chart']['path'],
+            'title': item['chart']['title'],
+            'size': item['size'],
+            'seek_size': item['seek_size'],
+            'beat_size': item['beat_size'],
+            'priority': item['priority'],
+        }
+
+        if item['idx'] in selected:
+            report['selected'].append(entry)
+            continue
+
+        if item['priority'] <= 0:
+            entry['reason'] = "priority is 0"
+
+        elif item['size'] > total_budget:
+            entry['reason'] = "larger than the whole budget"
+
+        else:
+            entry['reason'] = "lower priority per byte than the selected charts"
+
+        report['dropped'].append(entry)
+
+    return [x['chart'] for x in items if x['idx'] in selected], report
+
+
+def print_plan_report(report):
+    print("Flash budget: %d/%d bytes used by %d charts (%d bytes free)" % (report['used'], report['budget'], len(report['selected']), report['budget'] - report['used']))
+
+    if report['seek_size']:
+        print("Seek tables: %d bytes of the used budget" % (report['seek_size']))
+
+    if report['beat_size']:
+        print("Beat tables: %d bytes of the used budget" % (report['beat_size']))
+
+    if report['shard_table_size']:
+        print("Shard tables: up to %d bytes of the used budget" % (report['shard_table_size']))
+
+    if report['dropped']:
+        print("Dropped %d charts:" % (len(report['dropped'])))
+
+        for entry in report['dropped']:
+            print("  %-20s %7d bytes, priority %s: %s" % (entry['title'], entry['size'], entry['priority'], entry['reason']))
+
+
+def get_chart_sequence(chart, event_format):
+    # The values that end up in the event arrays for this chart, one per event_start_idx step
+    if event_format == "delta":
+        return get_chart_stream(chart)
+
+    return [(timestamp << 8) | note for timestamp, note in zip(chart['timestamps'], chart['notes'])]
+
+
+def get_sequence_hash(sequence):
+    h = 0
+    for x in sequence:
+        h = (h * SEQUENCE_HASH_BASE + x + 1) % SEQUENCE_HASH_MODULUS
+    return h
+
+
+def get_chart_sequence_hash(chart, event_format, sequence_hashes):
+    # sequence_hashes is {chart hash: {event format: hash}} and is kept in the manifest, so unchanged charts are never rehashed
+    cached = sequence_hashes.setdefault(chart['hash'], {})
+
+    if event_format not in cached:
+        cached[event_format] = get_sequence_hash(get_chart_sequence(chart, event_format))
+
+    return cached[event_format]
+
+
+def find_shared_regions(sequences, hashes=None):
+    # Finds sequences that are identical to, or a prefix or suffix of, another sequence.
+    # Returns {idx: (container idx, offset)}. Candidates are found with polynomial hashes of every prefix
+    # and suffix, only looked up at lengths some other sequence actually has, and confirmed by comparison,
+    # so the cost is linear in the total number of values rather than quadratic in the number of charts.
+    # hashes has get_sequence_hash() of every sequence when they're already known.
+    modulus = SEQUENCE_HASH_MODULUS
+    base = SEQUENCE_HASH_BASE
+
+    if hashes is None:
+        hashes = [get_sequence_hash(seq) for seq in sequences]
+
+    parents = {}
+
+    by_hash = {}
+    for idx, seq in enumerate(sequences):
+        if not seq:
+            continue
+
+        key = (len(seq), hashes[idx])
+        for other in by_hash.get(key, []):
+            if sequences[other] == seq:
+                parents[idx] = (other, 0)
+                break
+
+        else:
+            by_hash.setdefault(key, []).append(idx)
+
+    lengths = set([x[0] for x in by_hash])
+    min_length = min(lengths, default=0)
+
+    for idx in [x for x in range(len(sequences)) if sequences[x] and x not in parents]:
+        seq = sequences[idx]
+        n = len(seq)
+
+        # Nothing is short enough to be a prefix or suffix of this sequence
+        if n <= min_length:
+            continue
+
+        prefix_hashes = [0] * (n + 1)
+        powers = [1] * (n + 1)
+        for i, x in enumerate(seq):
+            prefix_hashes[i + 1] = (prefix_hashes[i] * base + x + 1) % modulus
+            powers[i + 1] = (powers[i] * base) % modulus
+
+        for k in range(1, n):
+            if k not in lengths:
+                continue
+
+            suffix_hash = (prefix_hashes[n] - prefix_hashes[n - k] * powers[k]) % modulus
+
+            for h, offset in [(prefix_hashes[k], 0), (suffix_hash, n - k)]:
+                for other in by_hash.get((k, h), []):
+                    if other not in parents and sequences[other] == seq[offset:offset + k]:
+                        parents[other] = (idx, offset)
+
+    return parents
+
+
+def layout_charts(charts, event_format, dedupe=True, sequence_hashes=None):
+    # event_start_idx is an event index for the raw format and a byte offset into event_stream for the delta format.
+    # Charts whose data is contained in another chart's data point into that chart's region instead of getting their own.
+    sequences = [get_chart_sequence(chart, event_format) for chart in charts]
+    parents = {}
+
+    if dedupe:
+        hashes = None if sequence_hashes is None else [get_chart_sequence_hash(chart, event_format, sequence_hashes) for chart in charts]
+        parents = find_shared_regions(sequences, hashes)
+
+    regions = []
+    event_start_idx = 0
+
+    for idx, chart in enumerate(charts):
+        if idx in parents:
+            continue
+
+        chart['event_start_idx'] = event_start_idx
+        event_start_idx += len(sequences[idx])
+        regions.append(chart)
+
+    def resolve(idx):
+        if idx not in parents:
+            return charts[idx]['event_start_idx']
+
+        parent, offset = parents[idx]
+        return resolve(parent) + offset
+
+    saved = 0
+    for idx in parents:
+        charts[idx]['event_start_idx'] = resolve(idx)
+        saved += len(sequences[idx]) if event_format == "delta" else get_raw_size(charts[idx])
+
+    return event_start_idx, regions, saved
+
+
+def render_seek_tables(charts, event_format, seek_interval):
+    # Stream positions in the table are absolute byte offsets into event_stream
+    output = []
+    points = []
+    seek_starts = []
+
+    for chart in charts:
+        seek_starts.append(len(points))
+
+        for point in build_seek_table(chart, event_format, seek_interval):
+            if event_format == "delta":
+                points.append("{%d,%d,%d,%d}" % (point[0], chart['event_start_idx'] + point[1], point[2], point[3]))
+
+            else:
+                points.append("{%d,%d}" % point)
+
+    seek_starts.append(len(points))
+
+    output.append("const ViberSeekPoint seek_points[%d] PROGMEM = {\n" % (max(1, len(points))))
+    output.append(",".join(points or ["{0}"]))
+    output.append("};\n")
+
+    output.append("const unsigned int chart_seek_start[VIBERCHART_CHARTCOUNT + 1] PROGMEM = {\n")
+    output.append(",".join([str(x) for x in seek_starts]))
+    output.append("};\n")
+
+    return output
+
+
+def verify_seek_tables(charts, event_format, seek_interval):
+    # Checks every seek point against the events: it must point at the first event at or after its time, and its held
+    # panels must be what pressing and releasing arrows for every note before that event leaves held down
+    point_count = 0
+
+    for chart in charts:
+        held_after = []
+        held = 0
+        for note in chart['notes']:
+            for panel in range(4):
+                if note & (0x10 << panel):
+                    held = (held | (1 << panel)) if note & (1 << panel) else (held & ~(1 << panel))
+
+            held_after.append(held)
+
+        for k, point in enumerate(build_seek_table(chart, event_format, seek_interval)):
+            idx = bisect.bisect_left(chart['timestamps'], k * seek_interval * 1000)
+            expected_held = held_after[idx - 1] if idx > 0 else 0
+
+            if point[0] != idx or point[-1] != expected_held:
+                print("Seek table check FAILED for %s: point %d is event %d with held panels %x instead of event %d with %x" % (chart['title'], k, point[0], point[-1], idx, expected_held))
+                return False
+
+            point_count += 1
+
+    print("Seek table check OK (%d points)" % (point_count))
+    return True
+
+
+def render_beat_tables(charts):
+    output = []
+    segments = []
+    beat_starts = []
+
+    for chart in charts:
+        beat_starts.append(len(segments))
+        segments += ["{%dUL,%dUL,%d,%d,%d}" % x for x in build_beat_table(chart)]
+
+    beat_starts.append(len(segments))
+
+    output.append("const ViberBeatSegment beat_segments[%d] PROGMEM = {\n" % (max(1, len(segments))))
+    output.append(",\n".join(segments or ["{0UL,0UL,0,0,0}"]))
+    output.append("};\n")
+
+    output.append("const unsigned int chart_beat_start[VIBERCHART_CHARTCOUNT + 1] PROGMEM = {\n")
+    output.append(",".join([str(x) for x in beat_starts]))
+    output.append("};\n")
+
+    return output
+
+
+def verify_beat_tables(charts):
+    # Replays the beat tables with the metronome's integer math and checks every beat against the converter's exact beat time
+    beat_count = 0
+    max_error = 0
+
+    for chart in charts:
+        replayed = []
+
+        for first_beat_us, period_us, period_frac, count, bpm_x100 in build_beat_table(chart):
+            beat_us = first_beat_us
+            frac = 0x8000
+
+            for i in range(count):
+                replayed.append(beat_us)
+
+                frac += period_frac
+                beat_us += period_us + (frac >> 16)
+                frac &= 0xffff
+
+        expected = [segment['start_us'] + i * fractions.Fraction(segment['period_num'], segment['period_den']) for segment in chart['beats'] for i in range(segment['count'])]
+
+        if len(replayed) != len(expected):
+            print("Beat table check FAILED for %s: %d beats instead of %d" % (chart['title'], len(replayed), len(expected)))
+            return False
+
+        errors = [abs(x - y) for x, y in zip(replayed, expected)]
+        max_error = max(errors + [max_error])
+        beat_count += len(errors)
+
+        if errors and max(errors) > BEAT_TOLERANCE_US:
+            print("Beat table check FAILED for %s: beat %d is %.2fus off" % (chart['title'], errors.index(max(errors)), max(errors)))
+            return False
+
+    print("Beat table check OK (%d beats, max error %.2fus)" % (beat_count, max_error))
+    return True
+
+
+def get_region_size(chart, event_format):
+    return len(chart['stream']) if event_format == "delta" else get_raw_size(chart)
+
+
+def get_shard_name(chart):
+    return hashlib.sha1(os.path.basename(chart['path']).encode('utf-8')).hexdigest()[:8]
+
+
+def plan_shards(regions, event_format, shard_size):
+    # Splits the event data regions into shards of about shard_size bytes. Whether a shard ends after a region is
+    # decided from a hash of the region's filename, with a chance proportional to the region's size, instead of a
+    # running total. Adding, removing or changing a chart then only changes the shard it's in, and the other shards
+    # keep their names and contents. Shards are named after their first region for the same reason.
+    shards = []
+    current = []
+    current_size = 0
+
+    for region in regions:
+        region_size = get_region_size(region, event_format)
+        current.append(region)
+        current_size += region_size
+
+        cut = int(get_shard_name(region), 16)
+        if cut * shard_size < region_size * 0x100000000 or current_size >= shard_size * MAX_SHARD_SCALE:
+            shards.append(current)
+            current = []
+            current_size = 0
+
+    if current or not shards:
+        shards.append(current)
+
+    return [{
+        'name': get_shard_name(shard[0]) if shard else "00000000",
+        'regions': shard,
+        'event_start_idx': shard[0]['event_start_idx'] if shard else 0,
+    } for shard in shards]
+
+
+def get_event_arrays(event_format):
+    # (type, name, chart field) of every event data array
+    if event_format == "delta":
+        return [("uint8_t", "event_stream", "stream")]
+
+    return [("uint32_t", "event_timestamps", "timestamps"), ("uint8_t", "event_notes", "notes")]
+
+
+def iter_values(regions, field):
+    # Same as ",\n".join() over every value of every region, one region at a time
+    first = True
+
+    for region in regions:
+        if not region[field]:
+            continue
+
+        yield ("" if first else ",\n") + ",\n".join([str(x) for x in region[field]])
+        first = False
+
+
+def iter_shard_table(shards, event_count, event_format):
+    for value_type, name, field in get_event_arrays(event_format):
+        for shard in shards:
+            yield "extern const %s %s_%s[] PROGMEM;\n" % (value_type, name, shard['name'])
+
+    # Pointers to each shard's arrays plus where each shard starts, in event_start_idx units, in the order they'd be concatenated
+    for value_type, name, field in get_event_arrays(event_format):
+        yield "const %s* const shard_%s[VIBERCHART_SHARD_COUNT] PROGMEM = {\n" % (value_type, field)
+        yield ",".join(["%s_%s" % (name, shard['name']) for shard in shards])
+        yield "};\n"
+
+    yield "const uint32_t shard_starts[VIBERCHART_SHARD_COUNT + 1] PROGMEM = {\n"
+    yield ",".join([str(x['event_start_idx']) for x in shards] + [str(event_count)])
+    yield "};\n"
+
+
+def iter_shard(shard, event_format):
+    yield "// Event data shard %s, generated by generate_headers.py\n" % (shard['name'])
+    yield "#include <Arduino.h>\n"
+
+    for value_type, name, field in get_event_arrays(event_format):
+        yield "extern const %s %s_%s[%d] PROGMEM = {\n" % (value_type, name, shard['name'], sum([len(x[field]) for x in shard['regions']]))
+        yield from iter_values(shard['regions'], field)
+        yield "};\n"
+
+
+def iter_chart_list(charts, regions, event_count, event_format, seek_interval=0, shards=None, beat_tables=False):
+    # Yields viberchart_list.h in pieces so it can be streamed to disk. With shards the event data goes in
+    # the shard files and the header only has the tables pointing to them.
+    yield "const ViberChart charts[VIBERCHART_CHARTCOUNT] PROGMEM = {\n"
+
+    for chart in charts:
+        yield f"{{\"{chart['title']}\",{len(chart['timestamps'])},{chart['event_start_idx']}}},"
+
+    yield "};\n"
+
+    if seek_interval:
+        yield from render_seek_tables(charts, event_format, seek_interval)
+
+    if beat_tables:
+        yield from render_beat_tables(charts)
+
+    if shards is not None:
+        yield from iter_shard_table(shards, event_count, event_format)
+        return
+
+    for value_type, name, field in get_event_arrays(event_format):
+        yield "const %s %s[%d] PROGMEM = {\n" % (value_type, name, event_count)
+        yield from iter_values(regions, field)
+        yield "};\n"
+
+
+def render_chart_list(charts, regions, event_count, event_format, seek_interval=0, shards=None, beat_tables=False):
+    return "".join(iter_chart_list(charts, regions, event_count, event_format, seek_interval, shards, beat_tables))
+
+
+def print_stream_report(charts):
+    for chart in charts:
+        raw_size = get_raw_size(chart)
+        saved = raw_size - len(chart['stream'])
+        print("%-20s %6d events %7d -> %7d bytes (%d saved, %.1f%%)" % (chart['title'], len(chart['timestamps']), raw_size, len(chart['stream']), saved, saved / raw_size * 100 if raw_size else 0))
+
+    raw_size = sum([get_raw_size(x) for x in charts])
+    stream_size = sum([len(x['stream']) for x in charts])
+    print("Total: %d -> %d bytes (%d saved)" % (raw_size, stream_size, raw_size - stream_size))
+
+
+def verify_event_streams(charts, regions, compiler="gcc", seek_interval=0):
+    # Builds eventstream.h's decoder for the host and checks that it decodes every chart back to the original events,
+    # and that decoding from every seek point gives the event the point refers to
+    stream = [x for chart in regions for x in chart['stream']] + [0]
+    seek_points = [(c, point[0], chart['event_start_idx'] + point[1], point[2]) for c, chart in enumerate(charts) for point in build_seek_table(chart, "delta", seek_interval)] if seek_interval else []
+    source = []
+    source.append("#include <stdio.h>\n")
+    source.append("#define EVENTSTREAM_READ_BYTE(addr) (*(addr))\n")
+    source.append("#include \"eventstream.h\"\n")
+    source.append("const uint8_t event_stream[] = {%s};\n" % (",".join([str(x) for x in stream])))
+    source.append("const uint32_t chart_starts[] = {%s};\n" % (",".join([str(x['event_start_idx']) for x in charts] + ["0"])))
+    source.append("const uint32_t chart_counts[] = {%s};\n" % (",".join([str(len(x['timestamps'])) for x in charts] + ["0"])))
+    source.append("const uint32_t seek_points[][4] = {%s};\n" % (",".join(["{%d,%d,%d,%d}" % x for x in seek_points] + ["{0,0,0,0}"])))
+    source.append("""
+int main()
+{
+  uint32_t timestamps[%d];
+  uint8_t notes[%d];
+
+  for (unsigned int c = 0; c < %d; c++) {
+    uint32_t pos = chart_starts[c];
+    uint32_t timestamp = 0;
+
+    for (uint32_t idx = 0; idx < chart_counts[c]; idx += %d) {
+      unsigned int count = chart_counts[c] - idx < %d ? chart_counts[c] - idx : %d;
+      decodeEventStream(event_stream, &pos, &timestamp, timestamps, notes, count);
+
+      for (unsigned int i = 0; i < count; i++)
+        printf("%%u %%lu %%u\\n", c, (unsigned long)timestamps[i], notes[i]);
+    }
+  }
+
+  for (unsigned int s = 0; s < %d; s++) {
+    uint32_t pos = seek_points[s][2];
+    uint32_t timestamp = seek_points[s][3];
+
+    decodeEventStream(event_stream, &pos, &timestamp, timestamps, notes, 1);
+    printf("%%lu %%lu %%lu %%u\\n", (unsigned long)seek_points[s][0], (unsigned long)seek_points[s][1], (unsigned long)timestamps[0], notes[0]);
+  }
+
+  return 0;
+}
+""" % (CACHE_SIZE, CACHE_SIZE, len(charts), CACHE_SIZE, CACHE_SIZE, CACHE_SIZE, len(seek_points)))
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        source_path = os.path.join(temp_folder, "verify_eventstream.cpp")
+        binary_path = os.path.join(temp_folder, "verify_eventstream")
+        open(source_path, "w").write("".join(source))
+
+        subprocess.check_call([compiler, "-x", "c++", "-O2", "-I", os.path.dirname(os.path.abspath(__file__)), "-o", binary_path, source_path])
+        decoded = subprocess.check_output([binary_path]).decode('ascii').split()
+
+    expected = [str(x) for c, chart in enumerate(charts) for event in zip(chart['timestamps'], chart['notes']) for x in (c,) + event]
+    expected += [str(x) for c, idx, pos, timestamp in seek_points for x in (c, idx, charts[c]['timestamps'][idx], charts[c]['notes'][idx])]
+
+    if decoded != expected:
+        print("Event stream round trip FAILED")
+        return False
+
+    print("Event stream round trip OK (%d events, %d seek points)" % (sum([len(x['timestamps']) for x in charts]), len(seek_points)))
+    return True
+
+
+def render_chart_meta(charts, event_format, seek_interval=0, shard_count=0, beat_tables=False):
+    output = "#define VIBERCHART_CHARTCOUNT %d\n" % (len(charts))
+
+    if shard_count:
+        output += "#define VIBERCHART_SHARD_COUNT %d\n" % (shard_count)
+
+    if event_format == "delta":
+        output += "#define VIBERCHART_DELTA_STREAM\n"
+
+    if seek_interval:
+        output += "#define VIBERCHART_SEEK_INTERVAL_MS %dUL\n" % (seek_interval)
+
+    if beat_tables:
+        output += "#define VIBERCHART_BEAT_TABLES\n"
+
+    return output
+
+
+def write_if_changed(path, content):
+    # content is a string or an iterable of strings, which is streamed to a temporary file and compared with the existing one.
+    # Leaving an unchanged file alone keeps its mtime so the Arduino build doesn't recompile it
+    temp_path = path + ".tmp"
+    size = 0
+
+    with open(temp_path, "w") as outfile:
+        for chunk in [content] if isinstance(content, str) else content:
+            outfile.write(chunk)
+            size += len(chunk)
+
+    if os.path.exists(path) and filecmp.cmp(path, temp_path, shallow=False):
+        os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, path)
+    profiler.count("bytes_written", size)
+
+    return True
+
+
+def build_headers(args, all_charts, changed, removed, sequence_hashes):
+    # Plans, lays out and writes the headers for every loaded chart, returns the names of the files the build is made of
+    charts = sort_charts(all_charts, args.sort)
+
+    if args.budget is not None:
+        with profiler.stage("plan"):
+            charts, report = plan_charts(charts, args.format, args.budget, load_priorities(args.priorities), args.default_priority, seek_interval=args.seek_interval, beat_tables=args.beat_tables, shard_size=args.shard_size)
+
+        print_plan_report(report)
+
+        if args.plan_report:
+            json.dump(report, open(args.plan_report, "w"), indent=4)
+
+    for chart in all_charts:
+        chart['event_start_idx'] = None
+
+    with profiler.stage("layout"):
+        event_count, regions, dedupe_saved = layout_charts(charts, args.format, not args.no_dedupe, sequence_hashes)
+
+    profiler.count("charts", len(charts))
+    profiler.count("events", sum([len(x['timestamps']) for x in charts]))
+    profiler.count("event_array_length", event_count)
+
+    if dedupe_saved:
+        print("%d charts share event data with another chart (%d bytes saved)" % (len(charts) - len(regions), dedupe_saved))
+
+    if args.seek_interval:
+        print("Seek tables: %d points every %dms (%d bytes)" % (sum([len(build_seek_table(x, args.format, args.seek_interval)) for x in charts]), args.seek_interval, sum([get_seek_table_size(x, args.format, args.seek_interval) for x in charts]) + SEEK_START_SIZE))
+
+        if args.verify:
+            with profiler.stage("verify"):
+                verified = verify_seek_tables(charts, args.format, args.seek_interval)
+
+            if not verified:
+                exit(1)
+
+    if args.beat_tables:
+        print("Beat tables: %d segments (%d bytes)" % (sum([len(build_beat_table(x)) for x in charts]), sum([get_beat_table_size(x, True) for x in charts]) + BEAT_START_SIZE))
+
+        if args.verify:
+            with profiler.stage("verify"):
+                verified = verify_beat_tables(charts)
+
+            if not verified:
+                exit(1)
+
+    if args.format == "delta":
+        print_stream_report(charts)
+
+        if args.verify:
+            with profiler.stage("verify"):
+                verified = verify_event_streams(charts, regions, args.cc, args.seek_interval)
+
+            if not verified:
+                exit(1)
+
+    shards = plan_shards(regions, args.format, args.shard_size) if args.shard_size > 0 else None
+
+    output_files = {
+        "viberchart_list.h": lambda: iter_chart_list(charts, regions, event_count, args.format, args.seek_interval, shards, args.beat_tables),
+        "viberchart_meta.h": lambda: render_chart_meta(charts, args.format, args.seek_interval, len(shards) if shards else 0, args.beat_tables),
+    }
+
+    for shard in shards or []:
+        output_files["viberchart_shard_%s.cpp" % (shard['name'])] = lambda shard=shard: iter_shard(shard, args.format)
+
+    print("%d charts (%d changed, %d removed)" % (len(charts), len(changed), len(removed)))
+
+    unchanged = 0
+
+    for path, render in output_files.items():
+        # Rendering is streamed into the write so both are timed together
+        with profiler.stage("write"):
+            written = write_if_changed(path, render())
+
+        if written:
+            print("Wrote %s" % (path))
+
+        else:
+            unchanged += 1
+
+    # Shards from earlier runs would still be compiled and linked by the Arduino build
+    for path in sorted([x for x in glob.glob(SHARD_FILE_PATTERN) if x not in output_files]):
+        os.remove(path)
+        print("Removed %s" % (path))
+
+    if shards:
+        print("%d shards, %d files unchanged" % (len(shards), unchanged))
+
+    return list(output_files.keys())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--input', help='Input chart folder or chart pack', default="charts")
+    parser.add_argument('-s', '--sort', help='Chart order', default="path", choices=["path", "title", "events"])
+    parser.add_argument('-m', '--manifest', help='Manifest used for incremental generation', default="viberchart_manifest.json")
+    parser.add_argument('--no-manifest', help='Read every chart and ignore the manifest', default=False, action='store_true')
+    parser.add_argument('-f', '--format', help='Event data format', default="raw", choices=EVENT_FORMATS)
+    parser.add_argument('--verify', help='Round trip the delta event stream through the C decoder built with the host compiler and check the --seek-interval and --beat-tables tables', default=False, action='store_true')
+    parser.add_argument('--cc', help='Host compiler used by --verify', default="gcc")
+    parser.add_argument('--no-dedupe', help="Don't share event data between charts with identical, prefix or suffix event data", default=False, action='store_true')
+    parser.add_argument('-b', '--budget', help='PROGMEM budget in bytes for chart data, only the best set of charts that fits is included', default=None, type=int)
+    parser.add_argument('-p', '--priorities', help='JSON file of {pattern: priority} used by --budget', default=None)
+    parser.add_argument('--default-priority', help='Priority of charts not matched in --priorities', default=1, type=float)
+    parser.add_argument('--plan-report', help='Write the --budget report to a JSON file', default=None)
+    parser.add_argument('--seek-interval', help='Add a seek table with a point every this many ms to every chart so playback can start mid-chart', default=0, type=int)
+    parser.add_argument('--beat-tables', help="Add every chart's beat schedule so the metronome can follow its tempo changes", default=False, action='store_true')
+    parser.add_argument('--shard-size', help='Write the event data to .cpp shards of about this many bytes that are compiled separately, only changed shards are rewritten', default=0, type=int)
+    parser.add_argument('--index', help='Library index written by ddr2vibes.py --index', default="library.db")
+    parser.add_argument('-q', '--query', help='Only include charts matching this SQL condition on the library index, e.g. "chart_type = \'single-heavy\' AND min_gap_us > 1000"', default=None)
+    parser.add_argument('--profile', help='Write stage timings and counters to this JSON file', default=None)
+    parser.add_argument('--cprofile', help='Also capture cProfile function stats in the --profile report', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler.enable(args.cprofile)
+
+    start_time = time.perf_counter()
+
+    manifest_path = None if args.no_manifest else args.manifest
+    manifest = load_manifest(manifest_path)
+
+    selected_paths = None
+    if args.query:
+        with profiler.stage("query"):
+            try:
+                selected_paths = set([x['path'] for x in query_index(args.index, args.query)])
+
+            except (FileNotFoundError, sqlite3.Error) as e:
+                print("Couldn't query the library index: %s" % e)
+                exit(1)
+
+    with profiler.stage("scan"):
+        try:
+            entries, changed, removed = scan_charts(args.input, manifest, selected_paths)
+
+        except (OSError, ChartPackError) as e:
+            print("Couldn't read the chart pack: %s" % e)
+            exit(1)
+
+    if selected_paths is not None:
+        print("%d charts matched the query (%d not found in %s)" % (len(selected_paths), len(selected_paths) - len(entries), args.input))
+
+    options = {
+        'sort': args.sort,
+        'format': args.format,
+        'dedupe': not args.no_dedupe,
+        'seek_interval': args.seek_interval,
+        'shard_size': args.shard_size,
+        'beat_tables': args.beat_tables,
+        'budget': args.budget,
+        'priorities': load_priorities(args.priorities) if args.budget is not None else None,
+        'default_priority': args.default_priority if args.budget is not None else None,
+    }
+
+    # Decided from the scan alone so nothing is decoded, laid out or encoded when the headers are up to date
+    outputs = manifest.get('outputs', [])
+    stale_shards = [x for x in glob.glob(SHARD_FILE_PATTERN) if x not in outputs]
+    up_to_date = manifest and not changed and not removed and manifest.get('options') == options and not stale_shards and outputs and all([os.path.exists(x) for x in outputs])
+
+    sequence_hashes = {k: dict(v) for k, v in manifest.get('sequence_hashes', {}).items()}
+
+    if up_to_date:
+        # Charts that were touched without changing only get their new size and mtime
+        print("No charts changed, headers are up to date")
+        manifest_charts = entries
+
+    else:
+        # Any change rebuilds everything from every chart, only the output files whose contents changed are rewritten
+        with profiler.stage("load_charts"):
+            try:
+                all_charts = read_charts(args.input, entries)
+
+            except (OSError, ChartPackError) as e:
+                print("Couldn't read the chart pack: %s" % e)
+                exit(1)
+
+        outputs = build_headers(args, all_charts, changed, removed, sequence_hashes)
+        manifest_charts = [get_manifest_entry(x) for x in all_charts]
+
+    new_manifest = {
+        'version': MANIFEST_VERSION,
+        'options': options,
+        'outputs': outputs,
+        'charts': [get_manifest_entry(x) for x in sorted(manifest_charts, key=lambda x: x['path'])],
+        # Hashes of charts that are gone are dropped
+        'sequence_hashes': {x['hash']: sequence_hashes[x['hash']] for x in manifest_charts if x['hash'] in sequence_hashes},
+    }
+
+    if new_manifest != manifest:
+        save_manifest(manifest_path, new_manifest)
+
+    if args.profile:
+        snapshot = profiler.snapshot()
+        snapshot['timers']['total'] = time.perf_counter() - start_time
+        save_report(args.profile, {
+            'elapsed': snapshot['timers']['total'],
+            'total': trim_functions(snapshot),
+        })
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+
+INDEX_VERSION = 1
+
+# Window used for the peak events per second statistic
+PEAK_WINDOW_US = 1000000
+
+INDEX_COLUMNS = [
+    ('path', "TEXT PRIMARY KEY"),
+    ('source_path', "TEXT NOT NULL"),
+    ('source_hash', "TEXT"),
+    ('music_id', "TEXT"),
+    ('title', "TEXT"),
+    ('chart_type', "TEXT"),
+    ('event_count', "INTEGER"),
+    ('duration_us', "INTEGER"),
+    ('peak_events_per_second', "INTEGER"),
+    ('min_gap_us', "INTEGER"),
+    ('converter_version', "INTEGER"),
+    ('updated', "REAL"),
+]
+
+
+def open_index(index_path):
+    # A version mismatch drops the old table, ddr2vibes.py fills it again on the next conversion
+    connection = sqlite3.connect(index_path)
+    version, = connection.execute("PRAGMA user_version").fetchone()
+
+    if version != INDEX_VERSION:
+        connection.execute("DROP TABLE IF EXISTS charts")
+
+    connection.execute("CREATE TABLE IF NOT EXISTS charts (%s)" % ", ".join(["%s %s" % x for x in INDEX_COLUMNS]))
+    connection.execute("CREATE INDEX IF NOT EXISTS charts_source ON charts (source_path)")
+    connection.execute("CREATE INDEX IF NOT EXISTS charts_chart_type ON charts (chart_type)")
+    connection.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+    connection.commit()
+
+    return connection
+
+
+def compute_chart_stats(events):
+    timestamps = [x['timestamp'] for x in events]
+
+    # Largest number of events starting within any PEAK_WINDOW_US long window
+    peak = 0
+    start = 0
+    for end in range(len(timestamps)):
+        while timestamps[end] - timestamps[start] >= PEAK_WINDOW_US:
+            start += 1
+
+        peak = max(peak, end - start + 1)
+
+    return {
+        'event_count': len(timestamps),
+        'duration_us': timestamps[-1] - timestamps[0] if timestamps else 0,
+        'peak_events_per_second': peak,
+        'min_gap_us': min([timestamps[i] - timestamps[i-1] for i in range(1, len(timestamps))], default=None),
+    }
+
+
+def update_index(index_path, rows):
+    # Rows are keyed by the absolute path of the converted chart so the index can be used from any working directory.
+    # Charts in a chart pack have <pack>/<name> paths. Rows of charts whose file or pack was deleted since the last update are dropped.
+    connection = open_index(index_path)
+
+    with connection:
+        removed_paths = [x for x, in connection.execute("SELECT path FROM charts") if not os.path.exists(x) and not os.path.isfile(os.path.dirname(x))]
+        connection.executemany("DELETE FROM charts WHERE path = ?", [(x,) for x in removed_paths])
+
+        connection.executemany("INSERT OR REPLACE INTO charts (%s) VALUES (%s)" % (", ".join([x[0] for x in INDEX_COLUMNS]), ", ".join(["?"] * len(INDEX_COLUMNS))), [
+            tuple([os.path.abspath(row['path']), os.path.abspath(row['source_path'])] + [row.get(x[0]) for x in INDEX_COLUMNS[2:-1]] + [time.time()])
+            for row in rows
+        ])
+
+    connection.close()
+
+
+def query_index(index_path, where=None, order="path", limit=None):
+    # where and order are SQL snippets, this is meant for a local library so they're used as given
+    if not os.path.exists(index_path):
+        raise FileNotFoundError("Library index not found: %s" % index_path)
+
+    connection = open_index(index_path)
+    connection.row_factory = sqlite3.Row
+
+    sql = "SELECT * FROM charts"
+
+    if where:
+        sql += " WHERE %s" % where
+
+    if order:
+        sql += " ORDER BY %s" % order
+
+    if limit is not None:
+        sql += " LIMIT %d" % limit
+
+    rows = [dict(x) for x in connection.execute(sql)]
+    connection.close()
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--index', help='Library index written by ddr2vibes.py --index', default="library.db")
+    parser.add_argument('-w', '--where', help='SQL condition charts have to match, e.g. "chart_type = \'single-heavy\' AND peak_events_per_second < 8"', default=None)
+    parser.add_argument('-s', '--sort', help='SQL ORDER BY clause', default="path")
+    parser.add_argument('-n', '--limit', help='Maximum number of charts to list', default=None, type=int)
+    parser.add_argument('--json', help='Print the matching rows as JSON', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+
+    try:
+        rows = query_index(args.index, args.where, args.sort, args.limit)
+
+    except (FileNotFoundError, sqlite3.Error) as e:
+        print(e)
+        exit(1)
+
+    elapsed = time.perf_counter() - start_time
+
+    if args.json:
+        print(json.dumps(rows, indent=4))
+
+    else:
+        print("%-40s %-18s %-20s %7s %9s %5s %8s" % ("Chart", "Type", "Title", "Events", "Length", "Peak", "Min gap"))
+
+        for row in rows:
+            print("%-40s %-18s %-20s %7d %8.1fs %5d %8s" % (
+                os.path.basename(row['path']),
+                row['chart_type'],
+                row['title'],
+                row['event_count'],
+                row['duration_us'] / 1000000,
+                row['peak_events_per_second'],
+                "-" if row['min_gap_us'] is None else "%dus" % row['min_gap_us'],
+            ))
+
+        print("%d charts (%.1fms)" % (len(rows), elapsed * 1000))
@@ -9,6 +9,26 @@ int beatsSent;
 
 bool joypadState;
 
+#ifdef VIBERCHART_BEAT_TABLES
+// Chart whose beats are followed instead of the manual BPM, -1 when using the manual BPM
+int beatChart;
+char beatChartTitle[21];
+
+unsigned int beatSegmentIdx;
+unsigned int beatSegmentEnd;
+ViberBeatSegment beatSegment;
+
+// Beats left in beatSegment including the next one, which is due nextBeatUs after timeChartStart
+unsigned int beatsLeft;
+uint32_t nextBeatUs;
+uint16_t nextBeatFrac;
+unsigned long timeChartStart;
+
+#define FOLLOWING_CHART (beatChart >= 0)
+#else
+#define FOLLOWING_CHART false
+#endif
+
 void metronomeInit()
 {
   beatsSent = 0;
@@ -16,6 +36,10 @@ void metronomeInit()
   timeSyncPressed = false;
   curBpm = DEFAULT_BPM;
   joypadState = false;  
+#ifdef VIBERCHART_BEAT_TABLES
+  beatChart = -1;
+  beatsLeft = 0;
+#endif
 }
 
 
@@ -29,13 +53,119 @@ void setBpm(double bpm)
   Serial.println(curBpmInMicros);
 }
 
+void setJoypadState(bool state)
+{
+  joypadState = state;
+  Joystick.setButton(0, joypadState);
+  digitalWrite(JAMMA_UP, joypadState);
+  digitalWrite(JAMMA_DOWN, joypadState);
+  digitalWrite(JAMMA_LEFT, joypadState);
+  digitalWrite(JAMMA_RIGHT, joypadState);
+  Joystick.sendState();
+}
+
+#ifdef VIBERCHART_BEAT_TABLES
+void loadBeatSegment()
+{
+  memcpy_P(&beatSegment, &beat_segments[beatSegmentIdx++], sizeof(ViberBeatSegment));
+  beatsLeft = beatSegment.beat_count;
+  nextBeatUs = beatSegment.first_beat_us;
+  nextBeatFrac = 0x8000;
+}
+
+// Rewinds to the first beat of beatChart, with the chart's first event at the current time
+void startChartBeats()
+{
+  timeChartStart = micros();
+  beatSegmentIdx = pgm_read_word(&chart_beat_start[beatChart]);
+  beatSegmentEnd = pgm_read_word(&chart_beat_start[beatChart + 1]);
+  beatsLeft = 0;
+
+  if (beatSegmentIdx < beatSegmentEnd)
+    loadBeatSegment();
+
+  memcpy_P(beatChartTitle, &charts[beatChart].title, 20);
+  beatChartTitle[20] = 0;
+}
+
+void advanceChartBeat()
+{
+  // The period's fraction is added up in 1/65536 us, the accumulator starts at one half so beats are rounded to the nearest us
+  if (--beatsLeft > 0) {
+    uint32_t frac = (uint32_t)nextBeatFrac + beatSegment.period_frac;
+    nextBeatUs += beatSegment.period_us + (frac >> 16);
+    nextBeatFrac = frac & 0xffff;
+  }
+  else if (beatSegmentIdx < beatSegmentEnd) {
+    loadBeatSegment();
+  }
+}
+
+// Cycles from the manual BPM through every chart's beats and back to the default BPM
+void followNextChart()
+{
+  if (beatChart >= 0) {
+    beatChart = beatChart + 1 < VIBERCHART_CHARTCOUNT ? beatChart + 1 : -1;
+
+    if (beatChart < 0)
+      setBpm(DEFAULT_BPM);
+  }
+  else if (curBpm != DEFAULT_BPM) {
+    setBpm(DEFAULT_BPM);
+  }
+  else {
+    beatChart = 0;
+  }
+
+  if (beatChart >= 0)
+    startChartBeats();
+}
+
+String getChartBpmString()
+{
+  if (beatsLeft == 0)
+    return "BPM: -";
+
+  unsigned int fraction = beatSegment.bpm_x100 % 100;
+  return "BPM: " + String(beatSegment.bpm_x100 / 100) + (fraction < 10 ? ".0" : ".") + String(fraction);
+}
+
+void updateChartBeats()
+{
+  if (beatsLeft > 0 && (signed long)(timeNow - timeChartStart - nextBeatUs) >= -8) {
+    beatsSent++;
+    timeBeat = timeNow;
+    advanceChartBeat();
+
+    if (joypadState == false)
+      setJoypadState(true);
+  }
+  else if (joypadState == true && timeNow - timeBeat > 25000) {
+    setJoypadState(false);
+  }
+  else if (joypadState == false && beatsLeft == 0) {
+    // The chart is over
+    playbackState = PLAYBACK_STOPPED;
+  }
+}
+#endif
+
 void updateScreenMetronome()
 {
   u8g.firstPage();
   do
   {
-    String bpm_str = "BPM: " + String(curBpm);
-    u8g.drawStr(2, 8, bpm_str.c_str());
+#ifdef VIBERCHART_BEAT_TABLES
+    if (FOLLOWING_CHART) {
+      u8g.drawStr(2, 8, getChartBpmString().c_str());
+      u8g.drawStr(2, 56, beatChartTitle);
+    }
+    else
+#endif
+    {
+      String bpm_str = "BPM: " + String(curBpm);
+      u8g.drawStr(2, 8, bpm_str.c_str());
+    }
 
     if (buttonHeldState[2] && buttonPressedDuration[2] > 1000000UL) {
       u8g.drawStr(2, 24, "State: COMMAND");
@@ -72,6 +202,10 @@ void updateButtonStateMetronome()
     else if (!buttonIsPressedNow[0]) {
       if (timeSyncPressed) {
         timeBeat = micros() - curBpmInMicros;
+#ifdef VIBERCHART_BEAT_TABLES
+        if (FOLLOWING_CHART)
+          startChartBeats();
+#endif
       }
 
       timeSyncPressed = false;
@@ -83,6 +217,10 @@ void updateButtonStateMetronome()
       updateScreenMetronome();
       beatsSent = 0;
       timeBeat = micros() - curBpmInMicros;
+#ifdef VIBERCHART_BEAT_TABLES
+      if (FOLLOWING_CHART)
+        startChartBeats();
+#endif
     }
   } else if (buttonHeldState[2]) {
     if (buttonPressedDuration[2] > 1000000UL) {
@@ -93,21 +231,25 @@ void updateButtonStateMetronome()
         resetAllButtonStates();
         setBpm(curBpm);
       } else if (!buttonIsPressedNow[0] && buttonIsPressedNow[1]) {
+#ifdef VIBERCHART_BEAT_TABLES
+        followNextChart();
+#else
         // Only clear BPM if button has been held
         setBpm(DEFAULT_BPM);
+#endif
         resetAllButtonStates();
       }
-    } else if (buttonHeldState[0] && !buttonHeldState[1]) {
+    } else if (!FOLLOWING_CHART && buttonHeldState[0] && !buttonHeldState[1]) {
       setBpm(curBpm + 2.50);
       resetAllButtonStates();
-    } else if (!buttonHeldState[0] && buttonHeldState[1]) {
+    } else if (!FOLLOWING_CHART && !buttonHeldState[0] && buttonHeldState[1]) {
       setBpm(curBpm - 2.50);
       resetAllButtonStates();
     }
-  } else if (buttonHeldState[0] && !buttonHeldState[1] && !buttonHeldState[2]) {
+  } else if (!FOLLOWING_CHART && buttonHeldState[0] && !buttonHeldState[1] && !buttonHeldState[2]) {
     setBpm(curBpm + 0.25);
     resetAllButtonStates();
-  } else if (!buttonHeldState[0] && buttonHeldState[1] && !buttonHeldState[2]) {
+  } else if (!FOLLOWING_CHART && !buttonHeldState[0] && buttonHeldState[1] && !buttonHeldState[2]) {
     setBpm(curBpm - 0.25);
     resetAllButtonStates();
   }
@@ -127,6 +269,13 @@ void updateMetronome()
     return;
   }
 
+#ifdef VIBERCHART_BEAT_TABLES
+  if (FOLLOWING_CHART) {
+    updateChartBeats();
+    return;
+  }
+#endif
+
   signed long diff2 = diff - curBpmInMicros;
   if (abs(diff2) <= 8 || diff >= curBpmInMicros) {
     //Serial.println(diff2);
@@ -135,23 +284,11 @@ void updateMetronome()
     timeBeat = timeNow + diff2; // Adjust for some variance
 
     if (joypadState == false) {
-      joypadState = true;
-      Joystick.setButton(0, joypadState);
-      digitalWrite(JAMMA_UP, joypadState);
-      digitalWrite(JAMMA_DOWN, joypadState);
-      digitalWrite(JAMMA_LEFT, joypadState);
-      digitalWrite(JAMMA_RIGHT, joypadState);
-      Joystick.sendState();
+      setJoypadState(true);
     }
   } else {
     if (joypadState == true && diff > 25000) {
-      joypadState = false;
-      Joystick.setButton(0, joypadState);
-      digitalWrite(JAMMA_UP, joypadState);
-      digitalWrite(JAMMA_DOWN, joypadState);
-      digitalWrite(JAMMA_LEFT, joypadState);
-      digitalWrite(JAMMA_RIGHT, joypadState);
-      Joystick.sendState();
+      setJoypadState(false);
     }
   }
 }
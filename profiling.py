@@ -0,0 +1,143 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import time
+
+
+# Number of functions kept from cProfile captures, sorted by their own time
+PROFILE_FUNCTION_COUNT = 40
+
+
+class Profiler:
+    # Opt-in stage timers and counters for the conversion and header pipelines.
+    # Everything is a no-op until enable() is called so the instrumented code pays almost nothing by default.
+    # Stage times are inclusive, a stage that runs inside another one is counted in both.
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = None
+        self.reset()
+
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.functions = {}
+
+
+    def enable(self, capture_cprofile=False):
+        self.enabled = True
+
+        if capture_cprofile and self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+
+    def disable(self):
+        self.collect_cprofile()
+        self.enabled = False
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start_time = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.timers[name] = self.timers.get(name, 0) + time.perf_counter() - start_time
+
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def collect_cprofile(self):
+        # Folds the running cProfile capture into self.functions as {function: [calls, own time, cumulative time]}
+        if self.cprofile is None:
+            return
+
+        self.cprofile.disable()
+
+        for (filename, line, func), (primitive_calls, calls, own_time, cumulative_time, callers) in pstats.Stats(self.cprofile).stats.items():
+            key = "%s:%d(%s)" % (os.path.basename(filename), line, func)
+            totals = self.functions.setdefault(key, [0, 0, 0])
+            totals[0] += calls
+            totals[1] += own_time
+            totals[2] += cumulative_time
+
+        self.cprofile = None
+
+
+    def snapshot(self, reset=True):
+        # Returns the collected stats as a JSON serializable dict, a running cProfile capture is restarted afterwards
+        capturing = self.cprofile is not None
+        self.collect_cprofile()
+
+        result = {
+            'timers': dict(self.timers),
+            'counters': dict(self.counters),
+            'functions': {k: list(v) for k, v in self.functions.items()},
+        }
+
+        if reset:
+            self.reset()
+
+        if capturing:
+            self.enable(True)
+
+        return result
+
+
+def merge_snapshots(snapshots):
+    total = {
+        'timers': {},
+        'counters': {},
+        'functions': {},
+    }
+
+    for snapshot in snapshots:
+        for field in ['timers', 'counters']:
+            for k, v in snapshot[field].items():
+                total[field][k] = total[field].get(k, 0) + v
+
+        for k, v in snapshot['functions'].items():
+            totals = total['functions'].setdefault(k, [0, 0, 0])
+            for i in range(3):
+                totals[i] += v[i]
+
+    return total
+
+
+def trim_functions(snapshot, count=PROFILE_FUNCTION_COUNT):
+    # Keeps only the functions with the most own time so reports stay readable
+    functions = sorted(snapshot['functions'].items(), key=lambda x: (-x[1][1], x[0]))[:count]
+
+    return dict(snapshot, functions=[{
+        'function': k,
+        'calls': v[0],
+        'time': v[1],
+        'cumulative_time': v[2],
+    } for k, v in functions])
+
+
+def save_report(path, report):
+    json.dump(report, open(path, "w"), indent=4)
+
+
+def print_snapshot(snapshot, output=print):
+    for name, value in sorted(snapshot['timers'].items(), key=lambda x: -x[1]):
+        output("  %-20s %10.4fs" % (name, value))
+
+    for name, value in sorted(snapshot['counters'].items()):
+        output("  %-20s %10d" % (name, value))
+
+
+profiler = Profiler()
@@ -8,16 +8,39 @@ int curChartEventStartIdx;
 char curChartTitle[32];
 unsigned int curChartEventCount;
 unsigned int curChartEventIdx;
+unsigned int curChartCacheIdx;
 
 uint32_t curChartEventTimestamps[CACHE_SIZE];
 uint8_t curChartEventNotes[CACHE_SIZE];
 
+// The loaded chart's event data, curChartEventStartIdx and stream positions are relative to these
+#ifdef VIBERCHART_DELTA_STREAM
+const uint8_t* curChartStream;
+uint32_t curChartStreamPos;
+uint32_t curChartStreamTimestamp;
+#else
+const uint32_t* curChartTimestampData;
+const uint8_t* curChartNoteData;
+#endif
+uint32_t curChartShardStart;
+
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+uint32_t curChartSeekTime;
+
+// Panels held down at the seek point, bit i is arrowState[i]
+uint8_t curChartSeekHeldPanels;
+#endif
+
 void replayerInit()
 {
   chartCursor = 0;
   curChartEventCount = 0;
   curChartEventIdx = 0;
+  curChartCacheIdx = 0;
   curChartEventStartIdx = 0;
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+  curChartSeekTime = 0;
+#endif
   memset(curChartTitle, 0, sizeof(char) * 32);
   memset(curChartEventTimestamps, 0, sizeof(uint32_t) * CACHE_SIZE);
   memset(curChartEventNotes, 0, sizeof(uint8_t) * CACHE_SIZE);
@@ -27,7 +50,16 @@ void replayerInit()
 
 void resetInputs()
 {
-  arrowState[0] = arrowState[1] = arrowState[2] = arrowState[3] = false;
+  setInputs(0);
+}
+
+// Sets every arrow to the state of its bit in panels, bit i is arrowState[i]
+void setInputs(uint8_t panels)
+{
+  arrowState[0] = (panels & 1) != 0;
+  arrowState[1] = (panels & 2) != 0;
+  arrowState[2] = (panels & 4) != 0;
+  arrowState[3] = (panels & 8) != 0;
 
   Joystick.setButton(0, arrowState[0]);
   Joystick.setButton(1, arrowState[1]);
@@ -41,15 +73,99 @@ void resetInputs()
   digitalWrite(JAMMA_RIGHT, arrowState[3] ? LOW : HIGH);
 }
 
+void refillEventCache()
+{
+  int copyCount = curChartEventIdx + CACHE_SIZE > curChartEventCount ? curChartEventCount - curChartEventIdx : CACHE_SIZE;
+#ifdef VIBERCHART_DELTA_STREAM
+  decodeEventStream(curChartStream, &curChartStreamPos, &curChartStreamTimestamp, curChartEventTimestamps, curChartEventNotes, copyCount);
+#else
+  memcpy_P(curChartEventNotes, &curChartNoteData[curChartEventStartIdx + curChartEventIdx], sizeof(uint8_t) * copyCount);
+  memcpy_P(curChartEventTimestamps, &curChartTimestampData[curChartEventStartIdx + curChartEventIdx], sizeof(uint32_t) * copyCount);
+#endif
+  curChartCacheIdx = 0;
+}
+
+#ifdef VIBERCHART_SHARD_COUNT
+// Finds the shard holding the event data that starts at event_start_idx, a chart's data is never split across shards
+unsigned int findShard(uint32_t eventStartIdx)
+{
+  unsigned int shard = 0;
+  while (shard + 1 < VIBERCHART_SHARD_COUNT && pgm_read_dword(&shard_starts[shard + 1]) <= eventStartIdx)
+    shard++;
+
+  return shard;
+}
+#endif
+
 void loadChart()
 {
-  curChartEventStartIdx = pgm_read_dword(&charts[chartCursor].event_start_idx);
+  uint32_t eventStartIdx = pgm_read_word(&charts[chartCursor].event_start_idx);
   curChartEventIdx = 0;
 
-  int copyCount = curChartEventIdx + CACHE_SIZE > curChartEventCount ? curChartEventCount - curChartEventIdx : CACHE_SIZE;
-  memcpy_P(curChartEventNotes, &event_notes[curChartEventStartIdx + curChartEventIdx], sizeof(uint8_t) * copyCount);
-  memcpy_P(curChartEventTimestamps, &event_timestamps[curChartEventStartIdx + curChartEventIdx], sizeof(uint32_t) * copyCount);
+#ifdef VIBERCHART_SHARD_COUNT
+  unsigned int shard = findShard(eventStartIdx);
+  curChartShardStart = pgm_read_dword(&shard_starts[shard]);
+#ifdef VIBERCHART_DELTA_STREAM
+  curChartStream = (const uint8_t*)pgm_read_ptr(&shard_stream[shard]);
+#else
+  curChartTimestampData = (const uint32_t*)pgm_read_ptr(&shard_timestamps[shard]);
+  curChartNoteData = (const uint8_t*)pgm_read_ptr(&shard_notes[shard]);
+#endif
+#else
+  curChartShardStart = 0;
+#ifdef VIBERCHART_DELTA_STREAM
+  curChartStream = event_stream;
+#else
+  curChartTimestampData = event_timestamps;
+  curChartNoteData = event_notes;
+#endif
+#endif
+  curChartEventStartIdx = eventStartIdx - curChartShardStart;
+
+#ifdef VIBERCHART_DELTA_STREAM
+  // event_start_idx is a byte offset into event_stream for delta encoded charts
+  curChartStreamPos = curChartEventStartIdx;
+  curChartStreamTimestamp = 0;
+#endif
+
+  refillEventCache();
+}
+
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+unsigned int getSeekPointCount()
+{
+  return pgm_read_word(&chart_seek_start[chartCursor + 1]) - pgm_read_word(&chart_seek_start[chartCursor]);
+}
+
+// Moves the loaded chart to the seek point for curChartSeekTime and returns the chart time in us playback starts at
+uint32_t seekChart()
+{
+  unsigned int seekPointCount = getSeekPointCount();
+  if (seekPointCount == 0) {
+    return 0;
+  }
+
+  unsigned int seekPointIdx = curChartSeekTime / VIBERCHART_SEEK_INTERVAL_MS;
+  if (seekPointIdx >= seekPointCount)
+    seekPointIdx = seekPointCount - 1;
+
+  ViberSeekPoint seekPoint;
+  memcpy_P(&seekPoint, &seek_points[pgm_read_word(&chart_seek_start[chartCursor]) + seekPointIdx], sizeof(ViberSeekPoint));
+
+  // Panels held through the seek point, like freezes, are pressed when playback starts
+  curChartSeekHeldPanels = seekPoint.held_panels;
+
+  curChartEventIdx = seekPoint.event_idx;
+#ifdef VIBERCHART_DELTA_STREAM
+  curChartStreamPos = seekPoint.stream_pos - curChartShardStart;
+  curChartStreamTimestamp = seekPoint.stream_timestamp;
+#endif
+
+  refillEventCache();
+
+  return seekPointIdx * VIBERCHART_SEEK_INTERVAL_MS * 1000UL;
 }
+#endif
 
 void updateScreenChartReplay()
 {
@@ -62,6 +178,10 @@ void updateScreenChartReplay()
     String chart_str = "Chart " + String(chartCursor + 1) + "/" + String(VIBERCHART_CHARTCOUNT);
     String title_str = String(curChartTitle);
     String events_str = "Events: " + String(curChartEventCount);
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+    if (curChartSeekTime > 0)
+      events_str += " @" + String(curChartSeekTime / 1000) + "s";
+#endif
 
     u8g.drawStr(2, 8, chart_str.c_str());
     u8g.drawStr(2, 24, title_str.c_str());
@@ -98,11 +218,17 @@ void updateButtonStateChartReplay()
       chartCursor -= 1;
       if (chartCursor < 0)
         chartCursor = VIBERCHART_CHARTCOUNT - 1;
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+      curChartSeekTime = 0;
+#endif
       loadChart();
     } else if (buttonIsPressedNow[0]) {
       chartCursor += 1;
       if (chartCursor >= VIBERCHART_CHARTCOUNT)
         chartCursor = 0;
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+      curChartSeekTime = 0;
+#endif
       loadChart();
     }
   } else if (playbackState == PLAYBACK_PRIMED || playbackState == PLAYBACK_STARTED) {
@@ -110,6 +236,14 @@ void updateButtonStateChartReplay()
       // Stop
       playbackState = PLAYBACK_STOPPED;
       updateButtons = true;
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+    } else if (playbackState == PLAYBACK_PRIMED && buttonIsPressedNow[1]) {
+      // Move the start point forward by one seek interval, wrapping back to the start after the last one
+      curChartSeekTime += VIBERCHART_SEEK_INTERVAL_MS;
+      if (curChartSeekTime / VIBERCHART_SEEK_INTERVAL_MS >= getSeekPointCount())
+        curChartSeekTime = 0;
+      updateScreenChartReplay();
+#endif
     } else if (buttonIsPressed[0]) {
       if (!timeSyncPressed) {
         updateScreenChartReplay();
@@ -123,7 +257,15 @@ void updateButtonStateChartReplay()
       updateButtons = true;
       loadChart();
       curChartEventIdx = 0;
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+      // seekChart() has to finish before micros() is read, and the held panels replace the reset below
+      uint32_t seekStart = seekChart();
+      setInputs(curChartSeekHeldPanels);
+      updateButtons = false;
+      timeBeat = micros() - seekStart;
+#else
       timeBeat = micros();
+#endif
       timeSyncPressed = false;
     }
   }
@@ -141,13 +283,13 @@ void updateEventHandler()
 
   timeNow = micros();
 
-  uint32_t curChartEventTimestamp = curChartEventTimestamps[curChartEventIdx % CACHE_SIZE];
+  uint32_t curChartEventTimestamp = curChartEventTimestamps[curChartCacheIdx];
   signed long diff = timeNow - timeBeat;
   signed long diff2 = diff - curChartEventTimestamp;
   if (abs(diff2) <= 16 || diff >= curChartEventTimestamp) { // Try to reduce the distance from the timestamp by accepting slightly earlier presses if they're within a certain range
     //Serial.println(diff2);
 
-    uint8_t curChartEventNote = curChartEventNotes[curChartEventIdx % CACHE_SIZE];
+    uint8_t curChartEventNote = curChartEventNotes[curChartCacheIdx];
 
     bool updateJoystick = false;
     if (curChartEventNote & 0x10) {
@@ -199,13 +341,13 @@ void updateEventHandler()
       Joystick.sendState();
 
     curChartEventIdx++;
+    curChartCacheIdx++;
 
+    // The cache has its own cursor since playback can start from a seek point in the middle of a cache block
     if (curChartEventIdx > curChartEventCount) {
       playbackState = PLAYBACK_STOPPED;
-    } else if ((curChartEventIdx % CACHE_SIZE) == 0) {
-      int copyCount = curChartEventIdx + CACHE_SIZE > curChartEventCount ? curChartEventCount - curChartEventIdx : CACHE_SIZE;
-      memcpy_P(curChartEventNotes, &event_notes[curChartEventStartIdx + curChartEventIdx], sizeof(uint8_t) * copyCount);
-      memcpy_P(curChartEventTimestamps, &event_timestamps[curChartEventStartIdx + curChartEventIdx], sizeof(uint32_t) * copyCount);
+    } else if (curChartCacheIdx == CACHE_SIZE) {
+      refillEventCache();
     }
   }
 }
@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import re
+
+
+# Estimated costs in µs on the 16MHz Pro Micro, all of them can be overridden from the command line
+LOOP_OVERHEAD_US = 12 # micros(), updateButtonStateChartReplay() and the loop() bookkeeping
+BUTTON_POLL_US = 4 # One iteration of the button loop in updateButtonState()
+HANDLER_CHECK_US = 6 # updateEventHandler() when no event is due
+DISPATCH_US = 12 # updateEventHandler() dispatching an event that doesn't change the joystick state
+SEND_STATE_US = 60 # Extra cost of Joystick.sendState() when the event changed a button
+MEMCPY_P_BYTE_US = 0.3 # memcpy_P per byte
+DECODE_EVENT_US = 4 # decodeEventStream() per event
+DECODE_BYTE_US = 0.5 # decodeEventStream() per stream byte
+MICROS_RESOLUTION_US = 4 # micros() only counts in steps of 4µs at 16MHz
+ACCEPT_WINDOW_US = 16 # Events up to this early are dispatched, see updateEventHandler()
+
+# updateButtonState() calls updateEventHandler() before polling each of the 3 buttons
+# and loop() calls it once more after updateButtonStateChartReplay()
+HANDLER_CALLS_PER_LOOP = 4
+BUTTON_COUNT = 3
+
+CACHE_SIZE = 100
+
+LATENESS_PERCENTILES = [50, 90, 99]
+LATENESS_BUCKETS = [0, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+def parse_int_array(content, name):
+    m = re.search(r"const\s+\w+\s+%s\[(\d+)\]\s+PROGMEM\s*=\s*\{(.*?)\};" % name, content, re.S)
+
+    if m is None:
+        return None
+
+    values = [int(x) for x in m.group(2).replace("\n", "").split(",") if x.strip()]
+    assert(len(values) == int(m.group(1)))
+
+    return values
+
+
+def load_event_array(content, name, folder):
+    # Sharded headers declare each shard's array as extern and define it in viberchart_shard_<name>.cpp,
+    # the shards are concatenated back into the single array a monolithic header has
+    shard_names = re.findall(r"extern\s+const\s+\w+\s+%s_(\w+)\[\]\s+PROGMEM;" % name, content)
+
+    if not shard_names:
+        return parse_int_array(content, name)
+
+    values = []
+    for shard_name in shard_names:
+        shard_content = open(os.path.join(folder, "viberchart_shard_%s.cpp" % shard_name), "r").read()
+        values += parse_int_array(shard_content, "%s_%s" % (name, shard_name))
+
+    return values
+
+
+def decode_event_stream(stream, pos, count):
+    # Same as decodeEventStream() in eventstream.h, returns (timestamps, notes, bytes read)
+    timestamps = []
+    notes = []
+    timestamp = 0
+    start_pos = pos
+
+    for _ in range(count):
+        b = stream[pos]
+        pos += 1
+        sel = (b >> 3) & 0x0f
+        delta = b & 0x07
+        shift = 3
+
+        while b & 0x80:
+            b = stream[pos]
+            pos += 1
+            delta |= (b & 0x7f) << shift
+            shift += 7
+
+        timestamp += delta
+        timestamps.append(timestamp)
+
+        if sel < 8:
+            panel = sel >> 1
+            notes.append((0x10 << panel) | ((sel & 1) << panel))
+
+        else:
+            notes.append(stream[pos])
+            pos += 1
+
+    return timestamps, notes, pos - start_pos
+
+
+def load_header(list_path, meta_path=None):
+    # Returns the charts in a generated viberchart_list.h as dicts with their events and the size of each event in flash
+    content = open(list_path, "r").read()
+
+    meta_path = meta_path or os.path.join(os.path.dirname(list_path), "viberchart_meta.h")
+    meta = open(meta_path, "r").read() if os.path.exists(meta_path) else ""
+    is_delta = "VIBERCHART_DELTA_STREAM" in meta
+
+    m = re.search(r"#define\s+VIBERCHART_SEEK_INTERVAL_MS\s+(\d+)", meta)
+    seek_interval = int(m.group(1)) if m else None
+
+    m = re.search(r"ViberChart\s+charts\[\w+\]\s+PROGMEM\s*=\s*\{(.*?)\};", content, re.S)
+    entries = re.findall(r'\{"(.*?)",(\d+),(\d+)\}', m.group(1))
+
+    # (event index, held panels) of every seek point, the stream position and timestamp of delta points aren't needed
+    seek_points = []
+    seek_starts = []
+    if seek_interval is not None:
+        m = re.search(r"ViberSeekPoint\s+seek_points\[\d+\]\s+PROGMEM\s*=\s*\{(.*?)\};", content, re.S)
+        seek_points = [(int(x[0]), int(x[-1])) for x in [y.split(",") for y in re.findall(r"\{([\d,]+)\}", m.group(1))]]
+
+        m = re.search(r"chart_seek_start\[[^\]]*\]\s+PROGMEM\s*=\s*\{(.*?)\};", content, re.S)
+        seek_starts = [int(x) for x in m.group(1).split(",") if x.strip()]
+
+    folder = os.path.dirname(list_path)
+    stream = load_event_array(content, "event_stream", folder) if is_delta else None
+    event_timestamps = load_event_array(content, "event_timestamps", folder) if not is_delta else None
+    event_notes = load_event_array(content, "event_notes", folder) if not is_delta else None
+
+    charts = []
+    for chart_idx, (title, event_count, event_start_idx) in enumerate(entries):
+        event_count = int(event_count)
+        event_start_idx = int(event_start_idx)
+
+        if is_delta:
+            timestamps, notes, stream_size = decode_event_stream(stream, event_start_idx, event_count)
+
+            # Bytes each event takes in the stream, needed for the refill cost
+            event_sizes = []
+            pos = event_start_idx
+            for i in range(event_count):
+                pos_end = pos + decode_event_stream(stream, pos, 1)[2]
+                event_sizes.append(pos_end - pos)
+                pos = pos_end
+
+        else:
+            timestamps = event_timestamps[event_start_idx:event_start_idx+event_count]
+            notes = event_notes[event_start_idx:event_start_idx+event_count]
+            event_sizes = [5] * event_count
+
+        charts.append({
+            'title': title,
+            'timestamps': timestamps,
+            'notes': notes,
+            'event_sizes': event_sizes,
+            'seek_points': seek_points[seek_starts[chart_idx]:seek_starts[chart_idx + 1]] if seek_starts else [],
+        })
+
+    return charts, "delta" if is_delta else "raw", seek_interval
+
+
+def get_held_panels(notes):
+    # Bit i is set when arrow i is held down after these notes
+    held = 0
+    for note in notes:
+        for panel in range(4):
+            if note & (0x10 << panel):
+                held = (held | (1 << panel)) if note & (1 << panel) else (held & ~(1 << panel))
+
+    return held
+
+
+def check_seek_points(charts, seek_interval):
+    # Every stored seek point must be the first event at or after its time and hold the panels the notes before it leave held
+    for chart in charts:
+        for k, (event_idx, held_panels) in enumerate(chart['seek_points']):
+            idx = len([x for x in chart['timestamps'] if x < k * seek_interval * 1000])
+            expected_held = get_held_panels(chart['notes'][:idx])
+
+            if event_idx != idx or held_panels != expected_held:
+                print("Seek point check FAILED for %s: point %d is event %d with held panels %x instead of event %d with %x" % (chart['title'], k, event_idx, held_panels, idx, expected_held))
+                return False
+
+    return True
+
+
+def get_seek_start(chart, seek_time, seek_interval):
+    # Same as seekChart() in replayer.ino, returns (index of the first event played, chart time in µs playback starts at, held panels)
+    point_count = len(chart['seek_points'])
+
+    if point_count == 0:
+        return 0, 0, 0
+
+    point_idx = min(seek_time // seek_interval, point_count - 1)
+    event_idx, held_panels = chart['seek_points'][point_idx]
+
+    return event_idx, point_idx * seek_interval * 1000, held_panels
+
+
+def get_refill_cost(chart, start, count, event_format, costs):
+    if event_format == "delta":
+        return count * costs['decode_event'] + sum(chart['event_sizes'][start:start+count]) * costs['decode_byte']
+
+    return count * 5 * costs['memcpy_p_byte']
+
+
+def simulate_chart(chart, event_format, cache_size, costs, redraw_period=0, redraw_cost=0, start_idx=0, start_us=0, held_panels=0):
+    # Runs the replayer loop in virtual time from the moment playback starts at start_us into the chart with event start_idx
+    # and the held_panels of the seek point pressed.
+    # Returns the lateness of every event played (µs after its timestamp that its outputs were updated, negative when early)
+    # and every refill that ran on the hot path as (event index, cost).
+    timestamps = chart['timestamps']
+    notes = chart['notes']
+    count = len(timestamps)
+
+    idle_handler = costs['handler_check'] + costs['button_poll']
+    idle_loop = costs['loop_overhead'] + idle_handler * BUTTON_COUNT + costs['handler_check']
+
+    lateness = []
+    refills = []
+
+    # seekChart() presses the panels that are held through the seek point, like freezes
+    arrow_state = [(held_panels & (1 << panel)) != 0 for panel in range(4)]
+
+    t = float(start_us)
+    idx = start_idx
+    next_redraw = t + redraw_period if redraw_period else None
+
+    # The cache has its own cursor like curChartCacheIdx, seekChart() fills the cache from the seek point's event
+    cache_idx = 0
+
+    while idx < count:
+        if next_redraw is not None and t >= next_redraw:
+            t += redraw_cost
+            next_redraw += redraw_period
+
+        # Skip whole idle loops until the next event can be close to due, this keeps long charts fast to simulate
+        due = timestamps[idx] - costs['accept_window'] - costs['micros_resolution']
+        skip_loops = int((due - t) // idle_loop) - 1
+
+        if next_redraw is not None:
+            skip_loops = min(skip_loops, int((next_redraw - t) // idle_loop))
+
+        if skip_loops > 0:
+            t += skip_loops * idle_loop
+            continue
+
+        t += costs['loop_overhead']
+
+        for call in range(HANDLER_CALLS_PER_LOOP):
+            if idx < count:
+                micros = t - (t % costs['micros_resolution'])
+                timestamp = timestamps[idx]
+
+                if abs(micros - timestamp) <= costs['accept_window'] or micros >= timestamp:
+                    note = notes[idx]
+
+                    changed = False
+                    for panel in range(4):
+                        if note & (0x10 << panel):
+                            state = (note & (1 << panel)) != 0
+
+                            if state != arrow_state[panel]:
+                                arrow_state[panel] = state
+                                changed = True
+
+                    t += costs['dispatch'] + (costs['send_state'] if changed else 0)
+                    lateness.append(t - timestamp)
+
+                    idx += 1
+                    cache_idx += 1
+
+                    if idx < count and cache_idx == cache_size:
+                        refill_cost = get_refill_cost(chart, idx, min(cache_size, count - idx), event_format, costs)
+                        refills.append((idx, refill_cost))
+                        t += refill_cost
+                        cache_idx = 0
+
+                else:
+                    t += costs['handler_check']
+
+            if call < BUTTON_COUNT:
+                t += costs['button_poll']
+
+    return lateness, refills
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize_chart(chart, lateness, refills, late_threshold):
+    timestamps = chart['timestamps']
+
+    # lateness starts at the first event played, which is after the seek point when playback didn't start at the beginning
+    first_idx = len(timestamps) - len(lateness)
+
+    # Events that came due while a refill was running were held up by it
+    stalled_events = 0
+    for refill_idx, refill_cost in refills:
+        refill_start = timestamps[refill_idx - 1] + lateness[refill_idx - 1 - first_idx]
+        stalled_events += len([x for x in timestamps[refill_idx:refill_idx+8] if x < refill_start + refill_cost])
+
+    histogram = {}
+    for i, bucket in enumerate(LATENESS_BUCKETS):
+        upper = LATENESS_BUCKETS[i+1] if i + 1 < len(LATENESS_BUCKETS) else None
+        histogram[("<%d" % upper) if upper is not None else (">=%d" % bucket)] = len([x for x in lateness if x >= (bucket if i else float("-inf")) and (upper is None or x < upper)])
+
+    return {
+        'title': chart['title'],
+        'events': len(lateness),
+        'mean': sum(lateness) / len(lateness) if lateness else 0,
+        'min': min(lateness) if lateness else 0,
+        'max': max(lateness) if lateness else 0,
+        'percentiles': {"p%d" % p: percentile(lateness, p) for p in LATENESS_PERCENTILES},
+        'late_events': len([x for x in lateness if x > late_threshold]),
+        'early_events': len([x for x in lateness if x < 0]),
+        'histogram': histogram,
+        'refills': len(refills),
+        'max_refill': max([x[1] for x in refills]) if refills else 0,
+        'stalled_events': stalled_events,
+    }
+
+
+def simulate(charts, event_format, cache_size, costs, late_threshold, redraw_period=0, redraw_cost=0, seek_time=0, seek_interval=None):
+    results = []
+
+    for chart in charts:
+        start_idx, start_us, held_panels = get_seek_start(chart, seek_time, seek_interval) if seek_time else (0, 0, 0)
+        lateness, refills = simulate_chart(chart, event_format, cache_size, costs, redraw_period, redraw_cost, start_idx, start_us, held_panels)
+        results.append(summarize_chart(chart, lateness, refills, late_threshold))
+
+    return results
+
+
+def print_results(results, late_threshold):
+    print("%-20s %7s %8s %8s %8s %8s %6s %8s %8s" % ("Chart", "Events", "Mean", "p99", "Max", "Late", "Stalls", "Refills", "Refill"))
+
+    for result in results:
+        flag = " !" if result['late_events'] else ""
+        print("%-20s %7d %8.1f %8.1f %8.1f %8d %6d %8d %8.1f%s" % (
+            result['title'], result['events'], result['mean'], result['percentiles']['p99'], result['max'],
+            result['late_events'], result['stalled_events'], result['refills'], result['max_refill'], flag
+        ))
+
+    problem_charts = [x for x in results if x['late_events']]
+    if problem_charts:
+        print()
+        print("%d charts have events more than %dµs late" % (len(problem_charts), late_threshold))
+
+
+def print_sweep(sweep):
+    print("%10s %10s %10s %10s %10s %14s" % ("Cache", "RAM", "Worst p99", "Worst max", "Late", "Problem charts"))
+
+    for row in sweep:
+        print("%10d %10d %10.1f %10.1f %10d %14d" % (row['cache_size'], row['ram'], row['worst_p99'], row['worst_max'], row['late_events'], len(row['problem_charts'])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--input', help='Generated chart list header', default="viberchart_list.h")
+    parser.add_argument('-m', '--meta', help='Generated meta header (defaults to viberchart_meta.h next to the input)', default=None)
+    parser.add_argument('-c', '--chart', help='Only simulate charts whose title contains this', default=None)
+    parser.add_argument('--cache-size', help='CACHE_SIZE of replayer.ino', default=CACHE_SIZE, type=int)
+    parser.add_argument('--sweep', help='Simulate every chart with each of these cache sizes', default=None, type=int, nargs='+')
+    parser.add_argument('--seek', help='Start every chart this many ms in from the seek point the replayer would use, the headers need a seek table', default=0, type=int)
+    parser.add_argument('--late-threshold', help='Events later than this many µs are reported as late', default=500, type=float)
+    parser.add_argument('--redraw-period', help='Redraw the OLED every this many µs during playback (the firmware normally doesn\'t)', default=0, type=float)
+    parser.add_argument('--redraw-cost', help='Cost of one OLED redraw in µs', default=30000, type=float)
+    parser.add_argument('--loop-overhead', default=LOOP_OVERHEAD_US, type=float)
+    parser.add_argument('--button-poll', default=BUTTON_POLL_US, type=float)
+    parser.add_argument('--handler-check', default=HANDLER_CHECK_US, type=float)
+    parser.add_argument('--dispatch', default=DISPATCH_US, type=float)
+    parser.add_argument('--send-state', default=SEND_STATE_US, type=float)
+    parser.add_argument('--memcpy-p-byte', default=MEMCPY_P_BYTE_US, type=float)
+    parser.add_argument('--decode-event', default=DECODE_EVENT_US, type=float)
+    parser.add_argument('--decode-byte', default=DECODE_BYTE_US, type=float)
+    parser.add_argument('--micros-resolution', default=MICROS_RESOLUTION_US, type=float)
+    parser.add_argument('--accept-window', default=ACCEPT_WINDOW_US, type=float)
+    parser.add_argument('-o', '--output', help='Write the per chart results to a JSON file', default=None)
+
+    args = parser.parse_args()
+
+    costs = {k: getattr(args, k) for k in ['loop_overhead', 'button_poll', 'handler_check', 'dispatch', 'send_state', 'memcpy_p_byte', 'decode_event', 'decode_byte', 'micros_resolution', 'accept_window']}
+
+    charts, event_format, seek_interval = load_header(args.input, args.meta)
+
+    if args.seek and seek_interval is None:
+        parser.error("--seek needs headers generated with --seek-interval")
+
+    if args.chart:
+        charts = [x for x in charts if args.chart in x['title']]
+
+    if args.seek and not check_seek_points(charts, seek_interval):
+        exit(1)
+
+    print("Simulating %d charts (%s event format)" % (len(charts), event_format))
+
+    output = {
+        'format': event_format,
+        'costs': costs,
+    }
+
+    if args.sweep:
+        sweep = []
+
+        for cache_size in args.sweep:
+            results = simulate(charts, event_format, cache_size, costs, args.late_threshold, args.redraw_period, args.redraw_cost, args.seek, seek_interval)
+
+            sweep.append({
+                'cache_size': cache_size,
+                # Each cached event is a uint32_t timestamp and a uint8_t note
+                'ram': cache_size * 5,
+                'worst_p99': max([x['percentiles']['p99'] for x in results]) if results else 0,
+                'worst_max': max([x['max'] for x in results]) if results else 0,
+                'late_events': sum([x['late_events'] for x in results]),
+                'problem_charts': [x['title'] for x in results if x['late_events']],
+            })
+
+        print_sweep(sweep)
+        output['sweep'] = sweep
+
+    else:
+        results = simulate(charts, event_format, args.cache_size, costs, args.late_threshold, args.redraw_period, args.redraw_cost, args.seek, seek_interval)
+        print_results(results, args.late_threshold)
+        output['cache_size'] = args.cache_size
+        output['charts'] = results
+
+    if args.output:
+        json.dump(output, open(args.output, "w"), indent=4)
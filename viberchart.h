@@ -6,4 +6,32 @@ typedef struct {
     unsigned int event_start_idx;
 } ViberChart;
 
+#ifdef VIBERCHART_SEEK_INTERVAL_MS
+// Point k of a chart is its first event at or after k * VIBERCHART_SEEK_INTERVAL_MS,
+// held_panels has bit i set when arrow i is held down by the events before it
+typedef struct {
+    unsigned int event_idx;
+#ifdef VIBERCHART_DELTA_STREAM
+    uint32_t stream_pos;
+    uint32_t stream_timestamp;
+#endif
+    uint8_t held_panels;
+} ViberSeekPoint;
+#endif
+
+#ifdef VIBERCHART_BEAT_TABLES
+// beat_count beats of a chart, beat i is first_beat_us + i * (period_us + period_frac / 65536) us after the chart's first event
+typedef struct {
+    uint32_t first_beat_us;
+    uint32_t period_us;
+    uint16_t period_frac;
+    uint16_t beat_count;
+    uint16_t bpm_x100;
+} ViberBeatSegment;
+#endif
+
+#ifdef VIBERCHART_DELTA_STREAM
+#include "eventstream.h"
+#endif
+
 #include "viberchart_list.h"